@@ -27,26 +27,58 @@ plex_api_token = ''
 database_folder = ''
 plex_linux_user = 'plex'
 plex_linux_group = 'plex'
+#The amount of media items of which the metadata is requested at the same time when exporting
+metadata_batch_size = 50
+#The journal mode and synchronous setting of the database file (see sqlite docs)
+#Set journal mode to 'DELETE' when the database file is on a network share
+database_journal_mode = 'WAL'
+database_synchronous = 'NORMAL'
 
 from sys import platform
-from os import getenv, path, listdir
+from os import getenv, path, listdir, makedirs, replace, remove
 from sqlite3 import connect
 from datetime import datetime
 from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import local, Lock
+from requests import Session
+from requests.adapters import HTTPAdapter
+from collections import deque, Counter
+from re import compile as re_compile
+from hashlib import sha256
+from json import dumps, loads
+from shutil import copyfile
+from tempfile import mkstemp
 linux_platform = platform == 'linux'
 if linux_platform == True:
 	from pwd import getpwnam
 	from grp import getgrnam
-	from os import chmod, chown, makedirs
+	from os import chmod, chown
 
 # Environmental Variables
 plex_ip = getenv('plex_ip', plex_ip)
 plex_port = getenv('plex_port', plex_port)
 plex_api_token = getenv('plex_api_token', plex_api_token)
 database_folder = getenv('database_folder', database_folder)
+metadata_batch_size = int(getenv('metadata_batch_size', metadata_batch_size))
+database_journal_mode = getenv('database_journal_mode', database_journal_mode)
+database_synchronous = getenv('database_synchronous', database_synchronous)
 base_url = f"http://{plex_ip}:{plex_port}"
 request_cache = {}
-guid_map = {}
+guid_map = None
+guid_regex = re_compile(r"'id': '([^']+)'")
+blob_chunk_size = 65536
+#save progress every x processed media items
+checkpoint_interval = 100
+checkpoint_count = 0
+#write to the database file when this many rows or bytes are waiting
+write_batch_size = 500
+write_buffer_size = 16 * 1024 * 1024
+#watched statuses and intro markers that still need to be sent to the server when importing
+watched_queue = None
+intro_marker_queue = deque()
+intro_tag_id = None
+metadata_map = {}
 if linux_platform == True:
 	plex_linux_user = getenv('plex_linux_user', plex_linux_user)
 	plex_linux_group = getenv('plex_linux_group', plex_linux_group)
@@ -405,12 +437,58 @@ media_types = {
 			CinemaTrailersFromBluRay TEXT,
 			CinemaTrailersPrerollID TEXT,
 			GlobalMusicVideoPath TEXT
-		)
+		);
 		""",
 		-1,
 		[]
 	)
 }
+#tables that are not for a media type
+extra_tables = {
+	'guid_index': """
+		CREATE TABLE IF NOT EXISTS guid_index (
+			machine_id TEXT,
+			section_key VARCHAR(15),
+			guid VARCHAR(120),
+			rating_key VARCHAR(15),
+			media_type INTEGER(2)
+		);
+		CREATE INDEX IF NOT EXISTS guid_index_lookup ON guid_index (machine_id, section_key);
+		CREATE TABLE IF NOT EXISTS guid_index_section (
+			machine_id TEXT,
+			section_key VARCHAR(15),
+			content_changed_at INTEGER(8),
+			PRIMARY KEY (machine_id, section_key)
+		);
+	""",
+	#posters and arts are stored once per unique image, the poster and art columns of media contain the hash of the image
+	'image': """
+		CREATE TABLE IF NOT EXISTS image (
+			hash VARCHAR(64) PRIMARY KEY,
+			data BLOB
+		);
+	""",
+	#the chapter thumbnails of movies and episodes, one row per chapter
+	'chapter_thumbnail': """
+		CREATE TABLE IF NOT EXISTS chapter_thumbnail (
+			rating_key VARCHAR(15),
+			[index] INTEGER,
+			data BLOB,
+			PRIMARY KEY (rating_key, [index])
+		);
+	""",
+	#the media that has been processed by a run that hasn't finished yet, so that it can be resumed
+	'progress': """
+		CREATE TABLE IF NOT EXISTS progress (
+			process TEXT,
+			type VARCHAR(15),
+			rating_key VARCHAR(15),
+			PRIMARY KEY (process, type, rating_key)
+		);
+	""",
+	#media is looked up by guid when importing
+	'guid_columns': ''.join(f'CREATE INDEX IF NOT EXISTS {t}_guid ON {t} (guid);' for t in ('movie','show','season','episode','artist','album','track'))
+}
 process_summary = {
 	'metadata': "The standard plex metadata like title, summary, tags and more.",
 	'advanced_metadata': "The advanced plex settings (metadata) for media",
@@ -428,20 +506,353 @@ process_summary = {
 process_types = ('import','export','reset')
 advanced_metadata_keys = ('languageOverride','useOriginalTitle','episodeSort','autoDeletionItemPolicyUnwatchedLibrary','autoDeletionItemPolicyWatchedLibrary','flattenSeasons','showOrdering','albumSort')
 advanced_collection_keys = ('collectionMode','collectionSort')
-metadata_skip_keys = ('rating_key','guid','updated_at','poster','art','watched_status','intro_start','intro_end','hash','subtype','guids') + advanced_metadata_keys + advanced_collection_keys + media_types['server'][0]
+image_tables = ('movie','show','season','episode','artist','album','collection','playlist')
+metadata_skip_keys = ('rating_key','guid','updated_at','poster','art','watched_status','intro_start','intro_end','hash','chapter_thumbnails','subtype','guids') + advanced_metadata_keys + advanced_collection_keys + media_types['server'][0]
 
 def _leave(db, plex_db=None, e=None):
 	#called upon early exit of script
 	print('Shutting down...')
-	db.commit()
+	if watched_queue != None:
+		watched_queue.send()
 	if plex_db != None:
+		_import_intro_markers(plex_db.cursor())
 		plex_db.commit()
+	if isinstance(db, _archive_writer):
+		#an archive can't be resumed so don't leave the files of an unfinished export behind
+		db.close(completed=False)
+	db.commit()
 	print('Progress saved')
 	if e != None:
 		print('AN ERROR OCCURED. ALL YOUR PROGRESS IS SAVED. PLEASE SHARE THE FOLLOWING WITH THE DEVELOPER:')
 		raise e
 	exit(0)
 
+class _database_writer:
+	#write to the database file in batches (executemany) instead of one statement at a time
+	#statements with the same sql are grouped, so they should not depend on statements with a different sql
+	def __init__(self, cursor):
+		self.cursor = cursor
+		self.connection = cursor.connection
+		self.batches = {}
+		self.batch_rows = 0
+		self.batch_bytes = 0
+
+	@property
+	def lastrowid(self):
+		return self.cursor.lastrowid
+
+	def queue(self, sql: str, values):
+		self.batches.setdefault(sql, []).append(values)
+		self.batch_rows += 1
+		self.batch_bytes += sum(len(v) for v in values if isinstance(v, bytes))
+		if self.batch_rows >= write_batch_size or self.batch_bytes >= write_buffer_size:
+			self.flush()
+		return
+
+	def insert(self, table: str, keys: list, values: list):
+		#insert the row, replacing the existing one with the same primary key
+		self.queue(f'INSERT OR REPLACE INTO {table} ({",".join(keys)}) VALUES ({",".join(["?"] * len(keys))});', values)
+		return
+
+	def image(self, hash: str, content: bytes):
+		self.queue("INSERT OR IGNORE INTO image VALUES (?, ?);", (hash, content))
+		return
+
+	def execute(self, *args):
+		#run the statement directly (after everything that is queued)
+		self.flush()
+		return self.cursor.execute(*args)
+
+	def flush(self):
+		for sql, values in self.batches.items():
+			self.cursor.executemany(sql, values)
+		self.batches.clear()
+		self.batch_rows = self.batch_bytes = 0
+		return
+
+	def commit(self):
+		self.flush()
+		self.connection.commit()
+		return
+
+class _archive_writer(_database_writer):
+	#write the export to an archive folder instead of a database file:
+	#	{table}.ndjson or {table}.{library key}.ndjson: one json object per row
+	#	images/{hash}: the posters and arts
+	#	chapter_thumbnails/{rating key}/chapter{number}.jpg: the chapter thumbnails
+	#the given cursor is of a temporary database that only keeps track of the run itself (e.g. progress)
+	#files are written to a temporary file first and only replace the real one when the run is done,
+	#so that exports running at the same time into the same archive never see (or leave) half written files
+	def __init__(self, cursor, folder: str):
+		super().__init__(cursor)
+		self.folder = folder
+		#the library that is being exported, which decides the file that the media goes in
+		self.shard = None
+		#file name -> (temporary file, file handle)
+		self.shards = {}
+		makedirs(path.join(folder, 'images'), exist_ok=True)
+		makedirs(path.join(folder, 'chapter_thumbnails'), exist_ok=True)
+
+	def insert(self, table: str, keys: list, values: list):
+		name = f'{table}.ndjson' if self.shard == None else f'{table}.{self.shard}.ndjson'
+		if not name in self.shards:
+			#files are written from scratch every run, so different libraries can be exported at the same time into the same archive
+			fd, temp_file = mkstemp(dir=self.folder, prefix=f'.{name}.', suffix='.tmp')
+			self.shards[name] = (temp_file, open(fd, 'w'))
+		self.shards[name][1].write(dumps(dict(zip(keys, values))) + '\n')
+		return
+
+	def image(self, hash: str, content: bytes):
+		image_file = path.join(self.folder, 'images', hash)
+		if path.isfile(image_file): return
+		fd, temp_file = mkstemp(dir=path.join(self.folder, 'images'), suffix='.tmp')
+		with open(fd, 'wb') as f:
+			f.write(content)
+		replace(temp_file, image_file)
+		return
+
+	def chapter_thumbnails(self, rating_key: str, bundle: str):
+		folder = path.join(self.folder, 'chapter_thumbnails', rating_key)
+		makedirs(folder, exist_ok=True)
+		for chapter_number, chapter_file in _chapter_files(bundle):
+			copyfile(chapter_file, path.join(folder, f'chapter{chapter_number}.jpg'))
+		return
+
+	def commit(self):
+		super().commit()
+		for _, shard in self.shards.values():
+			shard.flush()
+		return
+
+	def close(self, completed: bool=True):
+		#put the files of a completed run in place; the files of an interrupted run are thrown away
+		self.commit()
+		for name, (temp_file, shard) in self.shards.items():
+			shard.close()
+			if completed:
+				replace(temp_file, path.join(self.folder, name))
+			else:
+				remove(temp_file)
+		self.shards.clear()
+		return
+
+def _read_archive(folder: str, database_file: str):
+	#stream the files of an archive into a database file, one row at a time, so that it can be imported like any other
+	db = connect(database_file)
+	cursor = db.cursor()
+	cursor.executescript(''.join(media_type[2] for media_type in media_types.values()) + ''.join(extra_tables.values()))
+	writer = _database_writer(cursor)
+	for shard in sorted(listdir(folder)):
+		table = shard.split('.')[0]
+		if not (shard.endswith('.ndjson') and table in media_types): continue
+		cursor.execute(f"SELECT * FROM {table} LIMIT 0;")
+		keys = next(zip(*cursor.description))
+		with open(path.join(folder, shard), 'r') as f:
+			for line in f:
+				row = loads(line)
+				writer.insert(table, keys, [row.get(k) for k in keys])
+	for image_hash in listdir(path.join(folder, 'images')) if path.isdir(path.join(folder, 'images')) else []:
+		if image_hash.endswith('.tmp'): continue
+		with open(path.join(folder, 'images', image_hash), 'rb') as f:
+			writer.image(image_hash, f.read())
+	for rating_key in listdir(path.join(folder, 'chapter_thumbnails')) if path.isdir(path.join(folder, 'chapter_thumbnails')) else []:
+		_export_chapter_thumbnails(writer, rating_key, path.join(folder, 'chapter_thumbnails', rating_key))
+	writer.commit()
+	db.close()
+	return
+
+class _deferred_cursor:
+	#stand-in for the database writer that is given to _export when it runs in a worker thread
+	#the statements are recorded and executed later by the thread that owns the real writer
+	def __init__(self):
+		self.statements = []
+
+	def queue(self, *args):
+		self.statements.append((lambda writer, *a: writer.queue(*a), args))
+
+	def insert(self, *args):
+		self.statements.append((lambda writer, *a: writer.insert(*a), args))
+
+	def image(self, *args):
+		self.statements.append((lambda writer, *a: writer.image(*a), args))
+
+	def execute(self, *args):
+		self.statements.append((_database_writer.execute, args))
+
+	def defer(self, function, *args):
+		#function(writer, *args) is called by the thread that owns the real writer
+		self.statements.append((function, args))
+
+class _export_pool:
+	#run _export for multiple media items at the same time (fetching metadata and images concurrently)
+	#while the thread that owns the database cursor writes the results in the original order
+	deferred_arg = 'cursor'
+
+	def __init__(self, workers: int, cursor, run: str):
+		self.executor = ThreadPoolExecutor(max_workers=workers)
+		self.cursor = cursor
+		self.replay_cursor = cursor
+		self.plex_db = None
+		self.run = run
+		self.pending = deque()
+		self.max_pending = workers * 2
+
+	def _method(self, **kwargs):
+		return _export(**kwargs)
+
+	def submit(self, **kwargs):
+		deferred_cursor = _deferred_cursor()
+		if self.deferred_arg != None:
+			kwargs[self.deferred_arg] = deferred_cursor
+		self.pending.append((self.executor.submit(self._method, **kwargs), deferred_cursor, kwargs['type'], kwargs['data']['ratingKey']))
+		#keep the amount of media in memory bounded by writing the oldest one when too many are waiting
+		if len(self.pending) > self.max_pending:
+			return self._write_next()
+		return
+
+	def _write_next(self):
+		future, deferred_cursor, type, rating_key = self.pending.popleft()
+		response = future.result()
+		for function, args in deferred_cursor.statements:
+			function(self.replay_cursor, *args)
+		if not isinstance(response, str):
+			_checkpoint(self.cursor, self.run, type, rating_key, self.plex_db)
+		return response
+
+	def flush(self):
+		#write all media that is still being processed
+		while self.pending:
+			response = self._write_next()
+			if isinstance(response, str): return response
+		return
+
+	def close(self):
+		response = self.flush()
+		self.executor.shutdown()
+		return response
+
+class _import_pool(_export_pool):
+	#run _import for multiple media items at the same time
+	#all requests for one media item are made by one worker in order (e.g. metadata before prefs, scrobble before progress)
+	#the workers read from their own connection to the database file
+	deferred_arg = None
+
+	def __init__(self, workers: int, cursor, run: str, database_file: str, plex_db=None):
+		super().__init__(workers, cursor, run)
+		self.database_file = database_file
+		self.plex_db = plex_db
+		self.local = local()
+		self.connections = []
+
+	def _method(self, **kwargs):
+		if not hasattr(self.local, 'cursor'):
+			db = connect(self.database_file, check_same_thread=False)
+			self.connections.append(db)
+			self.local.cursor = db.cursor()
+		kwargs['cursor'] = self.local.cursor
+		return _import(**kwargs)
+
+	def close(self):
+		response = super().close()
+		for db in self.connections:
+			db.close()
+		return response
+
+class _watched_queue:
+	#collect the scrobble/unscrobble/progress requests per user and send them in batches
+	#every user gets it's own session (so no swapping of tokens) and the requests of a batch are made concurrently
+	#the requests are made by the workers of the import pool when there is one, so that the amount of connections stays within the amount of workers
+	def __init__(self, ssn, workers: int, executor=None):
+		self.ssn = ssn
+		self.workers = workers
+		self.executor = executor
+		self.sessions = {}
+		self.queue = {}
+		#the workers add to the queue while the main thread sends it
+		self.lock = Lock()
+
+	def _session(self, user_token: str):
+		if not user_token in self.sessions:
+			user_ssn = Session()
+			user_ssn.headers.update(self.ssn.headers)
+			user_ssn.params.update(self.ssn.params)
+			user_ssn.params.update({'X-Plex-Token': user_token})
+			user_ssn.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=self.workers, pool_block=True))
+			self.sessions[user_token] = user_ssn
+		return self.sessions[user_token]
+
+	def add(self, user_token: str, rating_key: str, watched_state: str):
+		params = {'identifier': 'com.plexapp.plugins.library', 'key': rating_key}
+		if watched_state == 'True':
+			#mark watched
+			request = ('/:/scrobble', params)
+		elif watched_state == 'False':
+			#mark not-watched
+			request = ('/:/unscrobble', params)
+		elif watched_state.isdigit():
+			#mark partially watched
+			request = ('/:/progress', dict(params, time=watched_state, state='stopped'))
+		else: return
+		with self.lock:
+			self.queue.setdefault(user_token, []).append(request)
+		return
+
+	def send(self):
+		with self.lock:
+			queue, self.queue = self.queue, {}
+			requests = [(self._session(user_token), request) for user_token, user_queue in queue.items() for request in user_queue]
+		if not requests: return
+		if self.executor != None:
+			list(self.executor.map(lambda r: r[0].get(f'{base_url}{r[1][0]}', params=r[1][1]), requests))
+		else:
+			with ThreadPoolExecutor(max_workers=self.workers) as executor:
+				list(executor.map(lambda r: r[0].get(f'{base_url}{r[1][0]}', params=r[1][1]), requests))
+		return
+
+	def close(self):
+		self.send()
+		for user_ssn in self.sessions.values():
+			user_ssn.close()
+		return
+
+class _hash_map(dict):
+	#rating key -> hash of the media in the plex database, looked up when needed instead of loading every media item of the server
+	#it has it's own connection to the plex database so that the workers can use it too
+	def __init__(self, db_file: str):
+		super().__init__()
+		self.db = connect(db_file, check_same_thread=False)
+		self.lock = Lock()
+
+	def __missing__(self, rating_key: str):
+		with self.lock:
+			result = self.db.execute("SELECT hash FROM metadata_items WHERE id = ?;", (rating_key,)).fetchone()
+		self[rating_key] = result[0] if result != None else None
+		return self[rating_key]
+
+	def load_library(self, lib_key: str):
+		#get the hashes of all movies and episodes in the library at once (replacing the ones of the previous library)
+		with self.lock:
+			result = self.db.execute("SELECT id, hash FROM metadata_items WHERE library_section_id = ? AND metadata_type IN (1,4);", (lib_key,)).fetchall()
+		self.clear()
+		self.update((str(i[0]), i[1]) for i in result)
+		return
+
+def _checkpoint(cursor, run: str, type: str, rating_key: str, plex_db=None):
+	#mark the media as done and save the progress every so often, so that the run can be resumed after being interrupted
+	global checkpoint_count
+
+	cursor.queue("INSERT OR IGNORE INTO progress VALUES (?, ?, ?);", (run, type, rating_key))
+	checkpoint_count += 1
+	if checkpoint_count % checkpoint_interval == 0:
+		#the media is only done once it's watched status and intro marker are on the server
+		if watched_queue != None:
+			watched_queue.send()
+		if plex_db != None:
+			_import_intro_markers(plex_db.cursor())
+			plex_db.commit()
+		cursor.commit()
+	return
+
 def _req_cache(ssn, url, params={}, headers={}):
 	#use for general requests in the hope that it is requested multiple times
 	#and that way the cached result from the first time is returned
@@ -452,32 +863,182 @@ def _req_cache(ssn, url, params={}, headers={}):
 
 	return request_cache[url]
 
-def _guid_to_ratingkey(ssn, guid: str):
+class _metadata_batch:
+	#the complete metadata of multiple media items, requested at once when the first of them is processed
+	#so that the processing of a library starts right away and the requests are spread over the workers
+	def __init__(self, ssn, rating_keys: list):
+		self.ssn = ssn
+		self.rating_keys = rating_keys
+		self.metadata = None
+		self.lock = Lock()
+
+	def get(self, rating_key: str):
+		with self.lock:
+			if self.metadata == None:
+				self.metadata = {}
+				media_info = self.ssn.get(f'{base_url}/library/metadata/{",".join(self.rating_keys)}', params={'includeGuids': '1'})
+				if media_info.status_code == 200:
+					self.metadata = {m['ratingKey']: m for m in media_info.json()['MediaContainer'].get('Metadata',[])}
+			return self.metadata.pop(rating_key, None)
+
+def _prefetch_metadata(ssn, media: list, timestamp_map: dict, done_media: set):
+	#request the complete metadata of multiple media items at the same time instead of one request per item
+	#the batch of a media item is put in metadata_map where _export or _import picks it up
+
+	#only media that is going to be exported (and that wasn't done already by the run that is resumed) needs it's metadata
+	rating_keys = [
+		m['ratingKey'] for m in media
+		if not (m['type'], m['ratingKey']) in done_media
+		and timestamp_map.get(m['type'], {}).get(m['ratingKey']) != m.get('updatedAt',0)
+	]
+	for offset in range(0, len(rating_keys), metadata_batch_size):
+		batch = _metadata_batch(ssn, rating_keys[offset:offset + metadata_batch_size])
+		for rating_key in batch.rating_keys:
+			metadata_map[rating_key] = batch
+	return
+
+def _get_prefetched_metadata(rating_key: str):
+	batch = metadata_map.pop(rating_key, None)
+	if batch == None: return None
+	return batch.get(rating_key)
+
+def _export_image(ssn, cursor, url: str):
+	#download the image and store it in the database if it isn't in it already; returns the hash of the image
+	r = ssn.get(f'{base_url}{url}')
+	if r.status_code != 200: return None
+	image_hash = sha256(r.content).hexdigest()
+	cursor.image(image_hash, r.content)
+	return image_hash
+
+def _import_image(cursor, value):
+	#get the image that the poster or art column refers to
+	if value == None or isinstance(value, bytes):
+		#no image or database file from before images were deduplicated
+		return value
+	image = cursor.connection.execute("SELECT data FROM image WHERE hash = ?;", (value,)).fetchone()
+	if image == None: return None
+	return image[0]
+
+def _chapter_files(bundle: str):
+	#the chapter thumbnails in a bundle, sorted on chapter number: [(chapter number, file), ...]
+	chapters = []
+	for chapter_file in listdir(bundle):
+		chapter_number = ''.join(filter(str.isdigit, chapter_file))
+		if chapter_number:
+			chapters.append((int(chapter_number), path.join(bundle, chapter_file)))
+	return sorted(chapters)
+
+def _export_chapter_thumbnails(cursor, rating_key: str, bundle: str):
+	#put the chapter thumbnails from disk in the database, one row per chapter
+	if isinstance(cursor, _archive_writer):
+		return cursor.chapter_thumbnails(rating_key, bundle)
+	#remove the chapters that the media doesn't have anymore; the rows are queued so that they're written in batches
+	#(the size of the queued thumbnails is limited by write_buffer_size)
+	cursor.execute("DELETE FROM chapter_thumbnail WHERE rating_key = ?;", (rating_key,))
+	for chapter_number, chapter_file in _chapter_files(bundle):
+		with open(chapter_file, 'rb') as f:
+			cursor.insert('chapter_thumbnail', ['rating_key','[index]','data'], [rating_key, chapter_number, f.read()])
+	return
+
+def _import_chapter_thumbnail(cursor, rowid: int, chapter_file: str):
+	#stream the chapter thumbnail from the database to disk
+	with open(chapter_file, 'wb') as f:
+		if not hasattr(cursor.connection, 'blobopen'):
+			#incremental blob i/o is not supported by this version of python
+			f.write(cursor.connection.execute("SELECT data FROM chapter_thumbnail WHERE rowid = ?;", (rowid,)).fetchone()[0])
+			return
+		with cursor.connection.blobopen('chapter_thumbnail', 'data', rowid, readonly=True) as blob:
+			while True:
+				chunk = blob.read(blob_chunk_size)
+				if not chunk: break
+				f.write(chunk)
+	return
+
+def _section_children(ssn, lib_key: str, media_type: int, parent_key: str):
+	#get all media of a type inside a library with one request and group them by their parent (e.g. all episodes per show)
+	lib_output = ssn.get(f'{base_url}/library/sections/{lib_key}/all', params={'type': media_type, 'includeGuids': '1'})
+	if lib_output.status_code != 200: return {}
+	children = {}
+	for media in lib_output.json()['MediaContainer'].get('Metadata',[]):
+		children.setdefault(media.get(parent_key), []).append(media)
+	return children
+
+def _watched_status(media_info: dict, rating_key: str, user_data: tuple, watched_map: dict):
+	#build the value for the watched_status column: user id followed by it's watched state, for every user
+	db_watched = ['_admin',str(media_info.get('viewOffset', 'viewCount' in media_info))]
+	for user_id, user_token in zip(*user_data):
+		user_watched = str(watched_map.get(user_token, {}).get(rating_key, ''))
+		if user_watched == '': continue
+		db_watched += [user_id, user_watched]
+	return ",".join(db_watched)
+
+def _build_guid_index(ssn, cursor=None):
+	#map every guid (e.g. imdb://tt0111161) of every movie, show, episode, artist, album and track to where it can be found on the server
+	#guid -> [(library key, rating key, plex type id), ...]
+	#when a cursor is given, the index is stored in the database file and libraries that haven't changed since are loaded from it
 	global guid_map
 
-	rating_key = guid_map.get(guid)
-	if rating_key == None:
-		sections = _req_cache(ssn, f'{base_url}/library/sections')['MediaContainer'].get('Directory',[])
-		for lib in sections:
-			if lib['type'] == 'movie':
-				media_type = '1'
-			elif lib['type'] == 'show':
-				media_type = '4'
-			else: continue
-			lib_output = _req_cache(ssn, f'{base_url}/library/sections/{lib["key"]}/all', params={'type': media_type, 'includeGuids': '1'})['MediaContainer'].get('Metadata',[])
-			for media in lib_output:
-				media_guid = str(media['Guid'])
-				if media_guid == guid:
-					rating_key = media['ratingKey']
-					guid_map[media_guid] = media['ratingKey']
-					break
-			else:
-				continue
-			break
-		else:
-			rating_key = None
+	guid_map = {}
+	machine_id = _req_cache(ssn, f'{base_url}/')['MediaContainer']['machineIdentifier']
+	sections = _req_cache(ssn, f'{base_url}/library/sections')['MediaContainer'].get('Directory',[])
+	for lib in sections:
+		if lib['type'] == 'movie':
+			lib_types = (1,)
+		elif lib['type'] == 'show':
+			lib_types = (2,4)
+		elif lib['type'] == 'artist':
+			lib_types = (8,9,10)
+		else: continue
+		lib_key = str(lib['key'])
+		content_changed_at = lib.get('contentChangedAt', lib.get('updatedAt', 0))
+
+		lib_index = None
+		if cursor != None:
+			cursor.execute("SELECT content_changed_at FROM guid_index_section WHERE machine_id = ? AND section_key = ?;", (machine_id, lib_key))
+			if cursor.fetchone() == (content_changed_at,):
+				#library hasn't changed since the index was stored
+				cursor.execute("SELECT guid, rating_key, media_type FROM guid_index WHERE machine_id = ? AND section_key = ?;", (machine_id, lib_key))
+				lib_index = cursor.fetchall()
+
+		if lib_index == None:
+			lib_index = []
+			for media_type in lib_types:
+				lib_output = ssn.get(f'{base_url}/library/sections/{lib_key}/all', params={'type': media_type, 'includeGuids': '1'})
+				if lib_output.status_code != 200: continue
+				for media in lib_output.json()['MediaContainer'].get('Metadata',[]):
+					lib_index += [(guid['id'], media['ratingKey'], media_type) for guid in media.get('Guid',[])]
+
+			if cursor != None:
+				cursor.execute("DELETE FROM guid_index WHERE machine_id = ? AND section_key = ?;", (machine_id, lib_key))
+				cursor.executemany("INSERT INTO guid_index VALUES (?, ?, ?, ?, ?);", ((machine_id, lib_key) + entry for entry in lib_index))
+				cursor.execute("INSERT OR REPLACE INTO guid_index_section VALUES (?, ?, ?);", (machine_id, lib_key, content_changed_at))
+
+		for guid, rating_key, media_type in lib_index:
+			guid_map.setdefault(guid, []).append((lib_key, rating_key, media_type))
+
+	return guid_map
+
+def _guid_matches(ssn, guid: str):
+	#guid is the Guid list of media as stored in the database
+	#returns library key -> (rating key, plex type id) of the media that matches the most guids in that library
+	if guid_map == None:
+		_build_guid_index(ssn)
+
+	votes = Counter()
+	for guid_id in guid_regex.findall(guid):
+		votes.update(guid_map.get(guid_id, ()))
+	matches = {}
+	for (lib_key, rating_key, media_type), _ in votes.most_common():
+		if not lib_key in matches:
+			matches[lib_key] = (rating_key, media_type)
+	return matches
 
-	return rating_key
+def _guid_to_ratingkey(ssn, guid: str):
+	votes = Counter()
+	for rating_key, _ in _guid_matches(ssn, guid).values():
+		votes[rating_key] += 1
+	if not votes: return None
+	return votes.most_common(1)[0][0]
 
 def _export(
 		type: str, data: dict, ssn, cursor, user_data: tuple, watched_map: dict, timestamp_map: dict,
@@ -485,7 +1046,6 @@ def _export(
 		target_poster: bool, target_episode_poster: bool, target_art: bool, target_episode_art: bool,
 		database_folder=None, hash_map=None, user_id=None
 	):
-	user_ids, user_tokens = user_data
 
 	#extract different data based on the type
 	if type in media_types:
@@ -505,11 +1065,7 @@ def _export(
 			db_keys.append(pref['id'])
 			db_values.append(pref['value'])
 		#write to the database
-		comm = f"""
-		INSERT INTO {type} ({",".join(db_keys)})
-		VALUES ({",".join(['?'] * len(db_keys))})
-		"""
-		cursor.execute(comm, db_values)
+		cursor.insert(type, db_keys, db_values)
 		return
 
 	rating_key = data['ratingKey']
@@ -518,9 +1074,10 @@ def _export(
 	updated_at = timestamp_map[type].get(rating_key)
 	if updated_at != None:
 		if updated_at == data.get('updatedAt',0):
+			if target_watched == True and type in ('movie','episode'):
+				#watching media doesn't change updatedAt, so keep the watched status up to date using the data we already have
+				cursor.queue(f"UPDATE {type} SET watched_status = ? WHERE rating_key = ?;", (_watched_status(data, rating_key, user_data, watched_map), rating_key))
 			return
-		else:
-			cursor.execute(f"DELETE FROM {type} WHERE rating_key = '{rating_key}'")
 	elif type == 'collection':
 		#collection either hasn't been added to db yet or has been imported after exporting
 		cursor.execute(f'DELETE FROM {type} WHERE title = "{data["title"]}";')
@@ -552,23 +1109,19 @@ def _export(
 
 		#export images
 		if 'thumb' in collection_info:
-			r = ssn.get(f'{base_url}{collection_info["thumb"]}')
-			if r.status_code == 200:
+			image_hash = _export_image(ssn, cursor, collection_info["thumb"])
+			if image_hash != None:
 				db_keys.append('poster')
-				db_values.append(r.content)
+				db_values.append(image_hash)
 
 		if 'art' in collection_info:
-			r = ssn.get(f'{base_url}{collection_info["art"]}')
-			if r.status_code == 200:
+			image_hash = _export_image(ssn, cursor, collection_info["art"])
+			if image_hash != None:
 				db_keys.append('art')
-				db_values.append(r.content)
+				db_values.append(image_hash)
 
 		#write to database
-		comm = f"""
-		INSERT INTO {type} ({",".join(db_keys)})
-		VALUES ({",".join(['?'] * len(db_keys))})
-		"""
-		cursor.execute(comm, db_values)
+		cursor.insert(type, db_keys, db_values)
 		return
 
 	#if requested, export playlist here and return function (playlist is a "special" case)
@@ -585,31 +1138,36 @@ def _export(
 
 		#export images
 		if 'thumb' in data:
-			r = ssn.get(f'{base_url}{data["thumb"]}')
-			if r.status_code == 200:
+			image_hash = _export_image(ssn, cursor, data["thumb"])
+			if image_hash != None:
 				db_keys.append('poster')
-				db_values.append(r.content)
+				db_values.append(image_hash)
 
 		if 'art' in data:
-			r = ssn.get(f'{base_url}{data["thumb"]}')
-			if r.status_code == 200:
+			image_hash = _export_image(ssn, cursor, data["art"])
+			if image_hash != None:
 				db_keys.append('art')
-				db_values.append(r.content)
+				db_values.append(image_hash)
 
 		#write to database
-		comm = f"""
-		INSERT INTO {type} ({",".join(db_keys)})
-		VALUES ({",".join(['?'] * len(db_keys))})
-		"""
-		cursor.execute(comm, db_values)
+		cursor.insert(type, db_keys, db_values)
 		return
 
 	if not 'Guid' in data: return
 
 	#request certain media again when we need it's metadata (lib output doesn't show all)
-	if (target_metadata == True and type != 'season') \
+	#markers and preferences are only included when requesting a single media item,
+	#otherwise use the metadata that was requested in a batch if available
+	media_info = None
+	if target_metadata == True and type != 'season' \
+	and not (target_intro_markers == True and type == 'episode') \
+	and not (target_advanced_metadata == True and type == 'movie'):
+		media_info = _get_prefetched_metadata(rating_key)
+
+	if media_info != None:
+		pass
+	elif (target_metadata == True and type != 'season') \
 	or (target_intro_markers == True and type == 'episode') \
-	or (target_chapter_thumbnail == True and type in ('movie','episode')) \
 	or (target_advanced_metadata == True and type == 'movie'):
 		media_info = ssn.get(f'{base_url}/library/metadata/{rating_key}', params={'includeGuids': '1', 'includeMarkers': '1', 'includeChapters': '1', 'includePreferences': '1'})
 		if media_info.status_code != 200: return
@@ -641,12 +1199,7 @@ def _export(
 
 	if target_watched == True and type in ('movie','episode'):
 		db_keys.append('watched_status')
-		db_watched = ['_admin',str(media_info.get('viewOffset', 'viewCount' in media_info))]
-		for user_id, user_token in zip(user_ids, user_tokens):
-			user_watched = str(watched_map.get(user_token, {}).get(rating_key, ''))
-			if user_watched == '': continue
-			db_watched += [user_id, user_watched]
-		db_values.append(",".join(db_watched))
+		db_values.append(_watched_status(media_info, rating_key, user_data, watched_map))
 
 	if target_intro_markers == True and type in 'episode':
 		for marker in media_info.get('Marker',[]):
@@ -656,43 +1209,102 @@ def _export(
 				db_values += [marker['startTimeOffset'], marker['endTimeOffset']]
 				break
 
-	if target_chapter_thumbnail == True and type in ('movie','episode'):
+	if target_chapter_thumbnail == True and type in ('movie','episode') and hash_map[rating_key] != None:
 		hash = hash_map[rating_key]
 		bundle = path.join(path.dirname(path.dirname(database_folder)), 'Media', 'localhost', hash[0], f'{hash[1:]}.bundle', 'Contents', 'Chapters')
-		# #check if media doesn't already have autogenerated thumbs and if hash matches
+		#check if media has autogenerated thumbs
 		if path.isdir(bundle):
-			db_keys += ['hash','chapter_thumbnails']
+			db_keys.append('hash')
 			db_values.append(hash)
-			db_values.append((b'\0' * 20).join(map(lambda c: open(path.join(bundle, c), 'rb').read(), listdir(bundle))))
+			if isinstance(cursor, _deferred_cursor):
+				cursor.defer(_export_chapter_thumbnails, rating_key, bundle)
+			else:
+				_export_chapter_thumbnails(cursor, rating_key, bundle)
 
 	if (target_poster == True and not type in ('episode','track')) or (target_episode_poster == True and type == 'episode'):
 		if 'thumb' in media_info:
-			r = ssn.get(f'{base_url}{media_info["thumb"]}')
-			if r.status_code == 200:
+			image_hash = _export_image(ssn, cursor, media_info["thumb"])
+			if image_hash != None:
 				db_keys.append('poster')
-				db_values.append(r.content)
+				db_values.append(image_hash)
 
 	if (target_art == True and not type in ('episode','track')) or (target_episode_art == True and type == 'episode'):
 		if 'art' in media_info:
-			r = ssn.get(f'{base_url}{media_info["art"]}')
-			if r.status_code == 200:
+			image_hash = _export_image(ssn, cursor, media_info["art"])
+			if image_hash != None:
 				db_keys.append('art')
-				db_values.append(r.content)
+				db_values.append(image_hash)
 
 	#write to the database
-	comm = f"""
-	INSERT INTO {type} ({",".join(db_keys)})
-	VALUES ({",".join(['?'] * len(db_keys))})
-	"""
-	cursor.execute(comm, db_values)
+	cursor.insert(type, db_keys, db_values)
 
 	return
 
+def _current_value(media_info: dict, option: str):
+	#the value of the option on the server, in the way it's stored in the database
+	if option[0].isupper():
+		return ",".join(x['tag'] for x in media_info.get(option, []))
+	elif option == '[index]':
+		return str(media_info.get('index', ''))
+	elif option == 'titleSort':
+		return str(media_info.get('titleSort', media_info.get('title', '')))
+	return str(media_info.get(option, ''))
+
+def _import_intro_markers(plex_cursor):
+	#add or update the intro markers that are waiting in the queue, all at once
+	global intro_tag_id
+
+	markers = dict(intro_marker_queue.popleft() for _ in range(len(intro_marker_queue)))
+	if not markers: return
+
+	#find the media that already have an intro marker
+	plex_cursor.execute("SELECT metadata_item_id FROM taggings WHERE text = 'intro' AND metadata_item_id IN (SELECT value FROM json_each(?));", (dumps(list(map(int, markers))),))
+	existing = set(str(r[0]) for r in plex_cursor.fetchall())
+
+	#intro marker exists so update timestamps
+	plex_cursor.executemany("""
+		UPDATE taggings
+		SET
+			time_offset = ?,
+			end_time_offset = ?
+		WHERE
+			text = 'intro'
+			AND metadata_item_id = ?;
+	""", ((start, end, rating_key) for rating_key, (start, end) in markers.items() if rating_key in existing))
+
+	#no intro marker exists so create one
+	new_markers = [(rating_key, start, end) for rating_key, (start, end) in markers.items() if not rating_key in existing]
+	if not new_markers: return
+	if intro_tag_id == None:
+		plex_cursor.execute("SELECT tag_id FROM taggings WHERE text = 'intro' LIMIT 1;")
+		i = plex_cursor.fetchone()
+		if i == None:
+			#no id yet for intro's so make one that isn't taken yet
+			plex_cursor.execute("SELECT MAX(tag_id) FROM taggings;")
+			intro_tag_id = int(plex_cursor.fetchone()[0] or 0) + 1
+		else:
+			intro_tag_id = i[0]
+	d = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+	plex_cursor.executemany(f"""
+		INSERT INTO taggings (
+			metadata_item_id,
+			tag_id,
+			[index],
+			text,
+			time_offset,
+			end_time_offset,
+			thumb_url,
+			created_at,
+			extra_data
+		) VALUES (?, ?, 0, 'intro', ?, ?, '', ?, 'pv%3Aversion=5');
+	""", ((rating_key, intro_tag_id, start, end, d) for rating_key, start, end in new_markers))
+	return
+
 def _import(
 		type: str, data: dict, ssn, cursor, media_lib_id: str, user_data: tuple, watched_map: dict, timestamp_map: dict,
 		target_metadata: bool, target_advanced_metadata: bool, target_watched: bool, target_intro_markers: bool, target_chapter_thumbnail: bool,
 		target_poster: bool, target_episode_poster: bool, target_art: bool, target_episode_art: bool,
-		plex_cursor=None, database_folder=None, hash_map=None
+		database_folder=None, hash_map=None, diff: str=None
 	):
 	user_ids, user_tokens = user_data
 
@@ -710,55 +1322,62 @@ def _import(
 		server_settings = cursor.fetchone()
 		if server_settings == None: return
 		payload = dict(zip(media_types[type][0], server_settings[1:]))
+		if diff != None:
+			#only send the settings that are different
+			current = dict((s['id'], str(s['value'])) for s in _req_cache(ssn, f'{base_url}/:/prefs')['MediaContainer']['Setting'])
+			payload = {k: v for k, v in payload.items() if current.get(k) != str(v)}
+			if diff == 'report':
+				if payload: print(f'	Server settings: {", ".join(payload)}')
+				return
+			if not payload: return
 		ssn.put(f'{base_url}/:/prefs', params=payload)
 		return
 
 	if type == 'collection':
 		cursor.execute(f"SELECT * FROM {type};")
 		collections = cursor.fetchall()
-		collection_types = set([c[8] for c in collections])
 		target_keys = next(zip(*cursor.description))
-		sections = _req_cache(ssn, f'{base_url}/library/sections')['MediaContainer'].get('Directory',[])
-		#go through every library and check if a collection "fits" in it
-		for lib in sections:
-			if not lib['type'] in collection_types: continue
-			lib_output = ssn.get(f'{base_url}/library/sections/{lib["key"]}/all', params={'type': media_types[lib['type']][3], 'includeGuids': '1'}).json()['MediaContainer'].get('Metadata',[])
-			#guid -> ratingkey
-			lib_content = {str(m['Guid']): m['ratingKey'] for m in lib_output if 'Guid' in m}
-			collection_output = ssn.get(f'{base_url}/library/sections/{lib["key"]}/collections').json()['MediaContainer'].get('Metadata',[])
-			#title -> ratingkey
-			collection_content = dict(map(lambda c: (c['title'], c['ratingKey']), collection_output))
-			#go through every collection to check if it fits in library
-			for collection in collections:
-				collection_entries = collection[9].split("|")
-				collection_keys = [lib_content.get(str(e)) for e in collection_entries if str(e) in lib_content]
-				if len(collection_keys) == len(collection_entries):
-					#collection can go in library
-					#remove existing collection if present
-					old_ratingkey = collection_content.get(collection[2])
-					if old_ratingkey != None:
-						ssn.delete(f'{base_url}/library/collections/{old_ratingkey}')
-					#create collection
-					new_ratingkey = ssn.post(f'{base_url}/library/collections', params={'title': collection[2], 'smart': '0', 'sectionId': lib['key'], 'type': media_types[lib['type']][3], 'uri': f'server://{machine_id}/com.plexapp.plugins.library/library/metadata/{",".join(collection_keys)}'}).json()['MediaContainer']['Metadata'][0]['ratingKey']
-					#set poster
-					if collection[10] != None:
-						ssn.post(f'{base_url}/library/collections/{new_ratingkey}/posters', data=collection[10])
-					#set art
-					if collection[11] != None:
-						ssn.post(f'{base_url}/library/collections/{new_ratingkey}/arts', data=collection[11])
-					#set settings
-					payload = {
-						'type': media_type,
-						'id': new_ratingkey,
-					}
-					for option, value in zip(target_keys, collection):
-						if option in metadata_skip_keys: continue
-						payload[f'{option}.value'] = value or ''
-						payload[f'{option}.locked'] = 1
-					ssn.put(f'{base_url}/library/sections/{lib["key"]}/all', params=payload)
-					#set advanced settings
-					payload = {o: v for o, v in zip(target_keys, collection) if o in advanced_collection_keys}
-					ssn.put(f'{base_url}/library/metadata/{new_ratingkey}/prefs', params=payload)
+		sections = dict((str(lib['key']), lib) for lib in _req_cache(ssn, f'{base_url}/library/sections')['MediaContainer'].get('Directory',[]))
+		#library key -> collection title -> rating key
+		lib_collections = {}
+		for collection in collections:
+			#find the libraries that contain every entry of the collection
+			entry_matches = [_guid_matches(ssn, e) for e in collection[9].split("|")]
+			for lib_key in set.intersection(*(set(m) for m in entry_matches)):
+				if sections.get(lib_key) == None: continue
+				collection_keys = [m[lib_key][0] for m in entry_matches]
+				if not lib_key in lib_collections:
+					collection_output = ssn.get(f'{base_url}/library/sections/{lib_key}/collections').json()['MediaContainer'].get('Metadata',[])
+					lib_collections[lib_key] = dict(map(lambda c: (c['title'], c['ratingKey']), collection_output))
+				#collection can go in library
+				if diff == 'report':
+					print(f'	Collection {collection[2]}: recreated in library {sections[lib_key]["title"]}')
+					continue
+				#remove existing collection if present
+				old_ratingkey = lib_collections[lib_key].get(collection[2])
+				if old_ratingkey != None:
+					ssn.delete(f'{base_url}/library/collections/{old_ratingkey}')
+				#create collection
+				new_ratingkey = ssn.post(f'{base_url}/library/collections', params={'title': collection[2], 'smart': '0', 'sectionId': lib_key, 'type': entry_matches[0][lib_key][1], 'uri': f'server://{machine_id}/com.plexapp.plugins.library/library/metadata/{",".join(collection_keys)}'}).json()['MediaContainer']['Metadata'][0]['ratingKey']
+				#set poster
+				if collection[10] != None:
+					ssn.post(f'{base_url}/library/collections/{new_ratingkey}/posters', data=_import_image(cursor, collection[10]))
+				#set art
+				if collection[11] != None:
+					ssn.post(f'{base_url}/library/collections/{new_ratingkey}/arts', data=_import_image(cursor, collection[11]))
+				#set settings
+				payload = {
+					'type': media_type,
+					'id': new_ratingkey,
+				}
+				for option, value in zip(target_keys, collection):
+					if option in metadata_skip_keys: continue
+					payload[f'{option}.value'] = value or ''
+					payload[f'{option}.locked'] = 1
+				ssn.put(f'{base_url}/library/sections/{lib_key}/all', params=payload)
+				#set advanced settings
+				payload = {o: v for o, v in zip(target_keys, collection) if o in advanced_collection_keys}
+				ssn.put(f'{base_url}/library/metadata/{new_ratingkey}/prefs', params=payload)
 		return
 
 	if type == 'playlist':
@@ -769,6 +1388,9 @@ def _import(
 			else:
 				if not playlist[2] in user_ids: continue
 				user_token = user_tokens[user_ids.index(playlist[2])]
+			if diff == 'report':
+				print(f'	Playlist {playlist[3]}: recreated for user {playlist[2]}')
+				continue
 			ssn.params.update({'X-Plex-Token': user_token})
 			user_playlists = _req_cache(ssn, f'{base_url}/playlists')['MediaContainer'].get('Metadata',[])
 			#delete already existing playlists with the name
@@ -783,17 +1405,25 @@ def _import(
 				ssn.put(f'{base_url}/playlists/{new_ratingkey}', params={'summary': playlist[4]})
 			#set images
 			if playlist[7] or '' != '':
-				ssn.post(f'{base_url}/playlists/{new_ratingkey}/posters', data=playlist[7])
+				ssn.post(f'{base_url}/playlists/{new_ratingkey}/posters', data=_import_image(cursor, playlist[7]))
 			if playlist[8] or '' != '':
-				ssn.post(f'{base_url}/playlists/{new_ratingkey}/arts', data=playlist[8])
+				ssn.post(f'{base_url}/playlists/{new_ratingkey}/arts', data=_import_image(cursor, playlist[8]))
 		return
 
 	rating_key = data['ratingKey']
 	if not 'Guid' in data: return
 
 	#request certain media again when we need it's metadata (lib output doesn't show all)
-	if target_metadata == True and type != 'season':
-		media_info = ssn.get(f'{base_url}/library/metadata/{rating_key}', params={'includeGuids': '1', 'includeMarkers': '1'})
+	#use the metadata that was requested in a batch if available; the preferences are only included when requesting a single media item
+	compare_prefs = diff != None and target_advanced_metadata == True and type in ('movie','show','artist')
+	media_info = None
+	if target_metadata == True and type != 'season' and compare_prefs == False:
+		media_info = _get_prefetched_metadata(rating_key)
+
+	if media_info != None:
+		pass
+	elif (target_metadata == True and type != 'season') or compare_prefs == True:
+		media_info = ssn.get(f'{base_url}/library/metadata/{rating_key}', params={'includeGuids': '1', 'includeMarkers': '1', 'includePreferences': '1'})
 		if media_info.status_code != 200: return
 		media_info = media_info.json()['MediaContainer']['Metadata'][0]
 	else:
@@ -805,6 +1435,8 @@ def _import(
 	target = cursor.fetchone()
 	if target == None: return
 	target_keys = next(zip(*cursor.description))
+	#the fields that are different from the target when diffing
+	changes = []
 
 	#import data
 	if target_metadata == True:
@@ -818,8 +1450,12 @@ def _import(
 			payload['artist.id.value'] = data['parentRatingKey']
 
 		#build the payload that sets all the values
+		locked_fields = set(f['name'] for f in media_info.get('Field', []) if f.get('locked') == True)
 		for option, value in zip(target_keys, target):
 			if option in metadata_skip_keys: continue
+			elif diff != None and _current_value(media_info, option) == str(value or '') and (option.lower() if option[0].isupper() else option) in locked_fields:
+				#value is already set (and locked)
+				continue
 			elif option[0].isupper():
 				#list of labels
 				value = value or ''
@@ -838,17 +1474,34 @@ def _import(
 				payload[f'{option}.locked'] = 1
 
 		#upload to plex
-		ssn.put(f'{base_url}/library/sections/{media_lib_id}/all', params=payload)
+		changed_fields = [k.split('.')[0].split('[')[0] for k in payload if k.endswith('.locked') and not k in ('thumb.locked','art.locked')]
+		if diff == None:
+			ssn.put(f'{base_url}/library/sections/{media_lib_id}/all', params=payload)
+		elif changed_fields:
+			changes += changed_fields
+			if diff == 'apply':
+				ssn.put(f'{base_url}/library/sections/{media_lib_id}/all', params=payload)
 
 	if target_advanced_metadata == True and type in ('movie','show','artist'):
 		payload = {o: v for o, v in zip(target_keys, target) if o in advanced_metadata_keys}
-		ssn.put(f'{base_url}/library/metadata/{rating_key}/prefs', params=payload)
-
-	if 'poster' in target_keys and ((type != 'episode' and target_poster == True) or (type == 'episode' and target_episode_poster == True)):
-		ssn.post(f'{base_url}/library/metadata/{rating_key}/posters', data=target[target_keys.index('poster')])
-
-	if 'art' in target_keys and ((type != 'episode' and target_art == True) or (type == 'episode' and target_episode_art == True)):
-		ssn.post(f'{base_url}/library/metadata/{rating_key}/arts', data=target[target_keys.index('art')])
+		if diff != None:
+			current = dict((s['id'], str(s['value'])) for s in media_info.get('Preferences', {}).get('Setting', []))
+			payload = {o: v for o, v in payload.items() if v != None and current.get(o) != str(v)}
+			changes += list(payload)
+		if diff != 'report' and (payload or diff == None):
+			ssn.put(f'{base_url}/library/metadata/{rating_key}/prefs', params=payload)
+
+	for image_type, endpoint, target_image in (('poster', 'posters', target_poster if type != 'episode' else target_episode_poster), ('art', 'arts', target_art if type != 'episode' else target_episode_art)):
+		if not (image_type in target_keys and target_image == True): continue
+		image = _import_image(cursor, target[target_keys.index(image_type)])
+		if diff != None:
+			#compare the content of the images
+			current_image = media_info.get('thumb' if image_type == 'poster' else 'art')
+			if image == None or (current_image != None and sha256(image).hexdigest() == sha256(ssn.get(f'{base_url}{current_image}').content).hexdigest()):
+				continue
+			changes.append(image_type)
+			if diff == 'report': continue
+		ssn.post(f'{base_url}/library/metadata/{rating_key}/{endpoint}', data=image)
 
 	if 'watched_status' in target_keys and target_watched == True:
 		watched_info = target[target_keys.index('watched_status')].split(',')
@@ -858,77 +1511,57 @@ def _import(
 				if not user in user_ids: continue
 				user_token = user_tokens[user_ids.index(user)]
 
-			#set watched status of media for this user
-			if watched_state == 'True':
-				#mark watched
-				ssn.get(f'{base_url}/:/scrobble', params={'identifier': 'com.plexapp.plugins.library', 'key': rating_key, 'X-Plex-Token': user_token})
-			elif watched_state == 'False':
-				#mark not-watched
-				ssn.get(f'{base_url}/:/unscrobble', params={'identifier': 'com.plexapp.plugins.library', 'key': rating_key, 'X-Plex-Token': user_token})
-			elif watched_state.isdigit():
-				#mark partially watched
-				ssn.get(f'{base_url}/:/progress', params={'identifier': 'com.plexapp.plugins.library', 'key': rating_key, 'time': watched_state, 'state': 'stopped', 'X-Plex-Token': user_token})
+			#skip if the media already has this watched status for this user
+			if str(watched_map.get(user_token, {}).get(rating_key, '')) == watched_state: continue
+			if diff == 'report':
+				changes.append(f'watched_status ({user})')
+			else:
+				watched_queue.add(user_token, rating_key, watched_state)
 
 	if 'intro_start' in target_keys and 'intro_end' in target_keys and target_intro_markers == True:
-		#check if media already has intro marker
-		plex_cursor.execute("SELECT * FROM taggings WHERE text = 'intro' AND metadata_item_id = ?;", (rating_key,))
-		if plex_cursor.fetchone() == None:
-			#no intro marker exists so create one
-			d = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-			plex_cursor.execute("SELECT tag_id FROM taggings WHERE text = 'intro';")
-			i = plex_cursor.fetchone()
-			if i == None:
-				#no id yet for intro's so make one that isn't taken yet
-				plex_cursor.execute("SELECT tag_id FROM taggings ORDER BY tag_id DESC;")
-				i = int(plex_cursor.fetchone()[0]) + 1
-			else:
-				i = i[0]
-			plex_cursor.execute(f"""
-				INSERT INTO taggings (
-					metadata_item_id,
-					tag_id,
-					[index],
-					text,
-					time_offset,
-					end_time_offset,
-					thumb_url,
-					created_at,
-					extra_data
-				) VALUES (?, ?, 0, 'intro', ?, ?, '', ?, 'pv%3Aversion=5');
-			""", (rating_key, i, target[target_keys.index('intro_start')], target[target_keys.index('intro_end')], d))
+		#the marker is added to the plex database together with the others (see _import_intro_markers)
+		if diff == 'report':
+			changes.append('intro_marker')
 		else:
-			#intro marker exists so update timestamps
-			plex_cursor.execute("""
-				UPDATE taggings
-				SET
-					time_offset = ?,
-					end_time_offset = ?
-				WHERE
-					text = 'intro'
-					AND metadata_item_id = ?;
-			""", (target[target_keys.index('intro_start')], target[target_keys.index('intro_end')], rating_key))
-
-	if 'hash' in target_keys and 'chapter_thumbnails' in target_keys and target_chapter_thumbnail == True:
+			intro_marker_queue.append((rating_key, (target[target_keys.index('intro_start')], target[target_keys.index('intro_end')])))
+
+	if 'hash' in target_keys and target_chapter_thumbnail == True and hash_map[rating_key] != None:
 		hash = hash_map[rating_key]
 		bundle = path.join(path.dirname(path.dirname(database_folder)), 'Media', 'localhost', hash[0], f'{hash[1:]}.bundle', 'Contents', 'Chapters')
 		#check if media doesn't already have autogenerated thumbs and if hash matches
 		if target[target_keys.index('hash')] == hash and not path.isdir(bundle):
-			thumbs = target[target_keys.index('chapter_thumbnails')].split(b'\0' * 20)
-			#create folder path to put thumbs in
-			bundle = path.dirname(path.dirname(database_folder))
-			for folder in ('Media', 'localhost', hash[0], f'{hash[1:]}.bundle', 'Contents', 'Chapters'):
-				bundle = path.join(bundle, folder)
-				makedirs(bundle)
-				chmod(bundle, 0o755)
-				chown(bundle, plex_linux_user, plex_linux_group)
-
-			#put all thumbs in created folder
-			for index, thumb in enumerate(thumbs):
-				chapter_file = path.join(bundle, f'chapter{index+1}.jpg')
-				with open(chapter_file, 'wb') as f:
-					f.write(thumb)
-				chmod(chapter_file, 0o644)
-				chown(bundle, plex_linux_user, plex_linux_group)
+			chapters = cursor.connection.execute("SELECT rowid, [index] FROM chapter_thumbnail WHERE rating_key = ? ORDER BY [index];", (target[target_keys.index('rating_key')],)).fetchall()
+			legacy_thumbs = None
+			if not chapters and 'chapter_thumbnails' in target_keys and target[target_keys.index('chapter_thumbnails')] != None:
+				#database file from before chapter thumbnails got their own table
+				legacy_thumbs = target[target_keys.index('chapter_thumbnails')].split(b'\0' * 20)
+				chapters = [(None, index + 1) for index in range(len(legacy_thumbs))]
+
+			if chapters and diff == 'report':
+				changes.append('chapter_thumbnail')
+			elif chapters:
+				#create folder path to put thumbs in
+				bundle = path.dirname(path.dirname(database_folder))
+				for folder in ('Media', 'localhost', hash[0], f'{hash[1:]}.bundle', 'Contents', 'Chapters'):
+					bundle = path.join(bundle, folder)
+					if path.isdir(bundle): continue
+					makedirs(bundle)
+					chmod(bundle, 0o755)
+					chown(bundle, plex_linux_user, plex_linux_group)
+
+				#put all thumbs in created folder
+				for rowid, chapter_number in chapters:
+					chapter_file = path.join(bundle, f'chapter{chapter_number}.jpg')
+					if legacy_thumbs != None:
+						with open(chapter_file, 'wb') as f:
+							f.write(legacy_thumbs[chapter_number - 1])
+					else:
+						_import_chapter_thumbnail(cursor, rowid, chapter_file)
+					chmod(chapter_file, 0o644)
+					chown(chapter_file, plex_linux_user, plex_linux_group)
+
+	if diff == 'report' and changes:
+		print(f'	{media_info.get("title", "")} ({rating_key}): {", ".join(changes)}')
 	return
 
 def _reset(
@@ -973,9 +1606,13 @@ def plex_exporter_importer(
 		library_name: str=None,
 		movie_name: str=None,
 		series_name: str=None, season_number: int=None, episode_number: int=None,
-		artist_name: str=None, album_name: str=None, track_name: str=None
+		artist_name: str=None, album_name: str=None, track_name: str=None,
+		workers: int=1, incremental: bool=False, persist_guid_index: bool=False, resume: bool=False,
+		diff: str=None
 	):
+	global watched_queue
 	result_json, watched_map, timestamp_map = [], {}, {}
+	media_pool = None
 	lib_target_specifiers = (library_name,movie_name,series_name,season_number,episode_number,artist_name,album_name,track_name)
 	all_target_specifiers = (all_movie, all_show, all_music)
 
@@ -984,9 +1621,26 @@ def plex_exporter_importer(
 		return 'Invalid value for "type"'
 	if platform == False and type == 'import' and 'chapter_thumbnails' in process:
 		return 'Importing chapter thumbnails on a non-linux system is not supported'
+	if workers < 1:
+		return 'Invalid value for "workers"'
+	if not diff in (None,'report','apply'):
+		return 'Invalid value for "diff"'
 	#setup db location
+	archive_folder = None
 	if type == 'export':
-		if path.isdir(location):
+		if location.endswith('.archive'):
+			#export to an archive folder; the database is only used to keep track of the run
+			if resume or incremental:
+				#the progress and timestamps aren't kept between runs
+				return 'Resuming and incremental exports are not supported with an archive'
+			if any(t != None for t in lib_target_specifiers[1:]):
+				#the files of a library are replaced as a whole, so exporting one item of it would drop the others
+				return 'Targeting specific media is not supported with an archive'
+			archive_folder = location
+			database_file = ':memory:'
+			print(f'Exporting to {archive_folder} (Archive)')
+
+		elif path.isdir(location):
 			database_file = f'{path.splitext(path.abspath(__file__))[0]}.db'
 			if path.isfile(database_file):
 				print(f'Exporting to {database_file} (Updating)')
@@ -1007,6 +1661,15 @@ def plex_exporter_importer(
 		if path.isfile(location):
 			database_file = location
 			print(f'Importing from {database_file}')
+		elif path.isdir(location) and location.endswith('.archive'):
+			#import from an archive folder by reading it into a database file inside of it (again when the archive has changed since)
+			database_file = path.join(location, 'import.db')
+			print(f'Importing from {location} (Archive)')
+			archive_changed = max((path.getmtime(path.join(location, f)) for f in listdir(location) if not f.startswith('import.db')), default=0)
+			if not path.isfile(database_file) or path.getmtime(database_file) < archive_changed:
+				for f in (database_file, f'{database_file}-wal', f'{database_file}-shm'):
+					if path.isfile(f): remove(f)
+				_read_archive(location, database_file)
 		else:
 			return 'Location not found'
 
@@ -1073,12 +1736,10 @@ def plex_exporter_importer(
 
 		#setup db connection
 		plex_db = connect(db_file)
-		plex_cursor = plex_db.cursor()
 
 		#create hash_map if needed
 		if 'chapter_thumbnail' in process:
-			plex_cursor.execute("SELECT id, hash FROM metadata_items;")
-			hash_map = dict(map(lambda i: (str(i[0]), i[1]), plex_cursor.fetchall()))
+			hash_map = _hash_map(db_file)
 
 	#check for illegal arg parsing
 	if all == True:
@@ -1099,9 +1760,12 @@ def plex_exporter_importer(
 
 	#setup variables
 	db = connect(database_file)
+	db.execute(f'PRAGMA journal_mode = {database_journal_mode};')
+	db.execute(f'PRAGMA synchronous = {database_synchronous};')
 	cursor = db.cursor()
+	writer = _database_writer(cursor) if archive_folder == None else _archive_writer(cursor, archive_folder)
 	#create tables
-	cursor.executescript(''.join(media_type[2] for media_type in media_types.values()))
+	cursor.executescript(''.join(media_type[2] for media_type in media_types.values()) + ''.join(extra_tables.values()))
 
 	machine_id = _req_cache(ssn, f'{base_url}/')['MediaContainer']['machineIdentifier']
 	shared_users = ssn.get(f'http://plex.tv/api/servers/{machine_id}/shared_servers').text
@@ -1115,13 +1779,13 @@ def plex_exporter_importer(
 		method = _reset
 	args = {
 		'ssn': ssn,
-		'cursor': cursor,
+		'cursor': writer if type == 'export' else cursor,
 		'target_poster': 'poster' in process,
 		'target_art': 'art' in process,
 		'target_metadata': 'metadata' in process
 	}
 	exit_args = {
-		'db': db
+		'db': writer
 	}
 	if type in ('export','import'):
 		args['user_data'] = user_data
@@ -1131,15 +1795,54 @@ def plex_exporter_importer(
 		args['target_watched'] = 'watched_status' in process
 		args['target_intro_markers'] = 'intro_marker' in process
 		args['target_chapter_thumbnail'] = 'chapter_thumbnail' in process
+		if type == 'import':
+			args['diff'] = diff
 		if 'chapter_thumbnail' in process:
 			args['hash_map'] = hash_map
 			args['database_folder'] = database_root
 	if type == 'import' and any(p in process for p in ('intro_marker','chapter_thumbnail')):
-		args['plex_cursor'] = plex_cursor
 		exit_args['plex_db'] = plex_db
+	#media types of which the metadata can be requested in batches when exporting
+	prefetch_types = set()
+	if type == 'export' and 'metadata' in process:
+		prefetch_types.update(('album','track'))
+		if not 'advanced_metadata' in process: prefetch_types.add('movie')
+		if not 'intro_marker' in process: prefetch_types.add('episode')
+	elif type == 'import' and 'metadata' in process:
+		#the markers aren't needed when importing, but the preferences are when diffing advanced metadata
+		prefetch_types.update(('episode','album','track'))
+		if not (diff != None and 'advanced_metadata' in process): prefetch_types.add('movie')
+
+	#progress of a run is only reused when resuming the same run
+	run = f'{type}:{",".join(sorted(process))}'
+	if resume == True:
+		cursor.execute("SELECT type, rating_key FROM progress WHERE process = ?;", (run,))
+		done_media = set(cursor.fetchall())
+		print(f'Resuming; skipping {len(done_media)} media items that were already done\n')
+	else:
+		cursor.execute("DELETE FROM progress WHERE process = ?;", (run,))
+		done_media = set()
+
+	def process_media(media_type: str, media: dict):
+		#process a media item of a library, unless it was already done by the run that is resumed
+		if not (media_type, media['ratingKey']) in done_media:
+			if media_pool != None:
+				response = media_pool.submit(type=media_type, data=media, watched_map=watched_map, timestamp_map=timestamp_map, **args)
+			else:
+				response = method(type=media_type, data=media, watched_map=watched_map, timestamp_map=timestamp_map, **args)
+				if isinstance(response, str): return response
+				_checkpoint(writer, run, media_type, media['ratingKey'], exit_args.get('plex_db'))
+			if isinstance(response, str): return response
+		result_json.append(media['ratingKey'])
+		return
 
 	#start working on the media/settings
+	run_finished = False
 	try:
+		if type == 'import' and ('collection' in process or 'playlist' in process):
+			#build the guid -> rating key index of the server once for all collections and playlists
+			_build_guid_index(ssn, cursor if persist_guid_index == True else None)
+
 		if 'server_settings' in process:
 			print('Server Settings')
 			if type == 'import':
@@ -1153,9 +1856,12 @@ def plex_exporter_importer(
 			print('Collections')
 			if type in ('export','reset'):
 				if type == 'export':
-					cursor.execute(f"SELECT rating_key, updated_at FROM 'collection';")
+					writer.execute(f"SELECT rating_key, updated_at FROM 'collection';")
 					timestamp_map['collection'] = dict(cursor.fetchall())
 				for lib in sections:
+					if archive_folder != None:
+						#every library gets it's own collection file so that exports of other libraries don't overwrite it
+						writer.shard = lib['key']
 					collections = ssn.get(f'{base_url}/library/sections/{lib["key"]}/collections').json()['MediaContainer'].get('Metadata',[])
 					for collection in collections:
 						if type == 'export':
@@ -1164,6 +1870,8 @@ def plex_exporter_importer(
 							response = method(type='collection', data=collection, watched_map=watched_map, timestamp_map=timestamp_map, media_lib_id=lib['key'], **args)
 						if isinstance(response, str): return response
 						else: result_json.append(collection['ratingKey'])
+				if archive_folder != None:
+					writer.shard = None
 
 			elif type == 'import':
 				response = method(type='collection', data={}, watched_map=watched_map, timestamp_map=timestamp_map, media_lib_id=0, **args)
@@ -1172,7 +1880,7 @@ def plex_exporter_importer(
 		if 'playlist' in process:
 			print('Playlists')
 			if type == 'export':
-				cursor.execute(f"SELECT rating_key, updated_at FROM 'playlist';")
+				writer.execute(f"SELECT rating_key, updated_at FROM 'playlist';")
 				timestamp_map['playlist'] = dict(cursor.fetchall())
 				complete_user_data = (list(user_data[0]) + ['_admin'], list(user_data[1]) + [plex_api_token])
 				for user_id, user_token in zip(*complete_user_data):
@@ -1186,6 +1894,15 @@ def plex_exporter_importer(
 			elif type == 'import':
 				response = method(type='playlist', data={}, watched_map=watched_map, timestamp_map=timestamp_map, media_lib_id=0, **args)
 
+		if type == 'export' and workers > 1:
+			#export multiple media items at the same time; this thread stays the only one writing to the database
+			media_pool = _export_pool(workers, writer, run)
+		elif type == 'import' and workers > 1:
+			#import multiple media items at the same time; this thread stays the only one writing to the plex database
+			media_pool = _import_pool(workers, writer, run, database_file, exit_args.get('plex_db'))
+		if type == 'import' and 'watched_status' in process:
+			watched_queue = _watched_queue(ssn, workers, media_pool.executor if media_pool != None else None)
+
 		for lib in sections:
 			if not (lib['type'] in media_types and (all == True \
 			or (library_name != None and lib['title'] == library_name) \
@@ -1199,13 +1916,24 @@ def plex_exporter_importer(
 			print(lib['title'])
 			if type in ('import','reset'):
 				args['media_lib_id'] = lib['key']
+			elif archive_folder != None:
+				writer.shard = lib['key']
 			lib_output = ssn.get(f'{base_url}/library/sections/{lib["key"]}/all', params={'includeGuids': '1'})
 			if lib_output.status_code != 200: continue
 			lib_output = lib_output.json()['MediaContainer'].get('Metadata',[])
 
-			if lib['type'] in ('movie','show') and type == 'export' and 'watched_status' in process:
-				#create watched map for every user to reduce requests
-				for user_token in user_data[1]:
+			if 'chapter_thumbnail' in process and type in ('export','import'):
+				if movie_name == None and series_name == None:
+					#the whole library is processed so get the hashes of it at once
+					hash_map.load_library(lib['key'])
+				else:
+					#only the hashes of the targeted media are looked up
+					hash_map.clear()
+
+			if lib['type'] in ('movie','show') and type in ('export','import') and 'watched_status' in process:
+				#create watched map for every user to reduce requests (and to skip media that already has the watched status when importing)
+				watched_map.clear()
+				for user_token in user_data[1] + ((plex_api_token,) if type == 'import' else ()):
 					user_lib_output = ssn.get(f'{base_url}/library/sections/{lib["key"]}/all', params={'X-Plex-Token': user_token, 'type': media_types[lib['type']][3]})
 					if user_lib_output.status_code != 200: continue
 					user_lib_output = user_lib_output.json()['MediaContainer'].get('Metadata', [])
@@ -1215,18 +1943,28 @@ def plex_exporter_importer(
 				#create timestamp map
 				lib_types = media_types[lib['type']][4]
 				for lib_type in lib_types:
-					cursor.execute(f"SELECT rating_key, updated_at FROM {lib_type};")
+					writer.execute(f"SELECT rating_key, updated_at FROM {lib_type};")
 					timestamp_map[lib_type] = dict(cursor.fetchall())
 
+			if type == 'export' and incremental == True:
+				#get the children of all shows/artists at once instead of per show/artist
+				if lib['type'] == 'show':
+					season_listing = _section_children(ssn, lib['key'], 3, 'parentRatingKey')
+					episode_listing = _section_children(ssn, lib['key'], 4, 'grandparentRatingKey')
+				elif lib['type'] == 'artist':
+					album_listing = _section_children(ssn, lib['key'], 9, 'parentRatingKey')
+					track_listing = _section_children(ssn, lib['key'], 10, 'grandparentRatingKey')
+
 			if lib['type'] == 'movie':
+				if 'movie' in prefetch_types:
+					_prefetch_metadata(ssn, [m for m in lib_output if movie_name in (None, m['title'])], timestamp_map, done_media)
 				for movie in lib_output:
 					if movie_name != None and movie['title'] != movie_name:
 						continue
 
 					if verbose == True: print(f'	{movie["title"]}')
-					response = method(type='movie', data=movie, watched_map=watched_map, timestamp_map=timestamp_map, **args)
+					response = process_media('movie', movie)
 					if isinstance(response, str): return response
-					else: result_json.append(movie['ratingKey'])
 
 					if movie_name != None:
 						break
@@ -1241,22 +1979,28 @@ def plex_exporter_importer(
 
 					if verbose == True: print(f'	{show["title"]}')
 					#process show
-					show_info = ssn.get(f'{base_url}/library/metadata/{show["ratingKey"]}', params={'includePreferences': '1','includeGuids': '1'}).json()['MediaContainer']['Metadata'][0]
-					response = method(type='show', data=show_info, watched_map=watched_map, timestamp_map=timestamp_map, **args)
+					if ('show', show['ratingKey']) in done_media \
+					or (type == 'export' and incremental == True and timestamp_map['show'].get(show['ratingKey']) == show.get('updatedAt',0)):
+						#show is already done or hasn't changed since the last export so it's going to be skipped anyway
+						show_info = show
+					else:
+						show_info = ssn.get(f'{base_url}/library/metadata/{show["ratingKey"]}', params={'includePreferences': '1','includeGuids': '1'}).json()['MediaContainer']['Metadata'][0]
+					response = process_media('show', show_info)
 					if isinstance(response, str): return response
-					else: result_json.append(show['ratingKey'])
 
 					#process seasons
-					season_info = ssn.get(f'{base_url}{show["key"]}', params={'includeGuids': '1'})
-					if season_info.status_code != 200: continue
-					season_info = season_info.json()['MediaContainer']['Metadata']
+					if type == 'export' and incremental == True:
+						season_info = season_listing.get(show['ratingKey'], [])
+					else:
+						season_info = ssn.get(f'{base_url}{show["key"]}', params={'includeGuids': '1'})
+						if season_info.status_code != 200: continue
+						season_info = season_info.json()['MediaContainer']['Metadata']
 					for season in season_info:
 						if season_number != None and season['index'] != season_number:
 							continue
 
-						response = method(type='season', data=season, watched_map=watched_map, timestamp_map=timestamp_map, **args)
+						response = process_media('season', season)
 						if isinstance(response, str): return response
-						else: result_json.append(season['ratingKey'])
 
 						if season_number != None:
 							break
@@ -1265,7 +2009,12 @@ def plex_exporter_importer(
 							return 'Season not found'
 
 					#process episodes
-					episode_info = ssn.get(f'{base_url}/library/metadata/{show["ratingKey"]}/allLeaves', params={'includeGuids': '1'}).json()['MediaContainer']['Metadata']
+					if type == 'export' and incremental == True:
+						episode_info = episode_listing.get(show['ratingKey'], [])
+					else:
+						episode_info = ssn.get(f'{base_url}/library/metadata/{show["ratingKey"]}/allLeaves', params={'includeGuids': '1'}).json()['MediaContainer']['Metadata']
+					if 'episode' in prefetch_types:
+						_prefetch_metadata(ssn, [e for e in episode_info if season_number in (None, e['parentIndex']) and episode_number in (None, e['index'])], timestamp_map, done_media)
 					for episode in episode_info:
 						if season_number != None and episode['parentIndex'] != season_number:
 							continue
@@ -1273,9 +2022,8 @@ def plex_exporter_importer(
 							continue
 
 						if verbose == True: print(f'		S{episode["parentIndex"]}E{episode["index"]} - {episode["title"]}')
-						response = method(type='episode', data=episode, watched_map=watched_map, timestamp_map=timestamp_map, **args)
+						response = process_media('episode', episode)
 						if isinstance(response, str): return response
-						else: result_json.append(episode['ratingKey'])
 
 						if episode_number != None:
 							break
@@ -1296,22 +2044,30 @@ def plex_exporter_importer(
 
 					if verbose == True: print(f'	{artist["title"]}')
 					#process artist
-					artist_info = ssn.get(f'{base_url}/library/metadata/{artist["ratingKey"]}', params={'includeGuids': '1','includePreferences': '1'}).json()['MediaContainer']['Metadata'][0]
-					response = method(type='artist', data=artist_info, watched_map=watched_map, timestamp_map=timestamp_map, **args)
+					if ('artist', artist['ratingKey']) in done_media \
+					or (type == 'export' and incremental == True and timestamp_map['artist'].get(artist['ratingKey']) == artist.get('updatedAt',0)):
+						#artist is already done or hasn't changed since the last export so it's going to be skipped anyway
+						artist_info = artist
+					else:
+						artist_info = ssn.get(f'{base_url}/library/metadata/{artist["ratingKey"]}', params={'includeGuids': '1','includePreferences': '1'}).json()['MediaContainer']['Metadata'][0]
+					response = process_media('artist', artist_info)
 					if isinstance(response, str): return response
-					else: result_json.append(artist['ratingKey'])
 
 					#process albums
-					album_info = ssn.get(f'{base_url}{artist["key"]}', params={'includeGuids': '1'})
-					if album_info.status_code != 200: continue
-					album_info = album_info.json()['MediaContainer'].get('Metadata',[])
+					if type == 'export' and incremental == True:
+						album_info = album_listing.get(artist['ratingKey'], [])
+					else:
+						album_info = ssn.get(f'{base_url}{artist["key"]}', params={'includeGuids': '1'})
+						if album_info.status_code != 200: continue
+						album_info = album_info.json()['MediaContainer'].get('Metadata',[])
+					if 'album' in prefetch_types:
+						_prefetch_metadata(ssn, [a for a in album_info if album_name in (None, a['title'])], timestamp_map, done_media)
 					for album in album_info:
 						if album_name != None and album['title'] != album_name:
 							continue
 
-						response = method(type='album', data=album, watched_map=watched_map, timestamp_map=timestamp_map, **args)
+						response = process_media('album', album)
 						if isinstance(response, str): return response
-						else: result_json.append(album['ratingKey'])
 
 						if album_name != None:
 							break
@@ -1320,7 +2076,12 @@ def plex_exporter_importer(
 							return 'Album not found'
 
 					#process tracks
-					track_info = ssn.get(f'{base_url}/library/metadata/{artist["ratingKey"]}/allLeaves', params={'includeGuids': '1'}).json()['MediaContainer'].get('Metadata',[])
+					if type == 'export' and incremental == True:
+						track_info = track_listing.get(artist['ratingKey'], [])
+					else:
+						track_info = ssn.get(f'{base_url}/library/metadata/{artist["ratingKey"]}/allLeaves', params={'includeGuids': '1'}).json()['MediaContainer'].get('Metadata',[])
+					if 'track' in prefetch_types:
+						_prefetch_metadata(ssn, [t for t in track_info if album_name in (None, t['parentTitle']) and track_name in (None, t['title'])], timestamp_map, done_media)
 					for track in track_info:
 						if album_name != None and track['parentTitle'] != album_name:
 							continue
@@ -1328,9 +2089,8 @@ def plex_exporter_importer(
 							continue
 
 						if verbose == True: print(f'		D{track["parentIndex"]}T{track["index"]} - {track["title"]}')
-						response = method(type='track', data=track, watched_map=watched_map, timestamp_map=timestamp_map, **args)
+						response = process_media('track', track)
 						if isinstance(response, str): return response
-						else: result_json.append(track['ratingKey'])
 
 						if track_name != None:
 							break
@@ -1347,26 +2107,74 @@ def plex_exporter_importer(
 			else:
 				print('	Library not supported')
 
+			if media_pool != None:
+				#the watched map is rebuilt for the next library so finish this one first
+				response = media_pool.flush()
+				if isinstance(response, str): return response
+			if watched_queue != None:
+				watched_queue.send()
+			#drop metadata of media that ended up not being exported
+			metadata_map.clear()
+
 			if library_name != None:
 				break
 		else:
 			if library_name != None:
 				return 'Library not found'
+
+		if media_pool != None:
+			response = media_pool.flush()
+			if isinstance(response, str): return response
+		#the watched queue sends using the workers of the pool so close it before the pool
+		if watched_queue != None:
+			watched_queue.close()
+			watched_queue = None
+		if media_pool != None:
+			media_pool.close()
+		run_finished = True
+	except KeyboardInterrupt:
+		_leave(**exit_args)
 	except Exception as e:
 		if 'has no column named' in str(e):
 			_leave(**exit_args, e='Database file is too old, please delete the file and export to a new one')
 		else:
 			_leave(**exit_args, e=e)
+	finally:
+		if archive_folder != None and not run_finished:
+			#the run stopped early (e.g. media not found) so don't leave the files of earlier libraries behind
+			writer.close(completed=False)
+
+	#run finished so it doesn't need to be resumed
+	writer.execute("DELETE FROM progress WHERE process = ?;", (run,))
+
+	if type == 'export':
+		#remove images that aren't used anymore
+		writer.execute(f"""
+			DELETE FROM image
+			WHERE hash NOT IN (
+				{" UNION ".join(f"SELECT poster FROM {t} WHERE poster IS NOT NULL UNION SELECT art FROM {t} WHERE art IS NOT NULL" for t in image_tables)}
+			);
+		""")
+		#remove chapter thumbnails of media that doesn't have them (anymore)
+		writer.execute("""
+			DELETE FROM chapter_thumbnail
+			WHERE rating_key NOT IN (
+				SELECT rating_key FROM movie WHERE hash IS NOT NULL
+				UNION SELECT rating_key FROM episode WHERE hash IS NOT NULL
+			);
+		""")
 
 	#save the database
-	db.commit()
 	if type == 'import' and ('intro_marker' in process or 'chapter_thumbnail' in process):
+		_import_intro_markers(plex_db.cursor())
 		plex_db.commit()
+	writer.commit()
+	if archive_folder != None:
+		writer.close()
 
 	return result_json
 
 if __name__ == '__main__':
-	from requests import Session
 	from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
 	#setup vars
@@ -1394,13 +2202,23 @@ EPILOG
 	When exporting and not giving this argument, the database file will be put in the same folder as the script.
 	When exporting and giving a path to a folder, the database file will be put in that folder.
 	When exporting and giving a path to a database file, that database file will be used to put the data in or will be updated if data is already in it (STRONGLY RECOMMENDED IF POSSIBLE)
+	When exporting and giving a path to a folder ending in ".archive", the data will be put in that folder as one json file per library and type, with the images and chapter thumbnails as separate files.
+		Libraries can be exported at the same time into the same archive (one run per library) and the files can be shipped as soon as the run of their library is done.
+		The files are only put in the archive once the run is done. -r/--Resume and -i/--Incremental are not supported when exporting to an archive,
+		and neither is targeting specific media inside a library (e.g. -m/--MovieName), as the files of a library are replaced as a whole.
 	When importing and giving a path to a database file, that database file will be read and used as the source of the data that will be applied
+	When importing and giving a path to an archive folder, the archive will be read and used as the source of the data that will be applied
 """.format(p="\n".join(map(lambda k: f'	{k[0]}: {k[1]}', process_summary.items())))
 	parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter, description='Export plex metadata to a database file that can then be read from to import the data back (on a different plex instance)', epilog=epilog)
 	parser.add_argument('-t','--Type', choices=process_types, required=True, type=str, help='Either export/import plex metadata or reset import (unlock all fields)')
 	parser.add_argument('-p','--Process', choices=process_summary.keys(), help='EXPORT/IMPORT ONLY: Select what to export/import; this argument can be given multiple times to select multiple things', action='append', required=True)
 	parser.add_argument('-L','--Location', type=str, help='SEE EPILOG', default=path.dirname(path.abspath(__file__)))
 	parser.add_argument('-v','--Verbose', help='Make script more verbose', action='store_true')
+	parser.add_argument('-i','--Incremental', help='EXPORT ONLY: Only request the metadata and images of media that changed since the last export to the database file, and get the seasons/episodes/albums/tracks per library instead of per show/artist', action='store_true')
+	parser.add_argument('-g','--PersistGuidIndex', help='IMPORT ONLY: Store the guid index of the server (used for collections and playlists) in the database file, so that following imports only rebuild it for libraries that changed', action='store_true')
+	parser.add_argument('-r','--Resume', help='Continue a run with the same type and process(es) that was interrupted, skipping the media that it already did', action='store_true')
+	parser.add_argument('-D','--Diff', choices=('report','apply'), help='IMPORT ONLY: Compare the database file with the server first; "report" shows what would change without changing anything, "apply" only sends what is different')
+	parser.add_argument('-w','--Workers', type=int, help='EXPORT/IMPORT ONLY: The amount of media items to export/import at the same time (also the max amount of connections to the server)', default=1)
 
 	#args regarding target selection
 	#general selectors
@@ -1421,6 +2239,9 @@ EPILOG
 	parser.add_argument('-T','--TrackName', type=str, help='Target a specific track inside the targeted album based on it\'s name (only accepted when -d is given)')
 
 	args = parser.parse_args()
+	if args.Workers > 1:
+		#allow every worker to keep it's own connection to the server open, but never open more than that
+		ssn.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=args.Workers, pool_block=True))
 
 	start_time = perf_counter()
 	response = plex_exporter_importer(
@@ -1429,7 +2250,9 @@ EPILOG
 		library_name=args.LibraryName,
 		movie_name=args.MovieName,
 		series_name=args.SeriesName, season_number=args.SeasonNumber, episode_number=args.EpisodeNumber,
-		artist_name=args.ArtistName, album_name=args.AlbumName, track_name=args.TrackName
+		artist_name=args.ArtistName, album_name=args.AlbumName, track_name=args.TrackName,
+		workers=args.Workers, incremental=args.Incremental, persist_guid_index=args.PersistGuidIndex, resume=args.Resume,
+		diff=args.Diff
 	)
 	print(f'Time: {round(perf_counter() - start_time, 3)}s')
 	if not isinstance(response, list):
@@ -1445,5 +2268,11 @@ EPILOG
 			parser.error('-d/--AlbumName is set but not -A/--ArtistName')
 		elif response == '"track_name" is set but not "album_name" or "artist_name"':
 			parser.error('-T/--TrackName is set but not -d/--AlbumName or -A/--ArtistName')
+		elif response == 'Invalid value for "workers"':
+			parser.error('-w/--Workers has to be 1 or higher')
+		elif response == 'Resuming and incremental exports are not supported with an archive':
+			parser.error('-r/--Resume and -i/--Incremental can not be used when exporting to an archive')
+		elif response == 'Targeting specific media is not supported with an archive':
+			parser.error('Only -a/--All, --AllMovie, --AllShow, --AllMusic and -l/--LibraryName can be used when exporting to an archive')
 		else:
 			parser.error(response)
@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+#-*- coding: utf-8 -*-
+
+"""
+The use case of this script is the following:
+	Measure how fast plex_exporter_importer.py writes media to the database file when exporting,
+	by replaying a recorded library listing through the old (one statement per row) and the current (batched) write path
+Requirements (python3 -m pip install [requirement]):
+	requests
+Setup:
+	Put this script in the same folder as plex_exporter_importer.py and fill the variables of that script (only needed for -R/--Record).
+	Record the listing of a library once, then replay it as often as needed (the server isn't used when replaying):
+		python3 plex_exporter_importer_benchmark.py -f movies.json -R Movies
+		python3 plex_exporter_importer_benchmark.py -f movies.json -c 100000
+Notes:
+	1. The database files are made in the -L/--Location folder and are removed afterwards;
+		use the folder that the database file is in when exporting (e.g. to measure a network share).
+	2. The advanced settings of plex_exporter_importer.py (e.g. database_journal_mode) are used for the batched write path.
+"""
+
+from sys import platform
+from os import close, path, remove
+from sqlite3 import connect
+from time import perf_counter
+from json import dump, load
+from tempfile import mkstemp
+from requests import Session
+if platform == 'linux':
+	#nothing is written to the folders of plex, so the plex user and group aren't needed
+	from os import environ, getgid
+	from getpass import getuser
+	from grp import getgrgid
+	environ.setdefault('plex_linux_user', getuser())
+	environ.setdefault('plex_linux_group', getgrgid(getgid()).gr_name)
+import plex_exporter_importer as pei
+
+def _record(ssn, file: str, library_name: str):
+	#save the listing of the library like the exporter requests it
+	sections = ssn.get(f'{pei.base_url}/library/sections').json()['MediaContainer'].get('Directory', [])
+	for lib in sections:
+		if lib['title'] == library_name: break
+	else:
+		return 'Library not found'
+	lib_types = pei.media_types[lib['type']][4] if lib['type'] in pei.media_types else ()
+	listing = []
+	for lib_type in lib_types:
+		listing += ssn.get(f'{pei.base_url}/library/sections/{lib["key"]}/all', params={'type': pei.media_types[lib_type][1], 'includeGuids': '1'}).json()['MediaContainer'].get('Metadata', [])
+	with open(file, 'w') as f:
+		dump(listing, f)
+	return len(listing)
+
+def _rows(listing: list, count: int):
+	#build the rows like _export does (metadata from the listing), repeating the listing until there are {count} rows
+	rows = []
+	while len(rows) < count:
+		for media in listing:
+			if len(rows) == count: break
+			db_keys = ['rating_key','guid','updated_at']
+			db_values = [str(len(rows)), str(media.get('Guid', [])), media.get('updatedAt', 0)]
+			for key in pei.media_types[media['type']][0]:
+				if key[0].isupper():
+					value = ",".join([x['tag'] for x in media.get(key, [])]) or None
+				elif key == '[index]':
+					value = media.get('index')
+				elif key == 'titleSort' and media['type'] != 'track':
+					value = media.get('titleSort', media.get('title', ''))
+				else:
+					value = media.get(key)
+
+				if value != None:
+					db_keys.append(key)
+					db_values.append(value)
+			rows.append((media['type'], db_keys, db_values))
+	return rows
+
+def _write_per_row(cursor, rows: list):
+	#the write path from before batching: a delete and an insert with a freshly formatted statement per row, committed at the end
+	for type, db_keys, db_values in rows:
+		cursor.execute(f"DELETE FROM {type} WHERE rating_key = '{db_values[0]}'")
+		cursor.execute(f"""
+		INSERT INTO {type} ({",".join(db_keys)})
+		VALUES ({",".join(['?'] * len(db_keys))})
+		""", db_values)
+	cursor.connection.commit()
+	return
+
+def _write_batched(cursor, rows: list):
+	#the write path of the exporter: rows are queued and written with executemany, committed at every checkpoint
+	cursor.execute(f'PRAGMA journal_mode = {pei.database_journal_mode};')
+	cursor.execute(f'PRAGMA synchronous = {pei.database_synchronous};')
+	writer = pei._database_writer(cursor)
+	for count, (type, db_keys, db_values) in enumerate(rows, 1):
+		writer.insert(type, db_keys, db_values)
+		if count % pei.checkpoint_interval == 0:
+			writer.commit()
+	writer.commit()
+	return
+
+def plex_exporter_importer_benchmark(ssn, file: str, count: int=None, location: str=path.dirname(path.abspath(__file__)), record: str=None):
+	result_json = []
+
+	if record != None:
+		response = _record(ssn, file, record)
+		if isinstance(response, str): return response
+		print(f'Recorded {response} media items to {file}')
+		return result_json
+
+	if not path.isfile(file):
+		return 'Listing file not found'
+	if not path.isdir(location):
+		return 'Location not found'
+	with open(file, 'r') as f:
+		listing = [m for m in load(f) if m.get('type') in pei.media_types and 'Guid' in m]
+	if not listing:
+		return 'No media found in listing'
+	rows = _rows(listing, count or len(listing))
+
+	for name, method in (('per row', _write_per_row), ('batched', _write_batched)):
+		fd, database_file = mkstemp(dir=location, suffix='.db')
+		close(fd)
+		db = connect(database_file)
+		db.executescript(''.join(media_type[2] for media_type in pei.media_types.values()))
+		start_time = perf_counter()
+		method(db.cursor(), rows)
+		duration = perf_counter() - start_time
+		db.close()
+		for f in (database_file, f'{database_file}-wal', f'{database_file}-shm'):
+			if path.isfile(f): remove(f)
+		print(f'{name}: {len(rows)} rows in {round(duration, 3)}s ({round(len(rows) / duration)} rows/s)')
+		result_json.append({'method': name, 'rows': len(rows), 'seconds': duration})
+
+	return result_json
+
+if __name__ == '__main__':
+	from argparse import ArgumentParser
+
+	#setup vars
+	ssn = Session()
+	ssn.headers.update({'Accept':'application/json'})
+	ssn.params.update({'X-Plex-Token': pei.plex_api_token})
+
+	#setup arg parsing
+	parser = ArgumentParser(description='Measure how fast plex_exporter_importer.py writes media to the database file by replaying a recorded library listing')
+	parser.add_argument('-f','--File', type=str, help='The file with the recorded library listing', required=True)
+	parser.add_argument('-R','--Record', type=str, help='Record the listing of the library with this name to -f/--File instead of replaying it', default=None)
+	parser.add_argument('-c','--Count', type=int, help='The amount of rows to write; the listing is repeated to get to this amount (default is the size of the listing)', default=None)
+	parser.add_argument('-L','--Location', type=str, help='The folder to make the database files in', default=path.dirname(path.abspath(__file__)))
+
+	args = parser.parse_args()
+	#call function and process result
+	response = plex_exporter_importer_benchmark(ssn=ssn, file=args.File, count=args.Count, location=args.Location, record=args.Record)
+	if not isinstance(response, list):
+		if response == 'Listing file not found':
+			parser.error('-f/--File not found; record a listing first using -R/--Record')
+		elif response == 'Location not found':
+			parser.error('-L/--Location is not a folder')
+		else:
+			parser.error(response)
@@ -24,6 +24,10 @@ Example:
 		Taking 'Batman server' as the source and 'Robin server' as the sync target
 		Sync the collections, playlists and watch history
 		Apply the user specific sync actions (in this case playlists and watch history) to yourself and 'user2'
+	python3 plex_sync.py -s 'Batman server' --Sync watch_history --User @all --Incremental
+		Sync only the watch history of every user that changed since the last run (meant to be run at a short interval)
+	python3 plex_sync.py -s 'Batman server' --Sync posters --Sync watch_history --User @all --Daemon
+		Keep running and sync posters and watch history to 'Robin server' as soon as they change on 'Batman server'
 """
 
 main_plex_name = 'Main'
@@ -40,12 +44,35 @@ backup_plex_api_token = ''
 #Hardcode the folder where the plex database is in
 #Leave empty unless really needed
 database_folder = ''
+#The max amount of upload requests (e.g. posters) that are made to the target server at the same time
+max_concurrent_requests = 10
+#The amount of times a request is tried again when the server returns an error (5xx) or can't be reached
+max_retries = 3
+#The max amount of users that are synced at the same time (for user-specific sync actions like watch history and playlists)
+max_concurrent_users = 5
+#The max amount of requests per second to the servers (both servers together); 0 for no limit
+max_requests_per_second = 0
+#The file in which the state of the sync is stored between runs (e.g. up to when the watch history is synced)
+#Leave empty to store it next to the script
+sync_database_file = ''
+#Incremental watch history: the seconds between full syncs of the watch history of a user
+#Marking media as unwatched or partially watched isn't in the watch history of the server, so it's only synced with a full sync
+incremental_full_sync_interval = 86400
+#Daemon mode: the seconds to wait after a change on the source server before syncing it, so that a burst of changes is synced at once
+daemon_debounce = 10
+#Daemon mode: the seconds between full syncs, as a safety net for changes that were missed
+daemon_full_sync_interval = 86400
 
 from os import getenv, geteuid
-from os.path import join, isfile
-from aiohttp import ClientSession
-from asyncio import gather, run
-from time import perf_counter
+from os.path import join, isfile, dirname, abspath
+from aiohttp import ClientSession, ClientError, TCPConnector, WSMsgType
+from asyncio import gather, new_event_loop, run, sleep, Semaphore, TimeoutError as AsyncTimeoutError
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from threading import Lock, RLock, Thread
+from time import time, perf_counter, monotonic, sleep as blocking_sleep
+from requests.adapters import HTTPAdapter
 
 # Environmental Variables
 main_plex_ip = getenv('main_plex_ip', main_plex_ip)
@@ -59,9 +86,77 @@ backup_plex_api_token = getenv('backup_plex_api_token', backup_plex_api_token)
 backup_base_url = f"http://{backup_plex_ip}:{backup_plex_port}"
 backup_plex_name = getenv('backup_plex_name', backup_plex_name)
 database_folder = getenv('database_folder', database_folder)
+max_concurrent_requests = int(getenv('max_concurrent_requests', max_concurrent_requests))
+max_retries = int(getenv('max_retries', max_retries))
+max_concurrent_users = int(getenv('max_concurrent_users', max_concurrent_users))
+max_requests_per_second = float(getenv('max_requests_per_second', max_requests_per_second))
+sync_database_file = getenv('sync_database_file', sync_database_file) or join(dirname(abspath(__file__)), 'plex_sync.db')
+daemon_debounce = float(getenv('daemon_debounce', daemon_debounce))
+daemon_full_sync_interval = float(getenv('daemon_full_sync_interval', daemon_full_sync_interval))
+incremental_full_sync_interval = float(getenv('incremental_full_sync_interval', incremental_full_sync_interval))
+
+#media type -> (library type, plex type number)
+content_types = {
+	'movie': ('movie', '1'),
+	'show': ('show', '2'),
+	'season': ('show', '3'),
+	'episode': ('show', '4'),
+	'artist': ('artist', '8'),
+	'album': ('artist', '9'),
+	'track': ('artist', '10')
+}
+
+#tables in the sync database
+sync_database_tables = """
+CREATE TABLE IF NOT EXISTS watch_history_watermarks(
+	user VARCHAR(255),
+	source VARCHAR(255),
+	viewed_at INTEGER,
+	full_synced_at INTEGER,
+	PRIMARY KEY (user, source)
+);
+CREATE TABLE IF NOT EXISTS media_map(
+	source VARCHAR(255),
+	target VARCHAR(255),
+	source_key VARCHAR(255),
+	source_updated_at INTEGER,
+	target_key VARCHAR(255),
+	target_updated_at INTEGER,
+	PRIMARY KEY (source, target, source_key)
+);
+"""
+
+class _rate_limiter:
+	#spaces out requests (from any thread) so that at most max_requests_per_second are made
+	def __init__(self, requests_per_second: float):
+		self.interval = 1 / requests_per_second if requests_per_second > 0 else 0
+		self.next_time = 0.0
+		self.lock = Lock()
+
+	def reserve(self):
+		#claim the next free moment to make a request at and return how many seconds that is from now
+		if self.interval == 0: return 0
+		with self.lock:
+			now = monotonic()
+			request_time = max(self.next_time, now)
+			self.next_time = request_time + self.interval
+		return request_time - now
+
+class _rate_limited_adapter(HTTPAdapter):
+	def __init__(self, limiter: _rate_limiter, **kwargs):
+		self.limiter = limiter
+		super().__init__(**kwargs)
+
+	def send(self, *args, **kwargs):
+		blocking_sleep(self.limiter.reserve())
+		return super().send(*args, **kwargs)
+
+def _title_key(title: str, year: int=None):
+	#normalized title and year, so that small differences in writing don't matter
+	return (''.join(c for c in title.lower() if c.isalnum()), year)
 
 class plex_sync:
-	def __init__(self, main_ssn, backup_ssn, source: str, sync: list, users: list=['@me'], sync_episode_posters: bool=True):
+	def __init__(self, main_ssn, backup_ssn, source: str, sync: list, users: list=['@me'], sync_episode_posters: bool=True, incremental_watch_history: bool=False):
 		#check for illegal argument parsing
 		if any(s not in ('collections','posters','watch_history','playlists','intro_markers') for s in sync):
 			return 'Invalid value in "sync" list'
@@ -71,7 +166,15 @@ class plex_sync:
 			return 'Script needs to be run as root when you want to sync intro_markers'
 
 		#setup vars
-		self.result_json, self.user_tokens, self.map = [], [], {}
+		self.result_json, self.user_tokens, self.map, self.index = [], [], {}, {}
+		#requests to the target server that are made asynchronously and the ones of them that failed
+		self.request_queue, self.failed_requests = [], Counter()
+		self.loop, self.session = new_event_loop(), None
+		#the map of media is source ratingkey -> target ratingkey; the stored map is the one of earlier runs
+		self.sync_db, self.stored_map = None, None
+		#users are synced at the same time so shared state is guarded
+		self.db_lock, self.index_lock, self.cache_locks = RLock(), Lock(), {}
+		self.limiter = _rate_limiter(max_requests_per_second)
 		self.cache = {
 			'source': {},
 			'target': {}
@@ -79,6 +182,7 @@ class plex_sync:
 		self.sync = sync
 		self.users = users
 		self.sync_episode_posters = sync_episode_posters
+		self.incremental_watch_history = incremental_watch_history
 		if source == main_plex_name:
 			self.source_ssn = main_ssn
 			self.target_ssn = backup_ssn
@@ -93,6 +197,10 @@ class plex_sync:
 			self.target_base_url = main_base_url
 			self.source_api_token = backup_plex_api_token
 			self.target_api_token = main_plex_api_token
+		for ssn in (main_ssn, backup_ssn):
+			adapter = _rate_limited_adapter(self.limiter, pool_maxsize=max(10, max_concurrent_users))
+			ssn.mount('http://', adapter)
+			ssn.mount('https://', adapter)
 		self.source_machine_id = self.__get_data('source','/')['MediaContainer']['machineIdentifier']
 		self.target_machine_id = self.__get_data('target','/')['MediaContainer']['machineIdentifier']
 
@@ -100,9 +208,10 @@ class plex_sync:
 
 	#utility functions
 	def __get_data(self, source: str, link: str, params: dict={}, refresh: bool=False, json: bool=True):
-		if f'{link}{params}' in self.cache[source] and refresh == False:
-			return self.cache[source][f'{link}{params}']
-		else:
+		#one lock per request so that users that are synced at the same time share the response instead of both requesting it
+		with self.cache_locks.setdefault((source, f'{link}{params}'), Lock()):
+			if f'{link}{params}' in self.cache[source] and refresh == False:
+				return self.cache[source][f'{link}{params}']
 			if source == 'source':
 				result = self.source_ssn.get(f'{self.source_base_url}{link}', params=params)
 				if json == True:
@@ -114,42 +223,172 @@ class plex_sync:
 			self.cache[source][f'{link}{params}'] = result
 			return result
 
-	def __find_on_target(self, guid: list=[], title: str='', type: str=None):
-		sections = self.__get_data('target','/library/sections')['MediaContainer'].get('Directory', None)
-		if sections == None: return None
-
-		for lib in sections:
-			#skip invalid lib
-			if not lib['type'] in ('show','movie','artist'): continue
-			#skip libs that don't contain the media type
-			if type != None:
-				if lib['type'] == 'show' and not type in ('episode','season','show'): continue
-				if lib['type'] == 'artist' and not type in ('track','album','artist'): continue
-				if lib['type'] == 'movie' and type != 'movie': continue
+	def __target_index(self, type: str):
+		#index of the media of a type on the target server: individual guid (e.g. imdb://tt0111161) or normalized (title, year) -> media
+		#built once per type so that finding media doesn't require going through the libraries every time
+		if type in self.index: return self.index[type]
 
-			if lib['type'] == 'show':
-				if type == 'episode': content_type = '4'
-				elif type == 'season': content_type = '3'
-				else: content_type = ''
-			elif lib['type'] == 'artist':
-				if type == 'track': content_type = '10'
-				elif type == 'album': content_type = '9'
-				elif type == 'artist': content_type = '8'
-			elif lib['type'] == 'movie': content_type = '1'
-
-			if any((lib['type'] == 'show' and type == 'show', lib['type'] == 'movie' and type == 'movie')):
-				lib_output = self.__get_data('target',f'/library/sections/{lib["key"]}/all', params={'includeGuids': '1'})['MediaContainer'].get('Metadata', [])
-			else:
+		with self.index_lock:
+			if type in self.index: return self.index[type]
+			index = {}
+			lib_type, content_type = content_types[type]
+			sections = self.__get_data('target','/library/sections')['MediaContainer'].get('Directory', [])
+			for lib in sections:
+				if lib['type'] != lib_type: continue
 				lib_output = self.__get_data('target',f'/library/sections/{lib["key"]}/all', params={'includeGuids': '1', 'type': content_type})['MediaContainer'].get('Metadata', [])
-			for entry in lib_output:
-				if (guid and 'Guid' in entry and entry['Guid'] == guid) or (title and 'title' in entry and entry['title'] == title):
+				for entry in lib_output:
+					for guid in entry.get('Guid', []):
+						index.setdefault(guid['id'], entry)
+					if 'title' in entry:
+						index.setdefault(_title_key(entry['title'], entry.get('year')), entry)
+			self.index[type] = index
+		return index
+
+	def __find_on_target(self, guid: list=[], title: str='', type: str=None, year: int=None):
+		types = (type,) if type in content_types else content_types.keys()
+
+		#match on any of the guids first
+		for t in types:
+			index = self.__target_index(t)
+			for g in guid:
+				if g['id'] in index:
+					#media found on target server
+					return index[g['id']]
+
+		#match on title (and year)
+		if title:
+			for t in types:
+				entry = self.__target_index(t).get(_title_key(title, year))
+				if entry != None:
 					#media found on target server
 					return entry
+
 		#media not found on target server
 		return None
 
-	#THE function to run
-	def start_sync(self):
+	def __get_stored_map(self):
+		#source ratingkey -> (source updatedAt, target ratingkey, target updatedAt) of the matches made in earlier runs
+		with self.db_lock:
+			if self.stored_map == None:
+				cursor = self.__sync_database().cursor()
+				cursor.execute("SELECT source_key, source_updated_at, target_key, target_updated_at FROM media_map WHERE source = ? AND target = ?;", (self.source_machine_id, self.target_machine_id))
+				self.stored_map = {r[0]: r[1:] for r in cursor}
+		return self.stored_map
+
+	def __store_map(self, entry: dict, target_entry: dict):
+		self.map[entry['ratingKey']] = target_entry['ratingKey']
+		stored_map = self.__get_stored_map()
+		match = (entry.get('updatedAt'), target_entry['ratingKey'], target_entry.get('updatedAt'))
+		if stored_map.get(entry['ratingKey']) != match:
+			stored_map[entry['ratingKey']] = match
+			with self.db_lock:
+				self.sync_db.execute("INSERT OR REPLACE INTO media_map(source, target, source_key, source_updated_at, target_key, target_updated_at) VALUES (?,?,?,?,?,?);", (self.source_machine_id, self.target_machine_id, entry['ratingKey'], *match))
+		return
+
+	def __load_map(self, entries: list):
+		#reuse the matches of earlier runs instead of searching the target server for the media again
+		stored_map = self.__get_stored_map()
+		candidates = {}
+		for entry in entries:
+			if entry['ratingKey'] in self.map or not entry['ratingKey'] in stored_map: continue
+			candidates.setdefault(stored_map[entry['ratingKey']][1], []).append(entry)
+
+		#check (100 at a time) that the media on the target server still exists and still matches
+		target_keys = list(candidates)
+		for i in range(0, len(target_keys), 100):
+			target_output = self.__get_data('target', f'/library/metadata/{",".join(target_keys[i:i+100])}', params={'includeGuids': '1'})['MediaContainer'].get('Metadata', [])
+			for target_entry in target_output:
+				for entry in candidates.get(target_entry['ratingKey'], []):
+					source_updated_at, target_key, target_updated_at = stored_map[entry['ratingKey']]
+					if (source_updated_at, target_updated_at) != (entry.get('updatedAt'), target_entry.get('updatedAt')):
+						#media changed on one of the servers since the match was made so check that the guids still match
+						if not {g['id'] for g in entry.get('Guid', [])} & {g['id'] for g in target_entry.get('Guid', [])}: continue
+					self.__store_map(entry, target_entry)
+		return
+
+	def __map_to_target(self, entry: dict, type: str=None):
+		#get the ratingkey of the media on the target server (None if it's not on the target server)
+		if entry['ratingKey'] in self.map:
+			return self.map[entry['ratingKey']]
+
+		target_entry = self.__find_on_target(guid=entry.get('Guid', []), title=entry.get('title', ''), type=type or entry.get('type'), year=entry.get('year'))
+		if target_entry == None:
+			self.map[entry['ratingKey']] = None
+			if self.__get_stored_map().pop(entry['ratingKey'], None) != None:
+				with self.db_lock:
+					self.sync_db.execute("DELETE FROM media_map WHERE source = ? AND target = ? AND source_key = ?;", (self.source_machine_id, self.target_machine_id, entry['ratingKey']))
+			return None
+		self.__store_map(entry, target_entry)
+		return target_entry['ratingKey']
+
+	def __sync_database(self):
+		#connection to the file that keeps the state of the sync between runs
+		with self.db_lock:
+			if self.sync_db == None:
+				from sqlite3 import connect
+				self.sync_db = connect(sync_database_file, check_same_thread=False)
+				self.sync_db.executescript(sync_database_tables)
+		return self.sync_db
+
+	def __get_source_media(self, rating_keys: list):
+		#get media from the source server by ratingkey, 100 at a time
+		result = []
+		for i in range(0, len(rating_keys), 100):
+			result += self.__get_data('source', f'/library/metadata/{",".join(rating_keys[i:i+100])}', params={'includeGuids': '1'}, refresh=True)['MediaContainer'].get('Metadata', [])
+		return result
+
+	def __queue_request(self, method: str, link: str, params: dict):
+		#add a request to the target server to the queue; it's made when the queue is sent
+		self.request_queue.append((method, f'{self.target_base_url}{link}', params))
+		return
+
+	async def __request(self, semaphore: Semaphore, method: str, url: str, params: dict):
+		for attempt in range(max_retries + 1):
+			try:
+				await sleep(self.limiter.reserve())
+				async with semaphore, self.session.request(method, url, params=params) as response:
+					if response.status < 500:
+						if response.status >= 400:
+							self.failed_requests[response.status] += 1
+						return
+					error = response.status
+			except (ClientError, AsyncTimeoutError) as e:
+				error = type(e).__name__
+			#wait longer with every try
+			if attempt < max_retries:
+				await sleep(0.5 * 2 ** attempt)
+		self.failed_requests[error] += 1
+		return
+
+	async def __send_requests(self, requests: list):
+		if self.session == None:
+			#one session for the whole sync so that connections are reused
+			self.session = ClientSession(connector=TCPConnector(limit=max_concurrent_requests))
+		semaphore = Semaphore(max_concurrent_requests)
+		await gather(*(self.__request(semaphore, *r) for r in requests))
+		return
+
+	def __send_queue(self):
+		#make all queued requests, at most max_concurrent_requests at the same time
+		requests, self.request_queue = self.request_queue, []
+		if requests:
+			self.loop.run_until_complete(self.__send_requests(requests))
+		return
+
+	def __close(self):
+		if self.session != None:
+			self.loop.run_until_complete(self.session.close())
+			self.session = None
+		self.loop.close()
+		if self.sync_db != None:
+			self.sync_db.commit()
+			self.sync_db.close()
+			self.sync_db = None
+		if self.failed_requests:
+			print(f'Failed requests: {", ".join(f"{count}x {error}" for error, count in self.failed_requests.items())}')
+		return
+
+	def __run_sync(self, full: bool=False):
 		#sync non-user-specific data
 		if 'collections' in self.sync:
 			start_time = perf_counter()
@@ -170,7 +409,7 @@ class plex_sync:
 		#sync user-specific data
 		if 'watch_history' in self.sync:
 			start_time = perf_counter()
-			self._watch_history()
+			self._watch_history(full=full)
 			print(f'Watch History time: {round(perf_counter() - start_time,3)}s')
 
 		if 'playlists' in self.sync:
@@ -180,26 +419,166 @@ class plex_sync:
 
 		return list(set(self.result_json))
 
+	#THE function to run
+	def start_sync(self):
+		response = self.__run_sync()
+		self.__close()
+		return response
+
+	def __save_state(self):
+		#write the matches of the media to the sync database, as the daemon never closes it
+		with self.db_lock:
+			if self.sync_db != None:
+				self.sync_db.commit()
+		return
+
+	def __reset_cache(self):
+		#forget the responses and matches of the previous sync so that changes on the servers are seen
+		self.cache = {
+			'source': {},
+			'target': {}
+		}
+		self.cache_locks, self.index, self.map = {}, {}, {}
+		return
+
+	async def __listen(self, events: Queue):
+		#put the notifications of the source server in the queue; reconnect when the connection is lost
+		url = f'{self.source_base_url.replace("http", "ws", 1)}/:/websockets/notifications'
+		attempt = 0
+		async with ClientSession() as session:
+			while True:
+				try:
+					async with session.ws_connect(url, params={'X-Plex-Token': self.source_api_token}, heartbeat=30) as ws:
+						if attempt > 0:
+							#notifications could've been missed while not connected
+							events.put({'type': 'reconnected'})
+						attempt = 0
+						async for message in ws:
+							if message.type == WSMsgType.TEXT:
+								events.put(message.json().get('NotificationContainer', {}))
+				except (ClientError, AsyncTimeoutError):
+					pass
+				#wait longer with every failed try
+				await sleep(min(0.5 * 2 ** attempt, 60))
+				attempt += 1
+
+	def __add_change(self, changes: dict, notification: dict):
+		#note what needs to be synced because of the notification; returns if the notification was relevant
+		relevant = False
+		if notification.get('type') == 'reconnected':
+			changes['full'] = relevant = True
+
+		elif notification.get('type') == 'playing' and 'watch_history' in self.sync:
+			#a stream stopped so the watch state of a user could've changed
+			if any(n.get('state') == 'stopped' for n in notification.get('PlaySessionStateNotification', [])):
+				changes['watch_history'] = relevant = True
+
+		elif notification.get('type') == 'timeline':
+			for entry in notification.get('TimelineEntry', []):
+				#state 5 = media is done being added/updated
+				if entry.get('state') != 5 or not 'itemID' in entry: continue
+				if entry.get('type') == 18 and 'collections' in self.sync:
+					changes['collections'] = relevant = True
+				elif entry.get('type') in (1,2,3,4,8,9,10) and 'posters' in self.sync:
+					changes['posters'].add(str(entry['itemID']))
+					relevant = True
+				if entry.get('type') == 4 and 'intro_markers' in self.sync:
+					changes['intro_markers'].add(str(entry['itemID']))
+					relevant = True
+
+		elif notification.get('type') == 'activity' and 'intro_markers' in self.sync:
+			#intro detection of a library finished
+			for a in notification.get('ActivityNotification', []):
+				if a.get('event') == 'ended' and a.get('Activity', {}).get('type') == 'media.generate.intros':
+					changes['all_intro_markers'] = relevant = True
+		return relevant
+
+	def __collect_changes(self, events: Queue, next_full_sync: float):
+		#wait for a relevant notification (or the next full sync), then keep collecting until no relevant one came in for daemon_debounce seconds
+		#irrelevant notifications (e.g. progress of streams) come in all the time so the waiting is based on fixed points in time
+		changes = {'full': False, 'collections': False, 'posters': set(), 'intro_markers': set(), 'all_intro_markers': False, 'watch_history': False}
+		quiet_at, deadline = None, None
+		while True:
+			wait = (next_full_sync if deadline == None else min(quiet_at, deadline)) - monotonic()
+			if wait <= 0:
+				return changes
+			try:
+				notification = events.get(timeout=wait)
+			except Empty:
+				return changes
+			if self.__add_change(changes, notification):
+				quiet_at = monotonic() + daemon_debounce
+				if deadline == None:
+					#don't wait forever when changes keep coming in
+					deadline = monotonic() + daemon_debounce * 6
+
+	def start_daemon(self):
+		#keep running and sync what changes on the source server, based on its notifications
+		#watch history is synced incrementally so that only the media of the stopped streams is synced
+		self.incremental_watch_history = True
+		events = Queue()
+		Thread(target=lambda: run(self.__listen(events)), daemon=True).start()
+
+		next_full_sync = monotonic()
+		while True:
+			if monotonic() >= next_full_sync:
+				print('Full sync')
+				self.__reset_cache()
+				try:
+					response = self.__run_sync(full=True)
+				except Exception as e:
+					#e.g. one of the servers is restarting; try again later instead of stopping the daemon
+					print(f'Full sync failed: {e!r}')
+					self.request_queue = []
+					next_full_sync = monotonic() + daemon_debounce * 6
+				else:
+					if isinstance(response, str): return response
+					self.__save_state()
+					next_full_sync = monotonic() + daemon_full_sync_interval
+
+			changes = self.__collect_changes(events, next_full_sync)
+			if changes['full']:
+				next_full_sync = monotonic()
+				continue
+
+			self.__reset_cache()
+			try:
+				if changes['collections']:
+					self._collections()
+				if changes['posters']:
+					self._posters(rating_keys=list(changes['posters']))
+				if changes['all_intro_markers']:
+					self._intro_markers()
+				elif changes['intro_markers']:
+					self._intro_markers(rating_keys=list(changes['intro_markers']))
+				if changes['watch_history']:
+					self._watch_history()
+			except Exception as e:
+				#the changes could've been (partly) missed, so catch up with a full sync soon
+				print(f'Sync failed: {e!r}')
+				self.request_queue = []
+				next_full_sync = min(next_full_sync, monotonic() + daemon_debounce * 6)
+			self.__save_state()
+
 	#non-user-specific actions
-	async def __process_collections(self, source_collection, target_lib, content_type):
-		session = ClientSession()
-		tasks = []
+	def __process_collections(self, source_collection, target_lib, content_type):
 		print(f'	{source_collection["title"]}')
 
 		#add collection on target server
 		source_collection_content = self.__get_data('source',f'/library/collections/{source_collection["ratingKey"]}/children', params={'includeGuids': '1'})['MediaContainer'].get('Metadata', [])
 		target_collection_content = []
+		self.__load_map(source_collection_content)
 		for entry in source_collection_content:
-			target_ratingkey = self.__find_on_target(guid=entry['Guid'] if 'Guid' in entry else [], title=entry['title'] if 'title' in entry else '')
+			target_ratingkey = self.__map_to_target(entry)
 			if target_ratingkey != None:
 				#media found on target server
-				target_collection_content.append(target_ratingkey['ratingKey'])
+				target_collection_content.append(target_ratingkey)
 		if not target_collection_content: return
 
 		new_ratingkey = self.target_ssn.post(f'{self.target_base_url}/library/collections', params={'title': source_collection['title'], 'smart': '0', 'sectionId': target_lib['key'], 'type': content_type, 'uri': f'server://{self.target_machine_id}/com.plexapp.plugins.library/library/metadata/{",".join(target_collection_content)}'}).json()['MediaContainer']['Metadata'][0]['ratingKey']
 		#sync poster
 		if 'thumb' in source_collection:
-			tasks.append(session.post(f'{self.target_base_url}/library/collections/{new_ratingkey}/posters', params={'url': f'{self.source_base_url}{source_collection["thumb"]}?X-Plex-Token={self.source_api_token}','X-Plex-Token': self.target_api_token}))
+			self.__queue_request('POST', f'/library/collections/{new_ratingkey}/posters', {'url': f'{self.source_base_url}{source_collection["thumb"]}?X-Plex-Token={self.source_api_token}','X-Plex-Token': self.target_api_token})
 		#sync settings
 		payload = {
 			'type': '18',
@@ -209,11 +588,8 @@ class plex_sync:
 			'summary.value': source_collection.get('summary',''),
 			'X-Plex-Token': self.target_api_token
 		}
-		tasks.append(session.put(f'{self.target_base_url}/library/sections/{target_lib["key"]}/all', params=payload))
+		self.__queue_request('PUT', f'/library/sections/{target_lib["key"]}/all', payload)
 		self.result_json += target_collection_content
-		#launch all the upload requests at the same time
-		await gather(*tasks)
-		await session.close()
 
 	def _collections(self):
 		print('Collections')
@@ -249,87 +625,110 @@ class plex_sync:
 
 			#sync each source collection with the target server
 			for source_collection in source_collections:
-				run(self.__process_collections(source_collection, target_lib, content_type))
+				self.__process_collections(source_collection, target_lib, content_type)
+			self.__send_queue()
 
 		return self.result_json
 
-	async def __process_posters(self, lib):
+	def __process_posters(self, lib):
 		if not lib['type'] in ('show','movie','artist'): return
 		if lib['type'] == 'show': content_type = '4'
 		elif lib['type'] == 'movie': content_type = '1'
 		elif lib['type'] == 'artist': content_type = '10'
 
-		session = ClientSession()
-		tasks = []
 		print(f'	{lib["title"]}')
 		#sync series/season posters
 		if lib['type'] == 'show':
-			lib_output = self.__get_data('source',f'/library/sections/{lib["key"]}/all', params={'includeGuids': '1'})['MediaContainer'].get('Metadata', [])
-			for show in lib_output:
-				if not 'thumb' in show: continue
-				key = show['Guid'] if 'Guid' in show else show['title']
-				if not str(key) in self.map:
-					target_ratingkey = self.__find_on_target(guid=show['Guid'] if 'Guid' in show else [], title=show['title'] if 'title' in show else '', type='show')
-					if target_ratingkey == None: continue
-					self.map[str(key)] = target_ratingkey['ratingKey']
-
-				tasks.append(session.post(f'{self.target_base_url}/library/metadata/{self.map[str(key)]}/posters', params={'url': f'{self.source_base_url}{show["thumb"]}?X-Plex-Token={self.source_api_token}','X-Plex-Token': self.target_api_token}))
-
-			lib_output = self.__get_data('source',f'/library/sections/{lib["key"]}/all', params={'includeGuids': '1', 'type': '3'})['MediaContainer'].get('Metadata', [])
-			for season in lib_output:
-				if not 'thumb' in season: continue
-				key = season['Guid'] if 'Guid' in season else season['title']
-				if not str(key) in self.map:
-					target_ratingkey = self.__find_on_target(guid=season['Guid'] if 'Guid' in season else [], title=season['title'] if 'title' in season else '', type='season')
-					if target_ratingkey == None: continue
-					self.map[str(key)] = target_ratingkey['ratingKey']
-
-				tasks.append(session.post(f'{self.target_base_url}/library/metadata/{self.map[str(key)]}/posters', params={'url': f'{self.source_base_url}{season["thumb"]}?X-Plex-Token={self.source_api_token}','X-Plex-Token': self.target_api_token}))
+			self.__queue_posters(self.__get_data('source',f'/library/sections/{lib["key"]}/all', params={'includeGuids': '1'})['MediaContainer'].get('Metadata', []), type='show')
+			self.__queue_posters(self.__get_data('source',f'/library/sections/{lib["key"]}/all', params={'includeGuids': '1', 'type': '3'})['MediaContainer'].get('Metadata', []), type='season')
 
 		#if said so, skip syncing episode posters
 		if lib['type'] != 'show' or (self.sync_episode_posters == True and lib['type'] == 'show'):
-			lib_output = self.__get_data('source',f'/library/sections/{lib["key"]}/all', params={'type': content_type, 'includeGuids': '1'})['MediaContainer'].get('Metadata', [])
-			#make map of media: guids or title -> target ratingkey
-			for entry in lib_output:
-				key = entry['Guid'] if 'Guid' in entry else entry['title']
-				if str(key) in self.map: continue
-
-				target_ratingkey = self.__find_on_target(guid=entry['Guid'] if 'Guid' in entry else [], title=entry['title'] if 'title' in entry else '', type=entry['type'])
-				if target_ratingkey == None: continue
-				self.map[str(key)] = target_ratingkey['ratingKey']
-
-			#go through every media item in the library
-			for entry in lib_output:
-				if not 'thumb' in entry: continue
-				key = entry['Guid'] if 'Guid' in entry else entry['title']
-				if not str(key) in self.map: continue
-				target_ratingkey = self.map[str(key)]
-
-				#add the request that will upload the poster to target media to a queue
-				tasks.append(session.post(f'{self.target_base_url}/library/metadata/{target_ratingkey}/posters', params={'url': f'{self.source_base_url}{entry["thumb"]}?X-Plex-Token={self.source_api_token}','X-Plex-Token': self.target_api_token}))
-				self.result_json.append(entry['ratingKey'])
-		#launch all the upload requests at the same time
-		await gather(*tasks)
-		await session.close()
+			self.__queue_posters(self.__get_data('source',f'/library/sections/{lib["key"]}/all', params={'type': content_type, 'includeGuids': '1'})['MediaContainer'].get('Metadata', []))
+		#upload the posters
+		self.__send_queue()
+
+	def __queue_posters(self, entries: list, type: str=None):
+		self.__load_map(entries)
+		#go through every media item
+		for entry in entries:
+			if not 'thumb' in entry: continue
+			target_ratingkey = self.__map_to_target(entry, type=type)
+			if target_ratingkey == None: continue
+
+			#add the request that will upload the poster to target media to the queue
+			self.__queue_request('POST', f'/library/metadata/{target_ratingkey}/posters', {'url': f'{self.source_base_url}{entry["thumb"]}?X-Plex-Token={self.source_api_token}','X-Plex-Token': self.target_api_token})
+			self.result_json.append(entry['ratingKey'])
+		return
 
-	def _posters(self):
+	def _posters(self, rating_keys: list=None):
 		print('Posters')
 
+		#only sync the posters of the given media
+		if rating_keys != None:
+			entries = [e for e in self.__get_source_media(rating_keys) if self.sync_episode_posters == True or e.get('type') != 'episode']
+			self.__queue_posters(entries)
+			self.__send_queue()
+			return self.result_json
+
 		#get sections on source server
 		sections = self.__get_data('source','/library/sections')['MediaContainer'].get('Directory', None)
 		if sections == None: return 'No libraries on the source server'
 
-		#process every library (at the same time) in __process_posters
+		#process every library in __process_posters
 		for lib in sections:
-			run(self.__process_posters(lib))
+			self.__process_posters(lib)
 		return self.result_json
 
-	def _intro_markers(self):
+	def __sync_intro_markers(self, db, episodes: list):
+		from datetime import datetime
+		cursor = db.cursor()
+		self.__load_map(episodes)
+		for episode in episodes:
+			#get markers of the episode on source
+			self.result_json.append(episode['ratingKey'])
+			episode_output = self.__get_data('source',f'/library/metadata/{episode["ratingKey"]}', params={'includeMarkers': '1'})['MediaContainer']['Metadata'][0].get('Marker',[])
+			for marker in episode_output:
+				if marker['type'] == 'intro':
+					#intro marker found
+					intro_start = marker['startTimeOffset']
+					intro_end = marker['endTimeOffset']
+					break
+			else:
+				#no intro marker found so skip episode
+				continue
+
+			#get ratingkey on target
+			target_ratingkey = self.__map_to_target(episode, type='episode')
+			if target_ratingkey == None: continue
+			#check if media already has intro marker
+			cursor.execute(f"SELECT * FROM taggings WHERE text = 'intro' AND metadata_item_id = '{target_ratingkey}';")
+			if cursor.fetchone() == None:
+				#no intro marker exists so create one
+				d = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+				cursor.execute("SELECT tag_id FROM taggings WHERE text = 'intro' LIMIT 1;")
+				i = cursor.fetchone()
+				if i == None:
+					#no id yet for intro's so make one that isn't taken yet
+					cursor.execute("SELECT tag_id FROM taggings ORDER BY tag_id DESC LIMIT 1;")
+					i = int(cursor.fetchone()[0]) + 1
+				else:
+					i = i[0]
+				cursor.execute(f"INSERT INTO taggings (metadata_item_id,tag_id,[index],text,time_offset,end_time_offset,thumb_url,created_at,extra_data) VALUES ({target_ratingkey},{i},0,'intro',{intro_start},{intro_end},'','{d}','pv%3Aversion=5');")
+			else:
+				#intro marker exists so update timestamps
+				cursor.execute(f"UPDATE taggings SET time_offset = '{intro_start}' WHERE text = 'intro' AND metadata_item_id = '{target_ratingkey}';")
+				cursor.execute(f"UPDATE taggings SET end_time_offset = '{intro_end}' WHERE text = 'intro' AND metadata_item_id = '{target_ratingkey}';")
+			#save changes
+			db.commit()
+		return
+
+	def _intro_markers(self, rating_keys: list=None):
 		print('Intro Markers')
 		from sqlite3 import connect
-		from datetime import datetime
 
 		#get location to database file
+		db_folder = database_folder
 		if database_folder == '':
 			db_folder = [s['value'] for s in self.__get_data('target','/:/prefs')['MediaContainer']['Setting'] if s['id'] == 'ButlerDatabaseBackupPath'][0]
 		db_file = join(db_folder, 'com.plexapp.plugins.library.db')
@@ -338,7 +737,12 @@ class plex_sync:
 
 		#setup db connection
 		db = connect(db_file)
-		cursor = db.cursor()
+
+		#only sync the markers of the given episodes
+		if rating_keys != None:
+			self.__sync_intro_markers(db, [e for e in self.__get_source_media(rating_keys) if e.get('type') == 'episode'])
+			db.close()
+			return self.result_json
 
 		#loop through episodes
 		sections = self.__get_data('source','/library/sections')['MediaContainer'].get('Directory',[])
@@ -346,51 +750,13 @@ class plex_sync:
 			if lib['type'] != 'show': continue
 			print(f'	{lib["title"]}')
 			lib_output = self.__get_data('source',f'/library/sections/{lib["key"]}/all', params={'type': '4', 'includeGuids': '1'})['MediaContainer'].get('Metadata',[])
-			for episode in lib_output:
-				#get markers of the episode on source
-				self.result_json.append(episode['ratingKey'])
-				episode_output = self.__get_data('source',f'/library/metadata/{episode["ratingKey"]}', params={'includeMarkers': '1'})['MediaContainer']['Metadata'][0].get('Marker',[])
-				for marker in episode_output:
-					if marker['type'] == 'intro':
-						#intro marker found
-						intro_start = marker['startTimeOffset']
-						intro_end = marker['endTimeOffset']
-						break
-				else:
-					#no intro marker found so skip episode
-					continue
-
-				#get ratingkey on target
-				target_ratingkey = self.__find_on_target(guid=episode.get('Guid',[]), title=episode.get('title',''), type='episode')
-				if target_ratingkey == None: continue
-				else: target_ratingkey = target_ratingkey.get('ratingKey','')
-				#check if media already has intro marker
-				cursor.execute(f"SELECT * FROM taggings WHERE text = 'intro' AND metadata_item_id = '{target_ratingkey}';")
-				if cursor.fetchone() == None:
-					#no intro marker exists so create one
-					d = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-					cursor.execute("SELECT tag_id FROM taggings WHERE text = 'intro' LIMIT 1;")
-					i = cursor.fetchone()
-					if i == None:
-						#no id yet for intro's so make one that isn't taken yet
-						cursor.execute("SELECT tag_id FROM taggings ORDER BY tag_id DESC LIMIT 1;")
-						i = int(cursor.fetchone()[0]) + 1
-					else:
-						i = i[0]
-					cursor.execute(f"INSERT INTO taggings (metadata_item_id,tag_id,[index],text,time_offset,end_time_offset,thumb_url,created_at,extra_data) VALUES ({target_ratingkey},{i},0,'intro',{intro_start},{intro_end},'','{d}','pv%3Aversion=5');")
-				else:
-					#intro marker exists so update timestamps
-					cursor.execute(f"UPDATE taggings SET time_offset = '{intro_start}' WHERE text = 'intro' AND metadata_item_id = '{target_ratingkey}';")
-					cursor.execute(f"UPDATE taggings SET end_time_offset = '{intro_end}' WHERE text = 'intro' AND metadata_item_id = '{target_ratingkey}';")
-				#save changes
-				db.commit()
+			self.__sync_intro_markers(db, lib_output)
+		db.close()
 		return self.result_json
 
 	#user-specific actions
-	def _watch_history(self):
-		print('Watch History')
-
-		#get list of tokens (users) to apply action to
+	def __get_user_tokens(self):
+		#get list of tokens (users) to apply action to: [username, source token, target token]
 		if not self.user_tokens:
 			from re import findall as re_findall
 
@@ -411,146 +777,171 @@ class plex_sync:
 				target_token = re_findall(rf'username="{username}.*?accessToken="\w+?(?=")', target_shared_users)
 				if target_token:
 					self.user_tokens.append([username, source_token, target_token[0].split('"')[-1]])
+		return self.user_tokens
 
-		for user_token in self.user_tokens:
-			print(f'	{user_token[0]}')
+	def __run_per_user(self, process):
+		#sync the users at the same time; the sync time is then that of the slowest user instead of the total
+		with ThreadPoolExecutor(max_workers=max_concurrent_users) as executor:
+			list(executor.map(process, self.__get_user_tokens()))
+		return
 
-			#get sections on source server
-			sections = self.__get_data('source', '/library/sections', params={'X-Plex-Token': user_token[1]})['MediaContainer'].get('Directory', [])
+	def __set_watch_state(self, entry: dict, target_ratingkey: str, target_token: str):
+		if 'viewOffset' in entry:
+			#set media to offset (partially watched; on deck)
+			self.target_ssn.get(f'{self.target_base_url}/:/progress', params={'identifier': 'com.plexapp.plugins.library', 'key': target_ratingkey, 'time': entry['viewOffset'], 'state': 'stopped', 'X-Plex-Token': target_token})
+		elif 'viewCount' in entry:
+			#mark media as watched
+			self.target_ssn.get(f'{self.target_base_url}/:/scrobble', params={'identifier': 'com.plexapp.plugins.library', 'key': target_ratingkey, 'X-Plex-Token': target_token})
+		elif not 'viewCount' in entry:
+			#mark media as not-watched
+			self.target_ssn.get(f'{self.target_base_url}/:/unscrobble', params={'identifier': 'com.plexapp.plugins.library', 'key': target_ratingkey, 'X-Plex-Token': target_token})
+		self.result_json.append(entry['ratingKey'])
+		return
 
-			#process every library (at the same time) in __process_watch_history
-			for lib in sections:
-				if not lib['type'] in ('show','movie','artist'): continue
-				if lib['type'] == 'show': content_type = '4'
-				elif lib['type'] == 'movie': content_type = '1'
-				elif lib['type'] == 'artist': content_type = '10'
-
-				handled_series = []
-				print(f'		{lib["title"]}')
-				#sync complete series to skip syncing every episode (reducing requests)
-				if lib['type'] == 'show':
-					lib_output = self.__get_data('source',f'/library/sections/{lib["key"]}/all', params={'includeGuids': '1'})['MediaContainer'].get('Metadata', [])
-					for show in lib_output:
-						if not (show['viewedLeafCount'] == 0 or show['viewedLeafCount'] == show['leafCount']): continue
-						key = show['Guid'] if 'Guid' in show else show['title']
-						if not str(key) in self.map:
-							target_ratingkey = self.__find_on_target(guid=show['Guid'] if 'Guid' in show else [], title=show['title'] if 'title' in show else '', type='show')
-							if target_ratingkey == None: continue
-							self.map[str(key)] = target_ratingkey['ratingKey']
-
-						if show['viewedLeafCount'] == 0:
-							#mark complete series as not-viewed
-							self.target_ssn.get(f'{self.target_base_url}/:/scrobble', params={'identifier': 'com.plexapp.plugins.library', 'key': self.map[str(key)], 'X-Plex-Token': user_token[2]})
-						else:
-							#mark complete series as viewed
-							self.target_ssn.get(f'{self.target_base_url}/:/unscrobble', params={'identifier': 'com.plexapp.plugins.library', 'key': self.map[str(key)], 'X-Plex-Token': user_token[2]})
-						handled_series.append(show['ratingKey'])
-
-				lib_output = self.__get_data('source',f'/library/sections/{lib["key"]}/all', params={'type': content_type, 'includeGuids': '1', 'X-Plex-Token': user_token[1]})['MediaContainer'].get('Metadata', [])
-				#make map of media: guids or title -> target ratingkey
-				for entry in lib_output:
-					if lib['type'] == 'show' and entry['grandparentRatingKey'] in handled_series: continue
-					key = entry['Guid'] if 'Guid' in entry else entry['title']
-					if str(key) in self.map: continue
+	def __process_watch_history_delta(self, user_token: list, history: list):
+		#only go through the media that is in the watch history since the last sync
+		rating_keys = list(dict.fromkeys(h['ratingKey'] for h in history if 'ratingKey' in h))
+		for i in range(0, len(rating_keys), 100):
+			#get the current state of the media for the user (it could've been unwatched again since)
+			lib_output = [e for e in self.__get_data('source', f'/library/metadata/{",".join(rating_keys[i:i+100])}', params={'includeGuids': '1', 'X-Plex-Token': user_token[1]}, refresh=True)['MediaContainer'].get('Metadata', []) if e.get('type') in ('movie','episode','track')]
+			self.__load_map(lib_output)
+			for entry in lib_output:
+				target_ratingkey = self.__map_to_target(entry)
+				if target_ratingkey == None: continue
+				self.__set_watch_state(entry, target_ratingkey, user_token[2])
+		return
+
+	def __process_watch_history(self, user_token: list, full: bool=False):
+		print(f'	{user_token[0]}')
+
+		if self.incremental_watch_history:
+			#account ids of the users on the source server to filter the watch history on
+			accounts = {a['name']: str(a['id']) for a in self.__get_data('source', '/accounts')['MediaContainer'].get('Account', [])}
+			account_id = '1' if user_token[0] == '@me' else accounts.get(user_token[0])
+			if account_id == None:
+				print(f'		Warning: {user_token[0]} is not found in the accounts of the source server so their watch history can\'t be synced incrementally; doing a full sync')
+				full = True
+			with self.db_lock:
+				watermark = self.__sync_database().execute("SELECT viewed_at, full_synced_at FROM watch_history_watermarks WHERE user = ? AND source = ?;", (user_token[0], self.source_machine_id)).fetchone()
+			if watermark != None and (watermark[1] or 0) + incremental_full_sync_interval <= time():
+				#unwatching and progress aren't in the watch history, so do a full sync every so often to pick them up
+				full = True
+			params = {'accountID': account_id, 'sort': 'viewedAt:desc'}
+			if watermark != None and not full:
+				#also get the entries of the second of the watermark again, as entries of that second could've been added after the last sync
+				#they're only synced once as the media is deduplicated
+				params['viewedAt>>'] = watermark[0] - 1
+			else:
+				#full sync (e.g. first run for the user) so only the newest entry is needed to set the watermark
+				params.update({'X-Plex-Container-Start': '0', 'X-Plex-Container-Size': '1'})
+			history = self.__get_data('source', '/status/sessions/history/all', params=params, refresh=True)['MediaContainer'].get('Metadata', []) if account_id != None else []
+			new_watermark = max([h.get('viewedAt', 0) for h in history] + [watermark[0] if watermark != None else 0])
+
+			if watermark != None and not full:
+				self.__process_watch_history_delta(user_token, history)
+				self.__store_watermark(user_token[0], new_watermark, watermark[1])
+				return
 
-					target_ratingkey = self.__find_on_target(guid=entry['Guid'] if 'Guid' in entry else [], title=entry['title'] if 'title' in entry else '', type=entry['type'])
+		#get sections on source server
+		sections = self.__get_data('source', '/library/sections', params={'X-Plex-Token': user_token[1]})['MediaContainer'].get('Directory', [])
+
+		#process every library
+		for lib in sections:
+			if not lib['type'] in ('show','movie','artist'): continue
+			if lib['type'] == 'show': content_type = '4'
+			elif lib['type'] == 'movie': content_type = '1'
+			elif lib['type'] == 'artist': content_type = '10'
+
+			handled_series = []
+			print(f'		{lib["title"]}')
+			#sync complete series to skip syncing every episode (reducing requests)
+			if lib['type'] == 'show':
+				lib_output = self.__get_data('source',f'/library/sections/{lib["key"]}/all', params={'includeGuids': '1', 'X-Plex-Token': user_token[1]})['MediaContainer'].get('Metadata', [])
+				self.__load_map(lib_output)
+				for show in lib_output:
+					if not (show['viewedLeafCount'] == 0 or show['viewedLeafCount'] == show['leafCount']): continue
+					target_ratingkey = self.__map_to_target(show, type='show')
 					if target_ratingkey == None: continue
-					self.map[str(key)] = target_ratingkey['ratingKey']
 
-				#go through every media item in the library
-				for entry in lib_output:
-					key = entry['Guid'] if 'Guid' in entry else entry['title']
-					if not str(key) in self.map: continue
-					target_ratingkey = self.map[str(key)]
-
-					#add the request that will set the watched status for the target media to a queue
-					if 'viewOffset' in entry:
-						#set media to offset (partially watched; on deck)
-						self.target_ssn.get(f'{self.target_base_url}/:/progress', params={'identifier': 'com.plexapp.plugins.library', 'key': target_ratingkey, 'time': entry['viewOffset'], 'state': 'stopped', 'X-Plex-Token': user_token[2]})
-					elif 'viewCount' in entry:
-						#mark media as watched
+					if show['viewedLeafCount'] == 0:
+						#mark complete series as not-viewed
 						self.target_ssn.get(f'{self.target_base_url}/:/scrobble', params={'identifier': 'com.plexapp.plugins.library', 'key': target_ratingkey, 'X-Plex-Token': user_token[2]})
-					elif not 'viewCount' in entry:
-						#mark media as not-watched
+					else:
+						#mark complete series as viewed
 						self.target_ssn.get(f'{self.target_base_url}/:/unscrobble', params={'identifier': 'com.plexapp.plugins.library', 'key': target_ratingkey, 'X-Plex-Token': user_token[2]})
-					self.result_json.append(entry['ratingKey'])
+					handled_series.append(show['ratingKey'])
 
-		return self.result_json
+			lib_output = self.__get_data('source',f'/library/sections/{lib["key"]}/all', params={'type': content_type, 'includeGuids': '1', 'X-Plex-Token': user_token[1]})['MediaContainer'].get('Metadata', [])
+			if lib['type'] == 'show':
+				lib_output = [e for e in lib_output if not e['grandparentRatingKey'] in handled_series]
+			self.__load_map(lib_output)
+			#go through every media item in the library
+			for entry in lib_output:
+				target_ratingkey = self.__map_to_target(entry)
+				if target_ratingkey == None: continue
+				self.__set_watch_state(entry, target_ratingkey, user_token[2])
 
-	def _playlists(self):
-		print('Playlists')
+		if self.incremental_watch_history and account_id != None:
+			#watch history is synced up to the newest entry from before the full sync
+			self.__store_watermark(user_token[0], new_watermark, int(time()))
+		return
 
-		#get list of tokens (users) to apply action to
-		if not self.user_tokens:
-			from re import findall as re_findall
+	def __store_watermark(self, user: str, viewed_at: int, full_synced_at: int):
+		with self.db_lock:
+			self.sync_db.execute("INSERT OR REPLACE INTO watch_history_watermarks(user, source, viewed_at, full_synced_at) VALUES (?,?,?,?);", (user, self.source_machine_id, viewed_at, full_synced_at))
+			self.sync_db.commit()
+		return
 
-			source_shared_users = self.source_ssn.get(f'http://plex.tv/api/servers/{self.source_machine_id}/shared_servers', headers={}).text
-			target_shared_users = self.target_ssn.get(f'http://plex.tv/api/servers/{self.target_machine_id}/shared_servers', headers={}).text
+	def _watch_history(self, full: bool=False):
+		print('Watch History')
+		self.__run_per_user(lambda user_token: self.__process_watch_history(user_token, full=full))
+		return self.result_json
 
-			#add user self if requested
-			if '@me' in self.users or '@all' in self.users:
-				self.user_tokens.append(['@me', self.source_api_token, self.target_api_token])
+	def __process_playlists(self, user_token: list):
+		print(f'	{user_token[0]}')
 
-			#get data about every user (username at beginning and token at end)
-			source_user_data = re_findall(r'(?<=username=").*?accessToken="\w+?(?=")', source_shared_users)
-			for source_user in source_user_data:
-				username = source_user.split('"')[0]
-				if not '@all' in self.users and not username in self.users:
-					continue
-				source_token = source_user.split('"')[-1]
-				target_token = re_findall(rf'username="{username}.*?accessToken="\w+?(?=")', target_shared_users)
-				if target_token:
-					self.user_tokens.append([username, source_token, target_token[0].split('"')[-1]])
+		#get playlists of user
+		source_playlists = self.__get_data('source','/playlists', params={'includeGuids': '1', 'X-Plex-Token': user_token[1]})['MediaContainer'].get('Metadata', [])
+		target_playlists = self.__get_data('target','/playlists', params={'includeGuids': '1', 'X-Plex-Token': user_token[2]})['MediaContainer'].get('Metadata', [])
 
-		for user_token in self.user_tokens:
-			print(f'	{user_token[0]}')
+		#delete all playlists to keep deleted playlists synced
+		for target_playlist in target_playlists:
+			self.target_ssn.delete(f'{self.target_base_url}/playlists/{target_playlist["ratingKey"]}', params={'X-Plex-Token': user_token[2]})
 
-			#get playlists of user
-			source_playlists = self.__get_data('source','/playlists', params={'includeGuids': '1', 'X-Plex-Token': user_token[1]})['MediaContainer'].get('Metadata', [])
-			target_playlists = self.__get_data('target','/playlists', params={'includeGuids': '1', 'X-Plex-Token': user_token[2]})['MediaContainer'].get('Metadata', [])
+		#sync source playlists to target server
+		for playlist in source_playlists:
+			print(f'		{playlist["title"]}')
+			source_playlist_content = self.__get_data('source',f'/playlists/{playlist["ratingKey"]}/items', params={'includeGuids': '1', 'X-Plex-Token': user_token[1]})['MediaContainer'].get('Metadata', None)
+			if source_playlist_content == None: continue
+			self.__load_map(source_playlist_content)
+			#go through every media item in the library
+			target_playlist_content = []
+			for entry in source_playlist_content:
+				target_ratingkey = self.__map_to_target(entry)
+				if target_ratingkey == None: continue
+
+				target_playlist_content.append(target_ratingkey)
+				self.result_json.append(entry['ratingKey'])
+			if not target_playlist_content: continue
 
-			#delete all playlists to keep deleted playlists synced
-			for target_playlist in target_playlists:
-				self.target_ssn.delete(f'{self.target_base_url}/playlists/{target_playlist["ratingKey"]}', params={'X-Plex-Token': user_token[2]})
+			new_ratingkey = self.target_ssn.post(f'{self.target_base_url}/playlists', params={'type': 'video', 'title': playlist['title'], 'smart': '0', 'uri': f'server://{self.target_machine_id}/com.plexapp.plugins.library/library/metadata/{",".join(target_playlist_content)}', 'X-Plex-Token': user_token[2]}).json()['MediaContainer']['Metadata'][0]['ratingKey']
+			#sync poster
+			if 'thumb' in playlist:
+				self.target_ssn.post(f'{self.target_base_url}/playlists/{new_ratingkey}/posters', params={'url': f'{self.source_base_url}{playlist["thumb"]}?X-Plex-Token={self.source_api_token}'})
+			#sync settings
+			payload = {
+				'summary': playlist.get('summary',''),
+				'X-Plex-Token': self.target_api_token
+			}
+			self.target_ssn.put(f'{self.target_base_url}/playlists/{new_ratingkey}', params=payload)
 
-			#sync source playlists to target server
-			for playlist in source_playlists:
-				print(f'		{playlist["title"]}')
-				source_playlist_content = self.__get_data('source',f'/playlists/{playlist["ratingKey"]}/items', params={'includeGuids': '1', 'X-Plex-Token': user_token[1]})['MediaContainer'].get('Metadata', None)
-				if source_playlist_content == None: continue
-				#make map of media: guids or title -> target ratingkey
-				for entry in source_playlist_content:
-					key = entry['Guid'] if 'Guid' in entry else entry['title']
-					if str(key) in self.map: continue
+			self.result_json += target_playlist_content
 
-					target_ratingkey = self.__find_on_target(guid=entry['Guid'] if 'Guid' in entry else [], title=entry['title'] if 'title' in entry else '', type=entry['type'])
-					if target_ratingkey == None: continue
-					self.map[str(key)] = target_ratingkey['ratingKey']
-
-				#go through every media item in the library
-				target_playlist_content = []
-				for entry in source_playlist_content:
-					key = entry['Guid'] if 'Guid' in entry else entry['title']
-					if not str(key) in self.map: continue
-					target_ratingkey = self.map[str(key)]
-
-					target_playlist_content.append(target_ratingkey)
-					self.result_json.append(entry['ratingKey'])
-				if not target_playlist_content: continue
-
-				new_ratingkey = self.target_ssn.post(f'{self.target_base_url}/playlists', params={'type': 'video', 'title': playlist['title'], 'smart': '0', 'uri': f'server://{self.target_machine_id}/com.plexapp.plugins.library/library/metadata/{",".join(target_playlist_content)}', 'X-Plex-Token': user_token[2]}).json()['MediaContainer']['Metadata'][0]['ratingKey']
-				#sync poster
-				if 'thumb' in playlist:
-					self.target_ssn.post(f'{self.target_base_url}/playlists/{new_ratingkey}/posters', params={'url': f'{self.source_base_url}{playlist["thumb"]}?X-Plex-Token={self.source_api_token}'})
-				#sync settings
-				payload = {
-					'summary': playlist.get('summary',''),
-					'X-Plex-Token': self.target_api_token
-				}
-				self.target_ssn.put(f'{self.target_base_url}/playlists/{new_ratingkey}', params=payload)
-
-				self.result_json += target_playlist_content
+		return
 
+	def _playlists(self):
+		print('Playlists')
+		self.__run_per_user(self.__process_playlists)
 		return self.result_json
 
 if __name__ == '__main__':
@@ -572,14 +963,19 @@ if __name__ == '__main__':
 	parser.add_argument('-S','--Sync', choices=['collections','posters','watch_history','playlists','intro_markers'], help='Select what to sync; This argument can be given multiple times', action='append', required=True, default=[])
 	parser.add_argument('-u','--User', help='Apply user-specific sync actions to these users; This argument can be given multiple times; Use @me to target yourself; Use @all to target everyone', action='append', default=['@me'])
 	parser.add_argument('-p','--NoEpisodePosters', help='When selecting "posters" as (one of) the sync action(s), only sync movie, series and season posters and not episode posters', action='store_false')
+	parser.add_argument('-d','--Daemon', help='Keep running and sync changes as they happen on the source server (based on its notifications) instead of syncing once; A full sync is done at the start and at an interval; Implies --Incremental', action='store_true')
+	parser.add_argument('-i','--Incremental', help='When selecting "watch_history" as (one of) the sync action(s), only sync the media that was watched on the source server since the last run (based on the watch history of the server) instead of going through all media; Unwatching and partial progress are not in the watch history, so those are only synced by a full sync, which is done on the first run for a user and after that every incremental_full_sync_interval seconds (see advanced settings)', action='store_true')
 
 	args = parser.parse_args()
 	#initiate class and process result
-	instance = plex_sync(main_ssn=main_ssn, backup_ssn=backup_ssn, source=args.SourceName, sync=args.Sync, users=args.User, sync_episode_posters=args.NoEpisodePosters)
+	instance = plex_sync(main_ssn=main_ssn, backup_ssn=backup_ssn, source=args.SourceName, sync=args.Sync, users=args.User, sync_episode_posters=args.NoEpisodePosters, incremental_watch_history=args.Incremental)
 	if isinstance(instance, str):
 		parser.error(instance)
 
 	#run sync and process result
+	if args.Daemon:
+		response = instance.start_daemon()
+		parser.error(response)
 	response = instance.start_sync()
 	if not isinstance(response, list):
 		parser.error(response)
@@ -3,9 +3,11 @@
 
 """
 The use case of this script is the following:
-	When a local stream on the main server is buffering for x seconds, stop it and start it on the backup server
+	When a local stream on a server is buffering for x seconds, stop it and start it on another server
+	The stream is started on the least busy server that is up and has the media
 Requirements (python3 -m pip install [requirement]):
 	requests
+	aiohttp
 	PlexAPI
 Setup:
 	Fill the variables below firstly,
@@ -19,6 +21,10 @@ Setup:
 			Playback Start = check
 		Arguments:
 			Playback Start -> Script Arguments = --SessionId {session_id}
+	When using more than the main server, do the above on the tautulli of all servers and add "--Server [name of server]" to the script arguments
+Setup without Tautulli:
+	Fill the variables below firstly, then run the script with --Daemon (e.g. as a service).
+	It keeps running and watches the streams on all servers at the same time, using the notifications of the servers
 """
 
 main_plex_ip = ''
@@ -29,8 +35,46 @@ backup_plex_ip = ''
 backup_plex_port = ''
 backup_plex_api_token = ''
 
+#ADVANCED SETTINGS
+#More servers to fail over to, next to the main and backup server
+#e.g. [{'name': 'server3', 'ip': '192.168.2.3', 'port': '32400', 'api_token': 'abc', 'capacity': 1}]
+#As an environmental variable, give the list in json format
+extra_plex_servers = []
+#How much load a server can handle compared to the other ones (e.g. 2 and 1 = main can handle twice the load of backup)
+main_capacity = 1
+backup_capacity = 1
+#The amount of seconds a server can take to respond before it's seen as down
+server_timeout = 5
+#The load of a stream based on what the server does with the video (or audio if there is no video)
+decision_costs = {
+	'directplay': 1,
+	'copy': 2,
+	'transcode': 8
+}
+#Multiplier for the load of a transcode based on the resolution of the video
+resolution_weights = {
+	'4k': 4,
+	'1080': 1,
+	'720': 0.6,
+	'480': 0.4,
+	'sd': 0.4
+}
+#Multiplier for the load of a transcode when it's done by hardware (e.g. GPU) instead of the CPU
+hardware_transcode_weight = 0.25
+#Multiplier for the load of streams without video (e.g. music)
+audio_weight = 0.1
+#The load added per 10Mbps of bitrate of the stream
+bitrate_cost = 0.5
+
 from os import getenv
-from time import sleep as time_sleep
+from json import loads, dumps
+from time import monotonic, sleep as time_sleep
+from aiohttp import ClientSession, ClientError, WSMsgType
+from asyncio import gather, run, sleep, TimeoutError as AsyncTimeoutError
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue, Empty
+from threading import Thread
+from requests.exceptions import RequestException
 from plexapi.server import PlexServer
 from plexapi.exceptions import NotFound as plexapi_notfound
 
@@ -43,77 +87,136 @@ backup_plex_ip = getenv('backup_plex_ip', backup_plex_ip)
 backup_plex_port = getenv('backup_plex_port', backup_plex_port)
 backup_plex_api_token = getenv('backup_plex_api_token', backup_plex_api_token)
 backup_base_url = f"http://{backup_plex_ip}:{backup_plex_port}"
+main_capacity = float(getenv('main_capacity', main_capacity))
+backup_capacity = float(getenv('backup_capacity', backup_capacity))
+extra_plex_servers = loads(getenv('extra_plex_servers', dumps(extra_plex_servers)))
+server_timeout = float(getenv('server_timeout', server_timeout))
 
-def plex_failover_switch(main_plex_ssn, backup_plex_ssn, media_id: str, player: str, offset: int=0):
-	main_plex = PlexServer(main_base_url, main_plex_api_token)
-	backup_plex = PlexServer(backup_base_url, backup_plex_api_token)
+#server name -> connection info and capacity of the server
+plex_servers = {
+	'main': {'base_url': main_base_url, 'api_token': main_plex_api_token, 'capacity': main_capacity},
+	'backup': {'base_url': backup_base_url, 'api_token': backup_plex_api_token, 'capacity': backup_capacity},
+	**{server['name']: {
+		'base_url': f"http://{server['ip']}:{server['port']}",
+		'api_token': server['api_token'],
+		'capacity': float(server.get('capacity', 1))
+	} for server in extra_plex_servers}
+}
+#media type -> type number used when searching
+media_types = {
+	'movie': '1',
+	'episode': '4',
+	'track': '10'
+}
 
-	#get info about source media
-	media_info = main_plex_ssn.get(f'{main_base_url}/library/metadata/{media_id}', params={'includeGuids': '1'})
-	if media_info.status_code != 404:
-		lib_id = str(media_info.json()['MediaContainer']['librarySectionID'])
-		sections = main_plex_ssn.get(f'{main_base_url}/library/sections').json()['MediaContainer']['Directory']
-		for lib in sections:
-			if lib['key'] == lib_id:
-				lib_type = lib['type']
-				break
-		else:
-			return 'Library type not found'
+def session_cost(session: dict):
+	#the load of a stream on the server, based on the data of the session in /status/sessions
+	transcode = session.get('TranscodeSession', {})
+	media = (session.get('Media') or [{}])[0]
+	decision = transcode.get('videoDecision') or transcode.get('audioDecision') or 'directplay'
+	cost = decision_costs.get(decision, decision_costs['transcode'])
+	if decision == 'transcode':
+		cost *= resolution_weights.get(str(media.get('videoResolution', '')).lower(), 1)
+		if transcode.get('transcodeHwFullPipeline') or transcode.get('transcodeHwEncoding'):
+			cost *= hardware_transcode_weight
+	if not 'videoResolution' in media:
+		cost *= audio_weight
+	#bitrate in kbps
+	bitrate = session.get('Session', {}).get('bandwidth') or media.get('bitrate') or 0
+	return cost + float(bitrate) / 10000 * bitrate_cost
 
-		media_info = media_info.json()['MediaContainer']['Metadata'][0]
-		if 'Guid' in media_info:
-			media_info = media_info['Guid']
-		else:
-			media_info = media_info['title']
+def get_snapshot(ssns: dict):
+	#get the health, streams and load of all servers at the same time
+	def _get_server(server: str):
+		try:
+			sessions = ssns[server].get(f'{plex_servers[server]["base_url"]}/status/sessions', timeout=server_timeout).json()['MediaContainer'].get('Metadata', [])
+		except (RequestException, ValueError, KeyError):
+			#server is down or doesn't respond properly
+			return server, {'healthy': False, 'sessions': [], 'load': 0.0}
+		return server, {'healthy': True, 'sessions': sessions, 'load': sum(session_cost(stream) for stream in sessions) / plex_servers[server]['capacity']}
+
+	with ThreadPoolExecutor(len(ssns)) as executor:
+		return dict(executor.map(_get_server, ssns))
+
+def _find_media(ssn, server: str, media_info: dict):
+	#find the media on the server and return its rating key
+	if not media_info['type'] in media_types: return None
+	if 'Guid' in media_info:
+		#search using guids (reliable); the guid filter only matches the guid of the agent, so that is tried first
+		#and otherwise the guids of all media are compared (e.g. imdb), as the servers could've matched the media using different agents
+		guids = {media_info.get('guid')} | {guid['id'] for guid in media_info['Guid']}
+		guids.discard(None)
+		searches = [{'guid': media_info['guid']}] if media_info.get('guid') else []
+		searches.append({})
 	else:
+		#search using title (unreliable)
+		searches = [{'title': media_info['title']}]
+
+	for search in searches:
+		params = {'type': media_types[media_info['type']], 'includeGuids': '1', **search}
+		try:
+			result = ssn.get(f'{plex_servers[server]["base_url"]}/library/all', params=params, timeout=server_timeout).json()['MediaContainer'].get('Metadata', [])
+		except (RequestException, ValueError, KeyError):
+			continue
+		for media in result:
+			if 'title' in search:
+				if media.get('title') == media_info['title']:
+					return media['ratingKey']
+			elif guids & ({media.get('guid')} | {guid['id'] for guid in media.get('Guid', [])}):
+				return media['ratingKey']
+	return None
+
+def plex_failover_switch(ssns: dict, source_server: str, session: dict):
+	player = session['Player']['title']
+	source_plex = PlexServer(plex_servers[source_server]['base_url'], plex_servers[source_server]['api_token'], timeout=server_timeout)
+
+	#get info about source media
+	media_info = ssns[source_server].get(f'{plex_servers[source_server]["base_url"]}/library/metadata/{session["ratingKey"]}', params={'includeGuids': '1'}, timeout=server_timeout)
+	if media_info.status_code == 404:
 		return 'Media not found'
-	#summary: lib_type = source lib type, lib_id = source lib id, media_info = source title (str) or source guids (list)
-
-	#try to find media on backup server
-	target_key = ''
-	sections = backup_plex_ssn.get(f'{backup_base_url}/library/sections').json()['MediaContainer']['Directory']
-	for lib in sections:
-		if lib['type'] != lib_type: continue
-		if lib['type'] == 'show':
-			lib_output = backup_plex_ssn.get(f'{backup_base_url}/library/sections/{lib["key"]}/all', params={'includeGuids': '1', 'type': '4'}).json()['MediaContainer']['Metadata']
-		else:
-			lib_output = backup_plex_ssn.get(f'{backup_base_url}/library/sections/{lib["key"]}/all', params={'includeGuids': '1'}).json()['MediaContainer']['Metadata']
+	media_info = media_info.json()['MediaContainer']['Metadata'][0]
 
-		for media in lib_output:
-			if isinstance(media_info, list) and 'Guid' in media and media['Guid'] == media_info:
-				#media found on backup server using guids (reliable)
-				target_key = f'/library/metadata/{media["ratingKey"]}'
-				break
+	#go over the other servers that are up, least busy (after getting the stream) first
+	snapshot = get_snapshot(ssns)
+	cost = session_cost(session)
+	targets = sorted(
+		(info['load'] + cost / plex_servers[server]['capacity'], server)
+		for server, info in snapshot.items()
+		if server != source_server and info['healthy']
+	)
 
-			elif isinstance(media_info, str) and 'title' in media and media['title'] == media_info:
-				#media found on backup server using title (unreliable)
-				target_key = f'/library/metadata/{media["ratingKey"]}'
-				break
-		else:
+	#find the first one that has the media and the client
+	target_server, target_client, target_media = None, None, None
+	for _, server in targets:
+		rating_key = _find_media(ssns[server], server, media_info)
+		if rating_key == None: continue
+		target_key = f'/library/metadata/{rating_key}'
+		try:
+			target_plex = PlexServer(plex_servers[server]['base_url'], plex_servers[server]['api_token'], timeout=server_timeout)
+			target_client = target_plex.client(player)
+			target_media = target_plex.fetchItem(target_key)
+		except plexapi_notfound:
 			continue
+		target_server = server
 		break
 
-	#stop stream and if media is found on backup server, start stream from backup server
+	#stop stream and if media is found on another server, start stream from that server
 	try:
-		client = main_plex.client(player)
+		client = source_plex.client(player)
 		client.stop(mtype='video')
 	except plexapi_notfound:
-		return 'Client on main plex server not found'
+		return f'Client on {source_server} plex server not found'
 
-	if target_key:
-		try:
-			client = backup_plex.client(player)
-			media = backup_plex.fetchItem(target_key)
-			client.playMedia(media, offset=offset, key=target_key)
-		except plexapi_notfound:
-			return 'Client on backup plex server not found'
-		return 'Success: send stream to backup server'
+	if target_server != None:
+		target_client.playMedia(target_media, offset=session['viewOffset'], key=target_key)
+		return f'Success: send stream to {target_server} server'
 	else:
 		return 'Success: stopped stream'
 
-def plex_failover(main_plex_ssn, backup_plex_ssn, session_id: str, buffer_threshold: int=10, check_interval: int=5):
+def plex_failover(ssns: dict, session_id: str, server: str='main', buffer_threshold: int=10, check_interval: int=5):
+	base_url = plex_servers[server]['base_url']
 	while True:
-		sessions = main_plex_ssn.get(f'{main_base_url}/status/sessions').json()['MediaContainer']
+		sessions = ssns[server].get(f'{base_url}/status/sessions').json()['MediaContainer']
 		if not 'Metadata' in sessions:
 			#session not found or ended
 			return 'Session ended'
@@ -127,7 +230,7 @@ def plex_failover(main_plex_ssn, backup_plex_ssn, session_id: str, buffer_thresh
 					buffer_counter = 0
 					for _ in range(buffer_threshold):
 						#check if current state is buffering
-						buffer_sessions = main_plex_ssn.get(f'{main_base_url}/status/sessions').json()['MediaContainer']
+						buffer_sessions = ssns[server].get(f'{base_url}/status/sessions').json()['MediaContainer']
 						if not 'Metadata' in buffer_sessions: return 'Session ended'
 						for buffer_session in buffer_sessions['Metadata']:
 							if buffer_session['Session']['id'] == session_id:
@@ -139,7 +242,7 @@ def plex_failover(main_plex_ssn, backup_plex_ssn, session_id: str, buffer_thresh
 						time_sleep(1)
 					if buffer_counter == buffer_threshold:
 						#session has been buffering for {buffer_threshold} seconds so initiate failover
-						response = plex_failover_switch(main_plex_ssn, backup_plex_ssn, player=session['Player']['title'], media_id=session['ratingKey'], offset=session['viewOffset'])
+						response = plex_failover_switch(ssns, source_server=server, session=session)
 						return f'Failover: {response}'
 				break
 		else:
@@ -148,24 +251,113 @@ def plex_failover(main_plex_ssn, backup_plex_ssn, session_id: str, buffer_thresh
 
 		time_sleep(check_interval)
 
+async def _listen(server: str, events: Queue):
+	#put the notifications of the server in the queue; reconnect when the connection is lost
+	url = f'{plex_servers[server]["base_url"].replace("http", "ws", 1)}/:/websockets/notifications'
+	attempt = 0
+	async with ClientSession() as session:
+		while True:
+			try:
+				async with session.ws_connect(url, params={'X-Plex-Token': plex_servers[server]['api_token']}, heartbeat=30) as ws:
+					if attempt > 0:
+						#notifications could've been missed while not connected
+						events.put((server, {'type': 'reconnected'}))
+					attempt = 0
+					async for message in ws:
+						if message.type == WSMsgType.TEXT:
+							events.put((server, message.json().get('NotificationContainer', {})))
+			except (ClientError, AsyncTimeoutError):
+				pass
+			#wait longer with every failed try
+			await sleep(min(0.5 * 2 ** attempt, 60))
+			attempt += 1
+
+async def _listen_all(events: Queue):
+	await gather(*(_listen(server, events) for server in plex_servers))
+
+def _failover_session(ssns: dict, server: str, session_key: str):
+	#check the stream on the server itself before failing it over
+	try:
+		sessions = ssns[server].get(f'{plex_servers[server]["base_url"]}/status/sessions', timeout=server_timeout).json()['MediaContainer'].get('Metadata', [])
+	except (RequestException, ValueError, KeyError):
+		return 'Server not reachable'
+	for session in sessions:
+		if str(session.get('sessionKey')) == session_key:
+			break
+	else:
+		return 'Session ended'
+	if session['Session']['location'] != 'lan': return 'Session not local; ignoring'
+	if session['Player']['state'] != 'buffering': return 'Session not buffering anymore'
+
+	response = plex_failover_switch(ssns, source_server=server, session=session)
+	return f'Failover: {response}'
+
+def plex_failover_daemon(ssns: dict, buffer_threshold: int=10):
+	#watch the streams on all servers using their notifications instead of polling every stream
+	events = Queue()
+	Thread(target=lambda: run(_listen_all(events)), daemon=True).start()
+
+	#(server, session key) -> since when the stream is buffering
+	buffering = {}
+	while True:
+		#wait for a notification or until the stream that has been buffering the longest reaches the threshold
+		timeout = None
+		if buffering:
+			timeout = max(min(buffering.values()) + buffer_threshold - monotonic(), 0)
+		try:
+			server, notification = events.get(timeout=timeout)
+		except Empty:
+			pass
+		else:
+			if notification.get('type') == 'reconnected':
+				#the state of the streams could've changed while not connected
+				for key in [key for key in buffering if key[0] == server]:
+					del buffering[key]
+
+			elif notification.get('type') == 'playing':
+				for state in notification.get('PlaySessionStateNotification', []):
+					key = (server, str(state.get('sessionKey')))
+					if state.get('state') == 'buffering':
+						buffering.setdefault(key, monotonic())
+					else:
+						#stream is playing, paused or stopped
+						buffering.pop(key, None)
+
+		#initiate failover for the streams that have been buffering for {buffer_threshold} seconds
+		for key, since in list(buffering.items()):
+			if monotonic() - since < buffer_threshold: continue
+			del buffering[key]
+			try:
+				response = _failover_session(ssns, *key)
+			except Exception as e:
+				#one failed failover shouldn't stop the monitoring of all other streams
+				response = f'Failover failed: {e!r}'
+			print(f'{key[0]}: {response}')
+
 if __name__ == '__main__':
 	import requests, argparse
 
 	#setup vars
-	main_plex_ssn = requests.Session()
-	main_plex_ssn.headers.update({'Accept': 'application/json'})
-	main_plex_ssn.params.update({'X-Plex-Token': main_plex_api_token})
-	backup_plex_ssn = requests.Session()
-	backup_plex_ssn.headers.update({'Accept': 'application/json'})
-	backup_plex_ssn.params.update({'X-Plex-Token': backup_plex_api_token})
+	ssns = {}
+	for server, info in plex_servers.items():
+		ssns[server] = requests.Session()
+		ssns[server].headers.update({'Accept': 'application/json'})
+		ssns[server].params.update({'X-Plex-Token': info['api_token']})
 
 	#setup arg parsing
-	parser = argparse.ArgumentParser(description="When a local stream on the main server is buffering for x seconds, stop it and start it on the backup server")
-	parser.add_argument('-s','--SessionId', type=str, help="The plex session id of the stream that should be monitored", required=True)
+	parser = argparse.ArgumentParser(description="When a local stream on a server is buffering for x seconds, stop it and start it on another server")
+	parser.add_argument('-s','--SessionId', type=str, help="The plex session id of the stream that should be monitored; required when not running as daemon")
+	parser.add_argument('-S','--Server', choices=list(plex_servers), help="The server that the stream is on", default='main')
 	parser.add_argument('-b','--BufferThreshold', type=int, help="The amount of seconds a stream should be buffering before the failover is triggered", default=10)
 	parser.add_argument('-i','--CheckInterval', type=int, help="The interval in seconds that the script checks a stream", default=5)
+	parser.add_argument('-d','--Daemon', action='store_true', help="Keep running and monitor all streams on all servers instead of one stream")
 
 	args = parser.parse_args()
+	if not args.Daemon and args.SessionId == None:
+		parser.error('-s/--SessionId is required when not running as daemon')
 	#call function and process result
-	response = plex_failover(main_plex_ssn=main_plex_ssn, backup_plex_ssn=backup_plex_ssn, session_id=args.SessionId, buffer_threshold=args.BufferThreshold, check_interval=args.CheckInterval)
-	print(response)
+	if args.Daemon:
+		plex_failover_daemon(ssns=ssns, buffer_threshold=args.BufferThreshold)
+	else:
+		response = plex_failover(ssns=ssns, session_id=args.SessionId, server=args.Server, buffer_threshold=args.BufferThreshold, check_interval=args.CheckInterval)
+		print(response)
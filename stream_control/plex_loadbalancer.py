@@ -3,13 +3,15 @@
 
 """
 The use case of this script is the following:
-	Distribute local streams over two plex servers so that the load on both servers is even
+	Distribute local streams over multiple plex servers so that the load on all servers is even
+	The load of a stream depends on what the server has to do for it (e.g. a 4K transcode weighs more than a direct play);
+	see the advanced settings and session_cost() to change how the load of a stream is calculated
 Requirements (python3 -m pip install [requirement]):
 	requests
 	PlexAPI
 Setup:
 	Fill the variables below firstly,
-	then ON BOTH SERVERS, go to their tautulli web-ui's -> Settings -> Notification Agents -> Add a new notification agent -> Script:
+	then ON ALL SERVERS, go to their tautulli web-ui's -> Settings -> Notification Agents -> Add a new notification agent -> Script:
 		Configuration:
 			Script Folder = /path/to/script/folder
 			Script File = select this script
@@ -23,6 +25,11 @@ Setup:
 Setup without Tautulli:
 	Fill the variables below firstly, then run the script with -h to see the arguments that you can give.
 	Run this script at an interval. Decide for yourself what the interval is (e.g. every 5m or every 1h).
+Note:
+	The script keeps an index of the media on all servers to quickly find the media of a stream on the other servers.
+	It's made and cleaned up by running the script with --RefreshIndex, which should be done once before using the script
+	(it can take a while the first time) and after that at an interval (e.g. every hour).
+	Every run also adds the media that changed since the last refresh to it in the background.
 """
 
 main_plex_ip = ''
@@ -33,7 +40,47 @@ backup_plex_ip = ''
 backup_plex_port = ''
 backup_plex_api_token = ''
 
+#ADVANCED SETTINGS
+#More servers to distribute the streams over, next to the main and backup server
+#e.g. [{'name': 'server3', 'ip': '192.168.2.3', 'port': '32400', 'api_token': 'abc', 'capacity': 1}]
+#As an environmental variable, give the list in json format
+extra_plex_servers = []
+#How much load a server can handle compared to the other ones (e.g. 2 and 1 = main can handle twice the load of backup)
+main_capacity = 1
+backup_capacity = 1
+#The amount of seconds a server can take to respond before it's seen as down
+server_timeout = 5
+#The load of a stream based on what the server does with the video (or audio if there is no video)
+decision_costs = {
+	'directplay': 1,
+	'copy': 2,
+	'transcode': 8
+}
+#Multiplier for the load of a transcode based on the resolution of the video
+resolution_weights = {
+	'4k': 4,
+	'1080': 1,
+	'720': 0.6,
+	'480': 0.4,
+	'sd': 0.4
+}
+#Multiplier for the load of a transcode when it's done by hardware (e.g. GPU) instead of the CPU
+hardware_transcode_weight = 0.25
+#Multiplier for the load of streams without video (e.g. music)
+audio_weight = 0.1
+#The load added per 10Mbps of bitrate of the stream
+bitrate_cost = 0.5
+#The file in which the index of the media on the servers is stored
+#Leave empty to store it next to the script
+index_database_file = ''
+
 from os import getenv
+from os.path import join, dirname, abspath
+from json import loads, dumps
+from sqlite3 import connect
+from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+from requests.exceptions import RequestException
 from plexapi.server import PlexServer
 from plexapi.exceptions import NotFound as plexapi_notfound
 
@@ -46,120 +93,218 @@ backup_plex_ip = getenv('backup_plex_ip', backup_plex_ip)
 backup_plex_port = getenv('backup_plex_port', backup_plex_port)
 backup_plex_api_token = getenv('backup_plex_api_token', backup_plex_api_token)
 backup_base_url = f"http://{backup_plex_ip}:{backup_plex_port}"
+main_capacity = float(getenv('main_capacity', main_capacity))
+backup_capacity = float(getenv('backup_capacity', backup_capacity))
+extra_plex_servers = loads(getenv('extra_plex_servers', dumps(extra_plex_servers)))
+server_timeout = float(getenv('server_timeout', server_timeout))
+index_database_file = getenv('index_database_file', index_database_file) or join(dirname(abspath(__file__)), 'plex_loadbalancer.db')
+
+#server name -> connection info and capacity of the server
+plex_servers = {
+	'main': {'base_url': main_base_url, 'api_token': main_plex_api_token, 'capacity': main_capacity},
+	'backup': {'base_url': backup_base_url, 'api_token': backup_plex_api_token, 'capacity': backup_capacity},
+	**{server['name']: {
+		'base_url': f"http://{server['ip']}:{server['port']}",
+		'api_token': server['api_token'],
+		'capacity': float(server.get('capacity', 1))
+	} for server in extra_plex_servers}
+}
+
+#media_index: guid (or title when the media has no guids) -> ratingkey per server
+#index_state: up to which updatedAt a library is in the index
+index_tables = """
+CREATE TABLE IF NOT EXISTS media_index(
+	server VARCHAR(255),
+	guid VARCHAR(255),
+	rating_key VARCHAR(255),
+	PRIMARY KEY (server, guid)
+);
+CREATE INDEX IF NOT EXISTS media_index_rating_key ON media_index(server, rating_key);
+CREATE TABLE IF NOT EXISTS index_state(
+	server VARCHAR(255),
+	library VARCHAR(255),
+	updated_at INTEGER,
+	PRIMARY KEY (server, library)
+);
+"""
+#library type -> type of the media in it that can be streamed
+index_types = {
+	'movie': '1',
+	'show': '4',
+	'artist': '10'
+}
+
+def _index_keys(media: dict):
+	if 'Guid' in media:
+		return [g['id'] for g in media['Guid']]
+	#media found using title is unreliable
+	return [f'title://{media["type"]}/{media["title"]}']
+
+def _connect_index():
+	db = connect(index_database_file, timeout=30)
+	db.execute("PRAGMA journal_mode = WAL;")
+	db.executescript(index_tables)
+	return db
+
+def refresh_index(ssn, base_url: str, server: str, prune: bool=False):
+	#add the media that was added or changed since the last refresh to the index of the server
+	#when pruning, the whole libraries are fetched to also remove the media that doesn't exist anymore
+	db = _connect_index()
+	rating_keys = []
+	sections = ssn.get(f'{base_url}/library/sections').json()['MediaContainer'].get('Directory', [])
+	for lib in sections:
+		if not lib['type'] in index_types: continue
+		updated_at = db.execute("SELECT updated_at FROM index_state WHERE server = ? AND library = ?;", (server, lib['key'])).fetchone()
+		params = {'includeGuids': '1', 'type': index_types[lib['type']]}
+		if updated_at != None and not prune:
+			#also get the media of the last second again in case it was changed after the last refresh
+			params['updatedAt>>'] = updated_at[0] - 1
+		lib_output = ssn.get(f'{base_url}/library/sections/{lib["key"]}/all', params=params).json()['MediaContainer'].get('Metadata', [])
+		rating_keys += [media['ratingKey'] for media in lib_output]
+
+		#the guids of changed media could've changed too, so replace all of them
+		db.executemany("DELETE FROM media_index WHERE server = ? AND rating_key = ?;", [(server, media['ratingKey']) for media in lib_output])
+		db.executemany("INSERT OR REPLACE INTO media_index(server, guid, rating_key) VALUES (?,?,?);", [(server, key, media['ratingKey']) for media in lib_output for key in _index_keys(media)])
+		new_updated_at = max([m.get('updatedAt', 0) for m in lib_output] + [updated_at[0] if updated_at != None else 0])
+		db.execute("INSERT OR REPLACE INTO index_state(server, library, updated_at) VALUES (?,?,?);", (server, lib['key'], new_updated_at))
+		db.commit()
+
+	if prune:
+		db.execute("CREATE TEMP TABLE existing(rating_key VARCHAR(255) PRIMARY KEY);")
+		db.executemany("INSERT OR IGNORE INTO existing VALUES (?);", [(rating_key,) for rating_key in rating_keys])
+		db.execute("DELETE FROM media_index WHERE server = ? AND NOT rating_key IN existing;", (server,))
+		db.commit()
+	db.close()
+	return
+
+def _find_in_index(db, server: str, keys: list):
+	if not keys: return None
+	result = db.execute(f"SELECT rating_key FROM media_index WHERE server = ? AND guid IN ({','.join('?' * len(keys))}) LIMIT 1;", (server, *keys)).fetchone()
+	return result[0] if result != None else None
+
+def session_cost(session: dict):
+	#the load of a stream on the server, based on the data of the session in /status/sessions
+	transcode = session.get('TranscodeSession', {})
+	media = (session.get('Media') or [{}])[0]
+	decision = transcode.get('videoDecision') or transcode.get('audioDecision') or 'directplay'
+	cost = decision_costs.get(decision, decision_costs['transcode'])
+	if decision == 'transcode':
+		cost *= resolution_weights.get(str(media.get('videoResolution', '')).lower(), 1)
+		if transcode.get('transcodeHwFullPipeline') or transcode.get('transcodeHwEncoding'):
+			cost *= hardware_transcode_weight
+	if not 'videoResolution' in media:
+		cost *= audio_weight
+	#bitrate in kbps
+	bitrate = session.get('Session', {}).get('bandwidth') or media.get('bitrate') or 0
+	return cost + float(bitrate) / 10000 * bitrate_cost
+
+def get_snapshot(ssns: dict):
+	#get the health, streams and load of all servers at the same time
+	def _get_server(server: str):
+		try:
+			sessions = ssns[server].get(f'{plex_servers[server]["base_url"]}/status/sessions', timeout=server_timeout).json()['MediaContainer'].get('Metadata', [])
+		except (RequestException, ValueError, KeyError):
+			#server is down or doesn't respond properly
+			return server, {'healthy': False, 'sessions': [], 'load': 0.0}
+		return server, {'healthy': True, 'sessions': sessions, 'load': sum(session_cost(stream) for stream in sessions) / plex_servers[server]['capacity']}
 
-def plex_loadbalancer(main_plex_ssn, backup_plex_ssn, session_id: str=None, prefered_server: str='main'):
+	with ThreadPoolExecutor(len(ssns)) as executor:
+		return dict(executor.map(_get_server, ssns))
+
+def _load_order(load: dict):
+	#the loads from high to low; a lower order is a better balance (first the busiest server, then the second busiest, etc.)
+	return sorted((round(l, 6) for l in load.values()), reverse=True)
+
+def plex_loadbalancer(ssns: dict, session_id: str=None, prefered_server: str='main'):
 	result_json = {}
-	main_plex = PlexServer(main_base_url, main_plex_api_token)
-	backup_plex = PlexServer(backup_base_url, backup_plex_api_token)
+	plex = {}
+	def _get_plex(server: str):
+		if not server in plex:
+			plex[server] = PlexServer(plex_servers[server]['base_url'], plex_servers[server]['api_token'])
+		return plex[server]
+
+	snapshot = get_snapshot(ssns)
+	db = _connect_index()
+	#bring the index of the servers that are up to date in the background; only wait for it when media isn't found in it
+	#the index is only made with --RefreshIndex, as making it takes too long to do while a stream is waiting to be moved
+	indexed_servers = [r[0] for r in db.execute("SELECT DISTINCT server FROM index_state;")]
+	if any(not server in indexed_servers for server in plex_servers):
+		print('The index is not made yet for all servers; run the script with --RefreshIndex to make it')
+	online_servers = [server for server in snapshot if snapshot[server]['healthy'] and server in indexed_servers]
+	#the refresh is stopped when the script is done; it continues on the next run
+	refresh = Thread(target=lambda: [refresh_index(ssns[server], plex_servers[server]['base_url'], server) for server in online_servers], daemon=True)
+	refresh.start()
 
-	#keep moving streams until they're in balance over the servers
+	#keep moving streams until moving one doesn't make the load more even anymore
 	while True:
-		#get all the streams from both servers
-		main_sessions = main_plex_ssn.get(f'{main_base_url}/status/sessions').json()['MediaContainer']
-		if 'Metadata' in main_sessions: main_sessions = main_sessions['Metadata']
-		else: main_sessions = []
-		backup_sessions = backup_plex_ssn.get(f'{backup_base_url}/status/sessions').json()['MediaContainer']
-		if 'Metadata' in backup_sessions: backup_sessions = backup_sessions['Metadata']
-		else: backup_sessions = []
-
-		#check if streams are balanced
-		if len(main_sessions) == len(backup_sessions):
-			#streams are balanced evenly (e.g. 2-2 or 0-0)
-			break
+		#servers that are down are left out
+		load = {server: info['load'] for server, info in snapshot.items() if info['healthy']}
+		current_order = _load_order(load)
 
-		if (prefered_server == 'main' and len(main_sessions) - 1 == len(backup_sessions)) \
-		or (prefered_server == 'backup' and len(main_sessions) + 1 == len(backup_sessions)):
-			#stream are balanced unevenly (e.g. 3-2 or 2-3 depending on prefered_server)
-			break
+		#select the stream moves that make the load more even, best first (the given session first)
+		candidates = []
+		for source_server in load:
+			for stream in snapshot[source_server]['sessions']:
+				cost = session_cost(stream)
+				for target_server in load:
+					if target_server == source_server: continue
+					new_load = dict(load)
+					new_load[source_server] -= cost / plex_servers[source_server]['capacity']
+					new_load[target_server] += cost / plex_servers[target_server]['capacity']
+					new_order = _load_order(new_load)
+					if new_order < current_order \
+					or (new_order == current_order and target_server == prefered_server):
+						#makes the load more even, or keeps it the same but moves the stream to the prefered server (e.g. 2-3 -> 3-2)
+						candidates.append((stream['Session']['id'] != session_id, new_order, stream, source_server, target_server))
+		candidates.sort(key=lambda c: c[:2])
 
-		#move stream from one server to the other
-		if len(main_sessions) > len(backup_sessions):
-			#move a stream from main server to backup server
-			source_plex = main_plex
-			source_plex_ssn = main_plex_ssn
-			source_base_url = main_base_url
-			target_plex = backup_plex
-			target_plex_ssn = backup_plex_ssn
-			target_base_url = backup_base_url
-			source_sessions = main_sessions
-
-		elif len(main_sessions) < len(backup_sessions):
-			#move a stream from backup server to main server
-			source_plex = backup_plex
-			source_plex_ssn = backup_plex_ssn
-			target_plex = main_plex
-			target_plex_ssn = main_plex_ssn
-			source_sessions = backup_sessions
-
-		#select source stream; if all fail (remote or media not found) exit
-		for check_id in True, False:
-			for stream in source_sessions:
-				if check_id == True and session_id != None and stream['Session']['id'] != session_id: continue
-				#session can possibly be used; check if client of session is on both servers
-				try:
-					source_client = source_plex.client(stream['Player']['title'])
-					target_client = target_plex.client(stream['Player']['title'])
-				except plexapi_notfound:
-					#session not able to be moved
-					continue
-
-				#session can be moved; check if media of session is on both servers
-				#get info about source media
-				media_info = source_plex_ssn.get(f'{source_base_url}/library/metadata/{stream["ratingKey"]}', params={'includeGuids': '1'})
-				lib_id = media_info.json()['MediaContainer']['librarySectionID']
-				sections = source_plex_ssn.get(f'{source_base_url}/library/sections').json()['MediaContainer']['Directory']
-				for lib in sections:
-					if lib['key'] == lib_id:
-						lib_type = lib['type']
-						break
-				else:
-					return 'Library type not found'
-
-				media_info = media_info.json()['MediaContainer']['Metadata'][0]
-				if 'Guid' in media_info:
-					media_info = media_info['Guid']
-				else:
-					media_info = media_info['title']
-
-				#try to find media on backup server
-				target_key = ''
-				sections = target_plex_ssn.get(f'{target_base_url}/library/sections').json()['MediaContainer']['Directory']
-				for lib in sections:
-					if lib['type'] != lib_type: continue
-					if lib['type'] == 'show':
-						lib_output = target_plex_ssn.get(f'{target_base_url}/library/sections/{lib["key"]}/all', params={'includeGuids': '1', 'type': '4'}).json()['MediaContainer']['Metadata']
-					else:
-						lib_output = target_plex_ssn.get(f'{target_base_url}/library/sections/{lib["key"]}/all', params={'includeGuids': '1'}).json()['MediaContainer']['Metadata']
-
-					for media in lib_output:
-						if isinstance(media_info, list) and 'Guid' in media and media['Guid'] == media_info:
-							#media found on target server using guids (reliable)
-							target_key = f'/library/metadata/{media["ratingKey"]}'
-							break
-
-						elif isinstance(media_info, str) and 'title' in media and media['title'] == media_info:
-							#media found on target server using title (unreliable)
-							target_key = f'/library/metadata/{media["ratingKey"]}'
-							break
-					else:
-						continue
-					break
-				if not target_key:
-					#media not found on target server
-					continue
-
-				#move session to target server
-				source_client.stop(mtype='video')
-				media = target_plex.fetchItem(target_key)
-				target_client.playMedia(media, offset=stream['viewOffset'], key=target_key)
-				print('Moved a session from one server to the other')
-				break
-			else:
+		#try to move one of the streams; if all fail (remote, client or media not found) exit
+		for _, _, stream, source_server, target_server in candidates:
+			#session can possibly be used; check if client of session is on both servers
+			try:
+				source_client = _get_plex(source_server).client(stream['Player']['title'])
+				target_client = _get_plex(target_server).client(stream['Player']['title'])
+			except plexapi_notfound:
+				#session not able to be moved
 				continue
+
+			#session can be moved; check if media of session is on both servers
+			#get the guids of the source media from the index, or from the server if it isn't in there (yet)
+			keys = [r[0] for r in db.execute("SELECT guid FROM media_index WHERE server = ? AND rating_key = ?;", (source_server, stream['ratingKey']))]
+			if not keys:
+				keys = _index_keys(ssns[source_server].get(f'{plex_servers[source_server]["base_url"]}/library/metadata/{stream["ratingKey"]}', params={'includeGuids': '1'}).json()['MediaContainer']['Metadata'][0])
+
+			#try to find media on target server
+			target_ratingkey = _find_in_index(db, target_server, keys)
+			if target_ratingkey == None and refresh.is_alive():
+				#media could've been added recently so look again when the index is up to date
+				refresh.join()
+				target_ratingkey = _find_in_index(db, target_server, keys)
+			if target_ratingkey == None:
+				#media not found on target server
+				continue
+			target_key = f'/library/metadata/{target_ratingkey}'
+			try:
+				media = _get_plex(target_server).fetchItem(target_key)
+			except plexapi_notfound:
+				#media was removed from target server
+				db.execute("DELETE FROM media_index WHERE server = ? AND rating_key = ?;", (target_server, target_ratingkey))
+				db.commit()
+				continue
+
+			#move session to target server
+			source_client.stop(mtype='video')
+			target_client.playMedia(media, offset=stream['viewOffset'], key=target_key)
+			print(f'Moved a session from {source_server} to {target_server}')
+			break
+		else:
+			#no stream could be moved
 			break
+		snapshot = get_snapshot(ssns)
 
-	result_json['main'] = main_sessions
-	result_json['backup'] = backup_sessions
+	db.close()
+	for server, info in snapshot.items():
+		result_json[server] = info['sessions']
 
 	return result_json
 
@@ -167,19 +312,23 @@ if __name__ == '__main__':
 	import requests, argparse
 
 	#setup vars
-	main_plex_ssn = requests.Session()
-	main_plex_ssn.headers.update({'Accept': 'application/json'})
-	main_plex_ssn.params.update({'X-Plex-Token': main_plex_api_token})
-	backup_plex_ssn = requests.Session()
-	backup_plex_ssn.headers.update({'Accept': 'application/json'})
-	backup_plex_ssn.params.update({'X-Plex-Token': backup_plex_api_token})
+	ssns = {}
+	for server, info in plex_servers.items():
+		ssns[server] = requests.Session()
+		ssns[server].headers.update({'Accept': 'application/json'})
+		ssns[server].params.update({'X-Plex-Token': info['api_token']})
 
 	#setup arg parsing
-	parser = argparse.ArgumentParser(description="Distribute local streams over two plex servers so that the load on both servers is even")
+	parser = argparse.ArgumentParser(description="Distribute local streams over multiple plex servers so that the load on all servers is even")
 	parser.add_argument('-s','--SessionId', type=str, help="The plex session id of the stream that will be prefered to be moved if needed; only needed for Tautulli setup")
-	parser.add_argument('-p','--PreferedServer', choices=['main','backup'], help="To which server should the restant stream go if there are uneven amount of streams", default='main')
+	parser.add_argument('-p','--PreferedServer', choices=list(plex_servers), help="To which server should the restant stream go if moving it doesn't change the load of the busiest server (e.g. 3-2 vs 2-3 streams)", default='main')
+	parser.add_argument('-r','--RefreshIndex', action='store_true', help="Only update the index of the media on the servers (and remove the media that doesn't exist anymore) and don't balance the streams")
 
 	args = parser.parse_args()
+	if args.RefreshIndex:
+		for server in plex_servers:
+			refresh_index(ssns[server], plex_servers[server]['base_url'], server, prune=True)
+		exit(0)
 	#call function and process result
-	response = plex_loadbalancer(main_plex_ssn=main_plex_ssn, backup_plex_ssn=backup_plex_ssn, session_id=args.SessionId, prefered_server=args.PreferedServer)
+	response = plex_loadbalancer(ssns=ssns, session_id=args.SessionId, prefered_server=args.PreferedServer)
 	print(response)
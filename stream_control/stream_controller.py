@@ -25,6 +25,10 @@ Setup:
 			-- Value -- = lan
 		Arguments:
 			Playback Start -> Script Arguments = --Player {player} --RatingKey {rating_key} --Resolution {stream_video_full_resolution} --Channels {stream_audio_channels} --VideoResolution {video_resolution} --AudioChannels {audio_channels} --ViewOffset {progress_duration_sec}
+Note:
+	The script keeps an index of the versions of all media on the servers so that it doesn't have to search through the libraries on every stream.
+	Run the script with --RefreshIndex at an interval (e.g. every hour) to keep it up to date: it adds new versions and drops removed ones.
+	Run it once before using the script, as the first time it's made can take a while. Versions that aren't in the index yet aren't found.
 """
 
 plex_ip = ''
@@ -62,9 +66,18 @@ exclude_clients = []
 max_resolution = '4k'
 max_channel_count = 9 # 7.2 = 9, 5.1.2 = 8, etc.
 
+#--------------------
+#ADVANCED SETTINGS
+
+#The file in which the index of the versions on the servers is stored
+#Leave empty to store it next to the script
+index_database_file = ''
+
 #--------------------
 
 from os import getenv
+from os.path import join, dirname, abspath
+from sqlite3 import connect, Row
 
 # Environmental Variables
 plex_ip = getenv('plex_ip', plex_ip)
@@ -75,15 +88,55 @@ backup_plex_ip = getenv('backup_plex_ip', backup_plex_ip)
 backup_plex_port = getenv('backup_plex_port', backup_plex_port)
 backup_plex_api_token = getenv('backup_plex_api_token', backup_plex_api_token)
 backup_base_url = f"http://{backup_plex_ip}:{backup_plex_port}"
+index_database_file = getenv('index_database_file', index_database_file) or join(dirname(abspath(__file__)), 'stream_controller.db')
 resolution_ladder = ['480','720','1080','2k','4k','6k','8k']
 type_map = {
 	'movie': ('movie',1),
 	'episode': ('show', 4)
 }
+#server name -> connection info of the servers to search for versions on
+plex_servers = {'main': {'base_url': base_url, 'api_token': plex_api_token}}
+if backup_plex_ip and backup_plex_port and backup_plex_api_token:
+	plex_servers['backup'] = {'base_url': backup_base_url, 'api_token': backup_plex_api_token}
+
+#versions: the video and audio streams of every version of the media on the servers
+#versions_guids: guid -> media on the servers, to find all versions of the same media
+#versions_state: up to which updatedAt a library is in the index
+index_tables = """
+CREATE TABLE IF NOT EXISTS versions(
+	server VARCHAR(255),
+	rating_key VARCHAR(255),
+	id INTEGER,
+	part_id INTEGER,
+	media_index INTEGER,
+	media_id INTEGER,
+	streamType INTEGER,
+	"index" INTEGER,
+	selected BOOL,
+	resolution VARCHAR(255),
+	channel_count INTEGER,
+	PRIMARY KEY (server, id)
+);
+CREATE INDEX IF NOT EXISTS versions_rating_key ON versions(server, rating_key);
+CREATE TABLE IF NOT EXISTS versions_guids(
+	server VARCHAR(255),
+	guid VARCHAR(255),
+	rating_key VARCHAR(255),
+	PRIMARY KEY (server, guid, rating_key)
+);
+CREATE INDEX IF NOT EXISTS versions_guids_guid ON versions_guids(guid);
+CREATE INDEX IF NOT EXISTS versions_guids_rating_key ON versions_guids(server, rating_key);
+CREATE TABLE IF NOT EXISTS versions_state(
+	server VARCHAR(255),
+	library VARCHAR(255),
+	updated_at INTEGER,
+	PRIMARY KEY (server, library)
+);
+"""
 
-def _extract_streams(media_info: dict, server: str) -> tuple:
+def _extract_streams(metadata: dict, server: str) -> tuple:
 	video_result, audio_result = [], []
-	for media_index, media in enumerate(media_info['MediaContainer']['Metadata'][0]['Media']):
+	for media_index, media in enumerate(metadata['Media']):
 		for part in media['Part']:
 			for stream in part['Stream']:
 				if not stream['streamType'] in (1,2): continue
@@ -92,7 +145,7 @@ def _extract_streams(media_info: dict, server: str) -> tuple:
 					'part_id': part['id'],
 					'media_index': media_index,
 					'media_id': media['id'],
-					'rating_key': media_info['MediaContainer']['Metadata'][0]['ratingKey'],
+					'rating_key': metadata['ratingKey'],
 					'server': server,
 
 					'streamType': stream['streamType'],
@@ -106,53 +159,99 @@ def _extract_streams(media_info: dict, server: str) -> tuple:
 				elif stream['streamType'] == 2: audio_result.append(result)
 	return video_result, audio_result
 
+def _connect_index():
+	db = connect(index_database_file, timeout=30)
+	db.execute("PRAGMA journal_mode = WAL;")
+	db.executescript(index_tables)
+	db.row_factory = Row
+	return db
+
+def _store_versions(db, server: str, metadata_list: list):
+	#replace the versions of the media in the index with the given ones
+	for metadata in metadata_list:
+		video_result, audio_result = _extract_streams(metadata, server)
+		db.execute("DELETE FROM versions WHERE server = ? AND rating_key = ?;", (server, metadata['ratingKey']))
+		db.execute("DELETE FROM versions_guids WHERE server = ? AND rating_key = ?;", (server, metadata['ratingKey']))
+		db.executemany("""
+			INSERT OR REPLACE INTO versions(server, rating_key, id, part_id, media_index, media_id, streamType, "index", selected, resolution, channel_count)
+			VALUES (:server, :rating_key, :id, :part_id, :media_index, :media_id, :streamType, :index, :selected, :resolution, :channel_count);
+		""", video_result + audio_result)
+		db.executemany("INSERT OR IGNORE INTO versions_guids(server, guid, rating_key) VALUES (?,?,?);", [(server, guid['id'], metadata['ratingKey']) for guid in metadata.get('Guid', [])])
+	return
+
+def refresh_index(ssn, server: str, prune: bool=False):
+	#add the versions that were added or changed since the last refresh to the index of the server
+	#when pruning, the whole libraries are fetched to also remove the media that doesn't exist anymore
+	server_url = plex_servers[server]['base_url']
+	token = {'X-Plex-Token': plex_servers[server]['api_token']}
+	lib_types = dict(type_map.values())
+	db = _connect_index()
+	rating_keys = []
+	sections = ssn.get(f'{server_url}/library/sections', params=token).json()['MediaContainer'].get('Directory', [])
+	for lib in sections:
+		if not lib['type'] in lib_types: continue
+		updated_at = db.execute("SELECT updated_at FROM versions_state WHERE server = ? AND library = ?;", (server, lib['key'])).fetchone()
+		#also get the media of the last second again in case it was changed after the last refresh
+		updated_at = updated_at[0] - 1 if updated_at != None else -1
+		params = {**token, 'type': lib_types[lib['type']]}
+		if not prune:
+			params['updatedAt>>'] = updated_at
+		lib_output = ssn.get(f'{server_url}/library/sections/{lib["key"]}/all', params=params).json()['MediaContainer'].get('Metadata', [])
+		rating_keys += [media['ratingKey'] for media in lib_output]
+
+		#the streams aren't in the library output so get them in batches
+		changed = [media['ratingKey'] for media in lib_output if media.get('updatedAt', 0) > updated_at]
+		for i in range(0, len(changed), 100):
+			metadata = ssn.get(f'{server_url}/library/metadata/{",".join(changed[i:i+100])}', params={**token, 'includeGuids': '1'}).json()['MediaContainer'].get('Metadata', [])
+			_store_versions(db, server, metadata)
+
+		new_updated_at = max([media.get('updatedAt', 0) for media in lib_output] + [updated_at + 1])
+		db.execute("INSERT OR REPLACE INTO versions_state(server, library, updated_at) VALUES (?,?,?);", (server, lib['key'], new_updated_at))
+		db.commit()
+
+	if prune:
+		db.execute("CREATE TEMP TABLE existing(rating_key VARCHAR(255) PRIMARY KEY);")
+		db.executemany("INSERT OR IGNORE INTO existing VALUES (?);", [(rating_key,) for rating_key in rating_keys])
+		db.execute("DELETE FROM versions WHERE server = ? AND NOT rating_key IN existing;", (server,))
+		db.execute("DELETE FROM versions_guids WHERE server = ? AND NOT rating_key IN existing;", (server,))
+		db.commit()
+	db.close()
+	return
+
 def _find_version(ssn, media_info: dict, resolution: str, channels: int, video_resolution: str, audio_channels: int) -> tuple:
 	video_result, audio_result = [], []
 	#map all available versions and their streams
 	#search inside library entry
-	result = _extract_streams(media_info, server='main')
+	metadata = media_info['MediaContainer']['Metadata'][0]
+	result = _extract_streams(metadata, server='main')
 	video_result += result[0]
 	audio_result += result[1]
 
-	#search inside other libraries
-	sections = ssn.get(f'{base_url}/library/sections').json()['MediaContainer'].get('Directory',[])
-	media_type = type_map[media_info['MediaContainer']['Metadata'][0]['type']]
-	for lib in sections:
-		if lib['type'] != media_type[0]: continue
-		if lib['key'] == str(media_info['MediaContainer']['librarySectionID']): continue
-		lib_output = ssn.get(f'{base_url}/library/sections/{lib["key"]}/all', params={'type': media_type[1], 'includeGuids': '1'}).json()['MediaContainer'].get('Metadata',[])
-		for media in lib_output:
-			if media['Guid'] == media_info['MediaContainer']['Metadata'][0]['Guid']:
-				#found media in other library
-				media_entry_info = ssn.get(f'{base_url}/library/metadata/{media["ratingKey"]}').json()
-				result = _extract_streams(media_entry_info, server='main')
-				video_result += result[0]
-				audio_result += result[1]
-				break
-		else:
-			continue
-		break
-
-	#search on backup server
-	if backup_plex_ip and backup_plex_port and backup_plex_api_token:
-		ssn.params.update({'X-Plex-Token': backup_plex_api_token})
-		sections = ssn.get(f'{backup_base_url}/library/sections').json()['MediaContainer'].get('Directory',[])
-		for lib in sections:
-			if lib['type'] != media_type[0]: continue
-			lib_output = ssn.get(f'{backup_base_url}/library/sections/{lib["key"]}/all', params={'type': media_type[1], 'includeGuids': '1'}).json()['MediaContainer'].get('Metadata',[])
-			for media in lib_output:
-				if media['Guid'] == media_info['MediaContainer']['Metadata'][0]['Guid']:
-					#found media on backup server
-					media_entry_info = ssn.get(f'{backup_base_url}/library/metadata/{media["ratingKey"]}').json()
-					result = _extract_streams(media_entry_info, server='backup')
-					video_result += result[0]
-					audio_result += result[1]
-					break
-			else:
-				continue
-			break
-
-		ssn.params.update({'X-Plex-Token': plex_api_token})
+	#search inside other libraries and on backup server using the index
+	db = _connect_index()
+	#the library entry was just fetched so keep it up to date in the index
+	_store_versions(db, 'main', [metadata])
+	db.commit()
+	guids = [guid['id'] for guid in metadata.get('Guid', [])]
+	versions = db.execute(f"""
+		SELECT v.*
+		FROM versions v
+		INNER JOIN (
+			SELECT DISTINCT server, rating_key
+			FROM versions_guids
+			WHERE guid IN ({','.join('?' * len(guids))})
+		) g
+		ON v.server = g.server AND v.rating_key = g.rating_key
+		WHERE NOT (v.server = 'main' AND v.rating_key = ?)
+		ORDER BY v.server != 'main', v.rowid;
+	""", (*guids, metadata['ratingKey'])).fetchall() if guids else []
+	db.close()
+	for version in map(dict, versions):
+		#versions of a server that isn't setup anymore or with an unknown resolution can't be used
+		if not version['server'] in plex_servers or not version['resolution'] in resolution_ladder: continue
+		version['selected'] = bool(version['selected'])
+		if version['streamType'] == 1: video_result.append(version)
+		elif version['streamType'] == 2: audio_result.append(version)
 
 	#filter and sort streams
 	if process_video == True and process_audio == False:
@@ -329,15 +428,22 @@ if __name__ == '__main__':
 
 	#setup arg parsing
 	parser = ArgumentParser(description='When a local stream is started, check if a different version of the media exists that better matches the desired criteria (resolution or audio channel count).')
-	parser.add_argument('-p','--Player', type=str, help='The name of the player used for the stream', required=True)
-	parser.add_argument('-k','--RatingKey', type=str, help='The rating key of the media being streamed', required=True)
-	parser.add_argument('-r','--Resolution', type=str, help='The resolution of the stream', required=True)
-	parser.add_argument('-c','--Channels', type=int, help='The channel count of the stream', required=True)
-	parser.add_argument('-R','--VideoResolution', type=str, help='The resolution of the stream inside the file', required=True)
-	parser.add_argument('-C','--AudioChannels', type=int, help='The channel count of the stream inside the file', required=True)
-	parser.add_argument('-v','--ViewOffset', type=int, help='The offfset of the stream', required=True)
+	parser.add_argument('-p','--Player', type=str, help='The name of the player used for the stream; required')
+	parser.add_argument('-k','--RatingKey', type=str, help='The rating key of the media being streamed; required')
+	parser.add_argument('-r','--Resolution', type=str, help='The resolution of the stream; required')
+	parser.add_argument('-c','--Channels', type=int, help='The channel count of the stream; required')
+	parser.add_argument('-R','--VideoResolution', type=str, help='The resolution of the stream inside the file; required')
+	parser.add_argument('-C','--AudioChannels', type=int, help='The channel count of the stream inside the file; required')
+	parser.add_argument('-v','--ViewOffset', type=int, help='The offfset of the stream; required')
+	parser.add_argument('-i','--RefreshIndex', action='store_true', help='Only update the index of the versions on the servers (and remove the ones that don\'t exist anymore) and don\'t process a stream')
 
 	args = parser.parse_args()
+	if args.RefreshIndex:
+		for server in plex_servers:
+			refresh_index(ssn, server, prune=True)
+		exit(0)
+	if None in (args.Player, args.RatingKey, args.Resolution, args.Channels, args.VideoResolution, args.AudioChannels, args.ViewOffset):
+		parser.error('-p/--Player, -k/--RatingKey, -r/--Resolution, -c/--Channels, -R/--VideoResolution, -C/--AudioChannels and -v/--ViewOffset are required')
 	#call function and process result
 	response = stream_controller(ssn=ssn, plex=plex, player=args.Player, rating_key=args.RatingKey, resolution=args.Resolution, channels=args.Channels, video_resolution=args.VideoResolution, audio_channels=args.AudioChannels, view_offset=args.ViewOffset, backup_plex=backup_plex)
 	if not isinstance(response, list):